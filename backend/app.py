@@ -18,6 +18,22 @@ def create_app():
     
     # Connect to DB
     db.connect()
+
+    from config import ANALYTICS_BACKEND
+    if ANALYTICS_BACKEND == "rollup":
+        # Periodically rebuilds the analytics counters from scratch (one worker per interval)
+        from services.analytics_rollup import start_reconciler
+        start_reconciler()
+
+    # Scores patients stored before patient_risk existed, off the request path
+    from services.risk_service import start_risk_backfill
+    start_risk_backfill()
+
+    # Bulk jobs are queued in memory: pick up the ones a restart left behind
+    from services.export_service import recover_exports
+    recover_exports()
+    from services.import_service import recover_imports
+    recover_imports()
     
     # Global Error Handler
     from flask import jsonify
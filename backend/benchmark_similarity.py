@@ -0,0 +1,68 @@
+"""
+Benchmark: approximate (MinHash/LSH) vs exact similar-patient search.
+Reports recall of the approximate top-k against the exact top-k and the latency of both paths.
+
+Usage: python benchmark_similarity.py [sample_size] [k]
+"""
+import sys
+import time
+import random
+from config import db
+
+def recall(exact, approx):
+    """(id recall, score recall). Score recall ignores which of several tied patients was picked."""
+    if not exact:
+        return 1.0, 1.0
+    exact_ids = {p["patient_id"] for p in exact}
+    id_recall = len(exact_ids & {p["patient_id"] for p in approx}) / len(exact)
+
+    remaining = [p["similarity_score"] for p in approx]
+    matched = 0
+    for score in (p["similarity_score"] for p in exact):
+        if score in remaining:
+            remaining.remove(score)
+            matched += 1
+    return id_recall, matched / len(exact)
+
+def run_benchmark(sample_size=100, k=5):
+    from services.recommendation_service import find_similar_patients
+    from services.cohort_lsh import rebuild_signatures
+    from models.models import PatientModel
+
+    print("Rebuilding MinHash signatures...")
+    rebuild_signatures()
+
+    ids = [p["id"] for p in PatientModel().collection.find({"id": {"$exists": True}}, {"id": 1})]
+    sample = random.Random(42).sample(ids, min(sample_size, len(ids)))
+    print(f"Benchmarking {len(sample)} patients, k={k}")
+
+    # Warm the exact index so its one-off build is not counted
+    if sample:
+        find_similar_patients(sample[0], k=k)
+
+    exact_time = approx_time = 0.0
+    id_recalls, score_recalls = [], []
+    for pid in sample:
+        start = time.time()
+        exact = find_similar_patients(pid, k=k)
+        exact_time += time.time() - start
+
+        start = time.time()
+        approx = find_similar_patients(pid, k=k, mode="approximate")
+        approx_time += time.time() - start
+
+        id_r, score_r = recall(exact, approx)
+        id_recalls.append(id_r)
+        score_recalls.append(score_r)
+
+    n = max(len(sample), 1)
+    print(f"Exact:       {round(exact_time / n * 1000, 2)} ms/query")
+    print(f"Approximate: {round(approx_time / n * 1000, 2)} ms/query")
+    print(f"Recall@{k} (patient ids): {round(sum(id_recalls) / n, 3)}")
+    print(f"Recall@{k} (scores):      {round(sum(score_recalls) / n, 3)}")
+
+if __name__ == "__main__":
+    db.connect()
+    sample_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    run_benchmark(sample_size, k)
@@ -0,0 +1,117 @@
+"""
+Benchmark: per-resource cost of FHIR validation, the previous path against the current one.
+The previous path looked the model class up on every call, round-tripped the model through a
+JSON string and appended each failure to the error log synchronously; the current one caches
+model classes, dumps straight to JSON-mode dicts (or, for the fixed shapes the API builds,
+skips re-serialization) and logs failures through a queue.
+Also checks that both paths return identical documents.
+
+Usage: python benchmark_validation.py [iterations]
+"""
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import warnings
+from fhir.resources import get_fhir_model_class
+from utils.validation import validate_fhir_resource
+
+def legacy_validate(resource_type, data, error_log):
+    """The validation path as it was before the model-class cache and direct dump."""
+    try:
+        resource = get_fhir_model_class(resource_type)(**data)
+        return json.loads(resource.json()), None
+    except Exception as e:
+        with open(error_log, "a") as f:
+            f.write(f"Validation Error for {resource_type}: {str(e)}\nData: {data}\n\n")
+        return None, str(e)
+
+def sample_resources():
+    """
+    (resource type, data, canonical) for the shapes built by /auth/register and
+    clinical-update, plus one invalid resource.
+    """
+    subject = {"reference": "Patient/6650f1c2a1b2c3d4e5f60718"}
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat().replace("+00:00", "Z")
+    return [
+        ("Patient", {
+            "resourceType": "Patient",
+            "name": [{"text": "Jane Doe"}],
+            "gender": "female",
+            "birthDate": "1980-04-12",
+            "telecom": [{"system": "phone", "value": "555-0100"}],
+            "address": [{"text": "12 Main St, Austin"}]
+        }, False),
+        ("Condition", {
+            "resourceType": "Condition",
+            "clinicalStatus": {"text": "Active"},
+            "code": {"text": "Type 2 Diabetes"},
+            "subject": subject
+        }, True),
+        ("Observation", {
+            "resourceType": "Observation",
+            "status": "final",
+            "code": {
+                "coding": [{"system": "http://loinc.org", "code": "8480-6", "display": "Systolic blood pressure"}],
+                "text": "Systolic blood pressure"
+            },
+            "subject": subject,
+            "valueQuantity": {"value": 128.0, "unit": "mmHg", "system": "http://unitsofmeasure.org", "code": "mmHg"},
+            "effectiveDateTime": now
+        }, True),
+        ("Observation", {
+            "resourceType": "Observation",
+            "status": "final",
+            "code": {"text": "Blood Oxygen"},
+            "subject": subject,
+            "valueQuantity": {"value": 97.5, "unit": None, "system": "http://unitsofmeasure.org", "code": None},
+            "effectiveDateTime": now
+        }, True),
+        ("MedicationRequest", {
+            "resourceType": "MedicationRequest",
+            "status": "active",
+            "intent": "order",
+            "medication": {"concept": {"text": "Metformin"}},
+            "subject": subject
+        }, True),
+        ("Patient", {"resourceType": "Patient", "name": "Invalid String Name instead of Array"}, False),
+    ]
+
+def time_path(validate, samples, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for resource_type, data, canonical in samples:
+            validate(resource_type, data, canonical)
+    return (time.perf_counter() - start) / (iterations * len(samples))
+
+def run_benchmark(iterations=500):
+    warnings.simplefilter("ignore")  # fhir.resources deprecation warnings for .json()
+    samples = sample_resources()
+    error_log = os.path.join(tempfile.mkdtemp(), "validation_errors.log")
+
+    mismatches = 0
+    for resource_type, data, canonical in samples:
+        expected = legacy_validate(resource_type, data, error_log)
+        if expected != validate_fhir_resource(resource_type, data, log_errors=False, canonical=canonical):
+            mismatches += 1
+    print(f"Output check: {len(samples) - mismatches}/{len(samples)} samples identical")
+
+    paths = {
+        "Before": lambda t, d, c: legacy_validate(t, d, error_log),
+        "After (model dump)": lambda t, d, c: validate_fhir_resource(t, d),
+        "After (fixed shapes)": lambda t, d, c: validate_fhir_resource(t, d, canonical=c),
+    }
+    # Warm every path so one-off model imports are not counted
+    for validate in paths.values():
+        time_path(validate, samples, 5)
+
+    print(f"Benchmarking {iterations} x {len(samples)} resources")
+    timings = {name: time_path(validate, samples, iterations) for name, validate in paths.items()}
+    for name, seconds in timings.items():
+        print(f"{name + ':':<22}{round(seconds * 1e6, 1)} us/resource ({round(timings['Before'] / seconds, 2)}x)")
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    run_benchmark(iterations)
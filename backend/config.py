@@ -1,6 +1,11 @@
 from pymongo import MongoClient
 import os
 
+# Execution backend for AnalyticsService: "python" (single scan in the app), "mongo"
+# (aggregation pipelines), "rollup" (counters maintained on write) or "snapshot" (vectorized
+# over an in-memory columnar copy, which also serves batch risk scoring)
+ANALYTICS_BACKEND = os.getenv("ANALYTICS_BACKEND", "python").lower()
+
 class Database:
     def __init__(self):
         self.client = None
@@ -16,6 +21,9 @@ class Database:
                 # Trigger a command to verify connection
                 self.client.admin.command('ping')
                 logger.info(f"Connected to MongoDB at {uri.split('@')[-1]}")
+                if os.getenv("ENSURE_INDEXES", "1") != "0":
+                    from utils.index_manager import ensure_indexes
+                    ensure_indexes(self.db)
             except Exception as e:
                 logger.error(f"Failed to connect to MongoDB: {str(e)}")
                 raise e
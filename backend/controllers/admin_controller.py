@@ -1,9 +1,12 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, Response, current_app, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity, get_jwt
 from models.insurance_plan_model import InsurancePlanModel
 from models.models import PatientModel, UserModel
 from config import db
 from utils.logger import logger
+from utils.pagination import parse_cursor_args, decode_cursor, keyset_page, SEARCH_MODES, MAX_DUMP_PAGE_SIZE
+from utils.patient_key import PATIENT_KEY_FIELD
+from utils.streaming import elements_projection, stream_json_array, stream_ndjson, NDJSON_MIMETYPE, CURSOR_BATCH_SIZE
 
 admin_bp = Blueprint('admin', __name__)
 plan_model = InsurancePlanModel()
@@ -15,6 +18,13 @@ def admin_required():
         return False
     return True
 
+def _cursor_response(result, next_token, params, total_count, estimated):
+    response = {"data": result, "next": next_token, "limit": params["limit"]}
+    if total_count is not None:
+        response["total"] = total_count
+        response["total_estimated"] = estimated
+    return response
+
 # --- Insurance Plan CRUD ---
 
 @admin_bp.route('/plans', methods=['GET'])
@@ -79,11 +89,21 @@ def get_all_patients():
     if claims.get("role") != "admin":
         return jsonify({"error": "Admin access required"}), 403
         
-    page = int(request.args.get('page', 1))
-    limit = int(request.args.get('limit', 15))
-    search = request.args.get('search', None)
-    
-    patients, total_count = patient_model.find_paginated(page, limit, search)
+    # ?after=<token> (empty for the first page) switches to keyset pagination
+    cursor_mode = 'after' in request.args
+    if cursor_mode:
+        params, error = parse_cursor_args(request.args)
+        if error:
+            return jsonify({"error": error}), 400
+        patients, next_token, total_count, estimated = patient_model.find_page(**params)
+    else:
+        page = int(request.args.get('page', 1))
+        limit = int(request.args.get('limit', 15))
+        search = request.args.get('search', None)
+        search_mode = request.args.get('search_mode', 'contains')
+        if search_mode not in SEARCH_MODES:
+            return jsonify({"error": f"search_mode must be one of {list(SEARCH_MODES)}"}), 400
+        patients, total_count = patient_model.find_paginated(page, limit, search, search_mode)
     
     # Format for listing
     result = []
@@ -107,7 +127,9 @@ def get_all_patients():
             "birthDate": p.get("birthDate"),
             "address": p.get("address", [{}])[0].get("text", "")
         })
-        
+
+    if cursor_mode:
+        return jsonify(_cursor_response(result, next_token, params, total_count, estimated))
     return jsonify({
         "data": result,
         "total": total_count,
@@ -141,41 +163,48 @@ def get_risk_distribution():
     if claims.get("role") != "admin":
         return jsonify({"error": "Admin access required"}), 403
     
-    # Calculate risk for all patients (This could be slow for many patients, optimize later)
-    # For a demo/hackathon, calculating on fly is okay, or we could cache it.
-    
-    from services.risk_service import calculate_risk_score
-    from models.models import ConditionModel
-    condition_model = ConditionModel()
-    
-    patients = patient_model.find_all()
-    distribution = {"Low": 0, "Medium": 0, "High": 0, "Unknown": 0}
-    
-    for p in patients:
-        # Use FHIR ID primarily, fallback to MongoDB _id
-        p_id = p.get("id") or str(p["_id"])
-        conditions = condition_model.find_by_patient(p_id)
-        
-        try:
-             risk_res = calculate_risk_score(p, conditions)
-             # Extract label
-             prediction = risk_res.get("prediction", [{}])[0]
-             label = prediction.get("qualitativeRisk", {}).get("coding", [{}])[0].get("display", "Unknown")
-             
-             if label in distribution:
-                 distribution[label] += 1
-             else:
-                 distribution["Unknown"] += 1
-        except Exception as e:
-             print(f"Error calculating risk for patient {p_id}: {str(e)}")
-             distribution["Unknown"] += 1
-             
+    # One $group over the materialized patient_risk rows (kept current by clinical writes and bulk loads)
+    from services.risk_service import get_population_risk_distribution
+    distribution = get_population_risk_distribution()
+
     # Format for chart (ChartJS usually takes labels and data arrays)
     return jsonify({
         "labels": ["Low Risk", "Medium Risk", "High Risk", "Unknown/Error"],
         "data": [distribution["Low"], distribution["Medium"], distribution["High"], distribution["Unknown"]]
     })
 
+@admin_bp.route('/stats/risk-simulate', methods=['POST'])
+@jwt_required()
+def simulate_population_risk():
+    claims = get_jwt()
+    if claims.get("role") != "admin":
+        return jsonify({"error": "Admin access required"}), 403
+
+    data = request.json or {}
+    weight_sets = data.get('weight_sets')
+    if not weight_sets or not isinstance(weight_sets, list) or not all(isinstance(w, dict) for w in weight_sets):
+        return jsonify({"error": "weight_sets must be a non-empty list of weight objects"}), 400
+
+    from services.simulation_service import simulate_population
+    try:
+        results = simulate_population(weight_sets, include_scores=bool(data.get('include_scores')))
+    except (TypeError, ValueError):
+        return jsonify({"error": "Weights must be numeric"}), 400
+    return jsonify({"results": results})
+
+@admin_bp.route('/stats/plan-recommendations', methods=['GET'])
+@jwt_required()
+def get_plan_recommendation_stats():
+    claims = get_jwt()
+    if claims.get("role") != "admin":
+        return jsonify({"error": "Admin access required"}), 403
+
+    from services.recommendation_service import recommend_plans_for_population
+    counts = {}
+    for plan_id in recommend_plans_for_population().values():
+        counts[plan_id] = counts.get(plan_id, 0) + 1
+    return jsonify(counts)
+
 @admin_bp.route('/patients/<patient_id>/fhir', methods=['GET'])
 @jwt_required()
 def get_patient_fhir(patient_id):
@@ -235,7 +264,19 @@ def delete_patient(patient_id):
     if claims.get("role") != "admin":
         return jsonify({"error": "Admin access required"}), 403
         
+    patient = patient_model.find_by_id(patient_id)
     if patient_model.delete(patient_id):
+        if patient:
+            from models.patient_risk_model import PatientRiskModel
+            PatientRiskModel().delete_by_patient(patient.get("id") or str(patient["_id"]))
+            from services.similarity_index import similarity_index
+            similarity_index.remove_patient(patient.get("id") or str(patient["_id"]))
+            from models.patient_signature_model import PatientSignatureModel
+            PatientSignatureModel().delete_by_patient(patient.get("id") or str(patient["_id"]))
+            from services.analytics_rollup import refresh_patient_rollup
+            refresh_patient_rollup(patient.get("id") or str(patient["_id"]))
+            from services.population_snapshot import mark_population_changed
+            mark_population_changed()
         return jsonify({"message": "Patient deleted successfully"}), 200
     return jsonify({"error": "Patient not found"}), 404
 
@@ -246,13 +287,24 @@ def get_all_users():
     if claims.get("role") != "admin":
         return jsonify({"error": "Admin access required"}), 403
     
-    page = int(request.args.get('page', 1))
-    limit = int(request.args.get('limit', 15))
-    search = request.args.get('search', None)
-    
     from models.models import UserModel
     user_model = UserModel()
-    users, total_count = user_model.find_paginated(page, limit, search)
+
+    # ?after=<token> (empty for the first page) switches to keyset pagination
+    cursor_mode = 'after' in request.args
+    if cursor_mode:
+        params, error = parse_cursor_args(request.args)
+        if error:
+            return jsonify({"error": error}), 400
+        users, next_token, total_count, estimated = user_model.find_page(**params)
+    else:
+        page = int(request.args.get('page', 1))
+        limit = int(request.args.get('limit', 15))
+        search = request.args.get('search', None)
+        search_mode = request.args.get('search_mode', 'contains')
+        if search_mode not in SEARCH_MODES:
+            return jsonify({"error": f"search_mode must be one of {list(SEARCH_MODES)}"}), 400
+        users, total_count = user_model.find_paginated(page, limit, search, search_mode)
     
     result = []
     for user in users:
@@ -266,7 +318,9 @@ def get_all_users():
             "email": user.get("email")
         }
         result.append(user_data)
-    
+
+    if cursor_mode:
+        return jsonify(_cursor_response(result, next_token, params, total_count, estimated))
     return jsonify({
         "data": result,
         "total": total_count,
@@ -296,6 +350,44 @@ def delete_user(user_id):
 
 # --- New Admin Endpoints for Enhanced Dashboard ---
 
+def _dump_collection(collection):
+    """
+    Admin dump of a whole collection without building it in memory:
+    - default: a JSON array streamed from the cursor
+    - ?after=<token>&limit=N: one keyset page {"data", "next", "limit"} ("after" empty for the first)
+    - ?_format=ndjson: one resource per line, streamed (from `after` if given)
+    ?_elements=a,b returns only those elements of each resource.
+    """
+    projection, error = elements_projection(request.args.get('_elements'))
+    if error:
+        return jsonify({"error": error}), 400
+    if projection is None:
+        projection = {PATIENT_KEY_FIELD: 0}
+
+    def public(item):
+        item['id'] = str(item['_id'])
+        del item['_id']
+        return item
+
+    ndjson = request.args.get('_format') in ("ndjson", NDJSON_MIMETYPE)
+    if 'after' in request.args and not ndjson:
+        params, error = parse_cursor_args(request.args, default_limit=100, max_limit=MAX_DUMP_PAGE_SIZE)
+        if error:
+            return jsonify({"error": error}), 400
+        items, next_token = keyset_page(collection, {}, params["limit"], params["after"], projection)
+        return jsonify({"data": [public(i) for i in items], "next": next_token, "limit": params["limit"]})
+
+    try:
+        after = decode_cursor(request.args.get('after'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    query = {"_id": {"$gt": after}} if after is not None else {}
+    docs = (public(i) for i in collection.find(query, projection, batch_size=CURSOR_BATCH_SIZE).sort("_id", 1))
+    dumps = current_app.json.dumps
+    if ndjson:
+        return Response(stream_with_context(stream_ndjson(docs, dumps)), mimetype=NDJSON_MIMETYPE)
+    return Response(stream_with_context(stream_json_array(docs, dumps)), mimetype="application/json")
+
 @admin_bp.route('/clinical/conditions', methods=['GET'])
 @jwt_required()
 def get_all_conditions():
@@ -304,12 +396,7 @@ def get_all_conditions():
         return jsonify({"error": "Admin access required"}), 403
     
     from models.models import ConditionModel
-    model = ConditionModel()
-    data = model.find_all()
-    for item in data:
-        item['id'] = str(item['_id'])
-        del item['_id']
-    return jsonify(data)
+    return _dump_collection(ConditionModel().collection)
 
 @admin_bp.route('/clinical/observations', methods=['GET'])
 @jwt_required()
@@ -319,12 +406,7 @@ def get_all_observations():
         return jsonify({"error": "Admin access required"}), 403
     
     from models.models import ObservationModel
-    model = ObservationModel()
-    data = model.find_all()
-    for item in data:
-        item['id'] = str(item['_id'])
-        del item['_id']
-    return jsonify(data)
+    return _dump_collection(ObservationModel().collection)
 
 @admin_bp.route('/clinical/medications', methods=['GET'])
 @jwt_required()
@@ -334,12 +416,7 @@ def get_all_medications():
         return jsonify({"error": "Admin access required"}), 403
     
     from models.models import MedicationModel
-    model = MedicationModel()
-    data = model.find_all()
-    for item in data:
-        item['id'] = str(item['_id'])
-        del item['_id']
-    return jsonify(data)
+    return _dump_collection(MedicationModel().collection)
 
 @admin_bp.route('/clinical/risk-assessments', methods=['GET'])
 @jwt_required()
@@ -349,12 +426,7 @@ def get_all_risk_assessments():
         return jsonify({"error": "Admin access required"}), 403
     
     from models.risk_assessment_model import RiskAssessmentModel
-    model = RiskAssessmentModel()
-    data = model.find_all()
-    for item in data:
-        item['id'] = str(item['_id'])
-        del item['_id']
-    return jsonify(data)
+    return _dump_collection(RiskAssessmentModel().collection)
 
 @admin_bp.route('/insurance/coverage', methods=['GET'])
 @jwt_required()
@@ -364,12 +436,7 @@ def get_all_coverage():
         return jsonify({"error": "Admin access required"}), 403
     
     from models.coverage_model import CoverageModel
-    model = CoverageModel()
-    data = model.find_all()
-    for item in data:
-        item['id'] = str(item['_id'])
-        del item['_id']
-    return jsonify(data)
+    return _dump_collection(CoverageModel().collection)
 
 @admin_bp.route('/insurance/consents', methods=['GET'])
 @jwt_required()
@@ -379,12 +446,7 @@ def get_all_consents():
         return jsonify({"error": "Admin access required"}), 403
     
     from models.consent_model import ConsentModel
-    model = ConsentModel()
-    data = model.find_all()
-    for item in data:
-        item['id'] = str(item['_id'])
-        del item['_id']
-    return jsonify(data)
+    return _dump_collection(ConsentModel().collection)
 
 @admin_bp.route('/system/logs', methods=['GET'])
 @jwt_required()
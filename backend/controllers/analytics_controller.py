@@ -1,5 +1,7 @@
+import os
 from flask import Blueprint, jsonify, request
 from services.analytics_service import AnalyticsService
+from utils.result_cache import ResultCache
 import services.risk_service as risk_service
 import services.recommendation_service as recommendation_service
 from models.models import PatientModel, ConditionModel
@@ -9,42 +11,61 @@ analytics_service = AnalyticsService()
 patient_model = PatientModel()
 condition_model = ConditionModel()
 
+# Population views are shared by every admin: fresh for ANALYTICS_CACHE_TTL seconds, then served
+# stale for up to ANALYTICS_CACHE_STALE_TTL more while one background refresh runs.
+analytics_cache = ResultCache(
+    ttl=int(os.getenv("ANALYTICS_CACHE_TTL", "60")),
+    stale_ttl=int(os.getenv("ANALYTICS_CACHE_STALE_TTL", "600")),
+    name="analytics_cache"
+)
+
+def _cached(view, compute):
+    # None of the population views take query parameters, so the view name alone is the key:
+    # arbitrary query strings must not each get their own entry and computation.
+    return analytics_cache.get(view, compute)
+
 # --- POPULATION ANALYTICS (ADMIN ONLY) ---
 
 @analytics_bp.route('/population/disease-distribution', methods=['GET'])
 def get_disease_distribution():
     # RBAC: Add admin check decorator here in real app
-    data = analytics_service.get_disease_distribution()
+    data = _cached("disease_distribution", analytics_service.get_disease_distribution)
     return jsonify(data), 200
 
 @analytics_bp.route('/population/disease-trends-by-age', methods=['GET'])
 def get_disease_trends_by_age():
-    data = analytics_service.get_disease_trends_by_age()
+    data = _cached("disease_trends_by_age", analytics_service.get_disease_trends_by_age)
     return jsonify(data), 200
 
 @analytics_bp.route('/population/disease-trends-by-location', methods=['GET'])
 def get_disease_trends_by_location():
-    data = analytics_service.get_disease_trends_by_location()
+    data = _cached("disease_trends_by_location", analytics_service.get_disease_trends_by_location)
     return jsonify(data), 200
 
 @analytics_bp.route('/population/vitals', methods=['GET'])
 def get_vital_analytics():
-    data = analytics_service.get_vital_analytics()
+    data = _cached("vitals", analytics_service.get_vital_analytics)
     return jsonify(data), 200
 
 @analytics_bp.route('/population/medications', methods=['GET'])
 def get_medication_analytics():
-    data = analytics_service.get_medication_analytics()
+    data = _cached("medications", analytics_service.get_medication_analytics)
     return jsonify(data), 200
 
 @analytics_bp.route('/population/chronic-acute', methods=['GET'])
 def get_chronic_vs_acute():
-    data = analytics_service.get_chronic_vs_acute_analytics()
+    data = _cached("chronic_acute", analytics_service.get_chronic_vs_acute_analytics)
     return jsonify(data), 200
 
 @analytics_bp.route('/population/comorbidity', methods=['GET'])
 def get_comorbidity():
-    data = analytics_service.get_comorbidity_analytics()
+    data = _cached("comorbidity", analytics_service.get_comorbidity_analytics)
+    return jsonify(data), 200
+
+@analytics_bp.route('/population/summary', methods=['GET'])
+def get_population_summary():
+    # All of the views above from one scan of each collection
+    data = _cached("summary", analytics_service.get_population_summary)
     return jsonify(data), 200
 
 
@@ -59,12 +80,9 @@ def get_patient_risk(patient_id):
     if not patient:
         return jsonify({"error": "Patient not found"}), 404
         
-    conditions = condition_model.find_by_patient(patient_id)
-    
-    # Calculate Risk (Recalculate on fly or fetch latest)
-    # The requirement asks for "Personal risk score" visible to patient.
-    # Re-calculating ensures it's fresh.
-    risk_assessment = risk_service.calculate_risk_score(patient, conditions)
+    # Serve the materialized risk row; it is recomputed whenever the patient's
+    # Conditions, Observations or MedicationRequests change.
+    risk_assessment = risk_service.get_patient_risk(patient)
     
     return jsonify(risk_assessment), 200
 
@@ -79,5 +97,8 @@ def get_patient_similarity(patient_id):
     # If the UI specifically needs the list of similar patients (anonymized), we can expose that too.
     # Let's Expose the "Insurance Recommendation" which includes the "explanation text" derived from similarity.
     
-    recommendation = recommendation_service.get_insurance_recommendation_for_patient(patient_id)
+    mode = request.args.get('mode', 'exact')
+    if mode not in recommendation_service.SIMILARITY_MODES:
+        return jsonify({"error": f"mode must be one of {recommendation_service.SIMILARITY_MODES}"}), 400
+    recommendation = recommendation_service.get_insurance_recommendation_for_patient(patient_id, similarity_mode=mode)
     return jsonify(recommendation), 200
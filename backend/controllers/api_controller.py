@@ -1,10 +1,24 @@
-from flask import Blueprint, request, jsonify
-from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity
+from flask import Blueprint, request, jsonify, url_for, send_from_directory
+from flask_jwt_extended import create_access_token, jwt_required, get_jwt_identity, get_jwt
 import datetime
+import uuid
 from models.models import PatientModel, ConditionModel, ObservationModel, MedicationModel, UserModel, HistoryModel, ClinicalVersionModel
 from services.recommendation_service import get_all_plans, recommend_plan
-from services.risk_service import calculate_risk_score
+from services.risk_service import calculate_risk_score, get_patient_risk as get_stored_patient_risk, refresh_patient_risk_for
+from services.similarity_index import similarity_index
+from services.cohort_lsh import update_patient_signature
+from services.analytics_rollup import refresh_patient_rollup
+from services.population_snapshot import mark_population_changed
+from services.bundle_service import process_bundle
+from services.export_service import parse_export_params, start_export, cancel_export, export_manifest, job_dir
+from models.export_job_model import ExportJobModel
+from services.import_service import parse_import_manifest, save_upload, start_import, import_manifest, ERROR_FILE_NAME
+from services.import_service import job_dir as import_job_dir
+from models.import_job_model import ImportJobModel
+from utils.streaming import NDJSON_MIMETYPE
 from utils.validation import validate_fhir_resource
+from utils.patient_key import patient_key, resolve_patient_key
+from utils.unit_of_work import UnitOfWork
 from data.scripts import conditions_pool, observations_pool, medications_pool
 from utils.logger import logger
 
@@ -31,8 +45,34 @@ def format_id(doc):
     if doc:
         doc["id"] = str(doc["_id"])
         del doc["_id"]
+        doc.pop("_patientKey", None)
     return doc
 
+CLINICAL_RESOURCE_TYPES = ["Condition", "Observation", "MedicationRequest"]
+MAX_SIMILAR_K = 100
+
+def _clinical_data_changed(patient_ref):
+    """Refreshes derived per-patient data (materialized risk, similarity index, MinHash signature, analytics counters, population snapshot) after a write for that patient."""
+    if not isinstance(patient_ref, str):
+        return
+    patient_key = patient_ref[len("Patient/"):] if patient_ref.startswith("Patient/") else patient_ref
+    try:
+        refresh_patient_risk_for(patient_key)
+        similarity_index.refresh_patient(patient_key)
+        update_patient_signature(patient_key)
+        refresh_patient_rollup(patient_key)
+        mark_population_changed()
+    except Exception as e:
+        logger.error(f"Failed to refresh derived data for {patient_ref}: {str(e)}")
+
+def _fhir_now():
+    """Current UTC time as a FHIR instant ("...Z"), the form validation would produce."""
+    return datetime.datetime.now(datetime.timezone.utc).isoformat().replace("+00:00", "Z")
+
+def _subject_reference(resource):
+    subject = (resource or {}).get("subject")
+    return subject.get("reference") if isinstance(subject, dict) else None
+
 # --- Auth ---
 @api.route('/auth/login', methods=['POST'])
 def login():
@@ -79,10 +119,13 @@ def register():
     if error:
         return jsonify({"error": f"Invalid FHIR Patient Data: {error}"}), 400
 
-    patient_id = patient_model.create(validated_patient)
+    # Every write below is queued and flushed per collection at the end (in one transaction
+    # where supported); the patient's _id is allocated up front for the references
+    uow = UnitOfWork()
+    patient_id = uow.insert(patient_model.collection, patient_model.prepare(validated_patient))
     patient_id_str = str(patient_id)
-    
-    logger.info(f"Registered new patient: {username} (ID: {patient_id_str})")
+    patient_key_str = validated_patient.get("id") or patient_id_str
+
     from utils.validation import sanitize_text
 
     # 1. Conditions (Multi-select)
@@ -96,8 +139,8 @@ def register():
                 "code": {"text": clean_text},
                 "subject": {"reference": f"Patient/{patient_id_str}"}
             }
-            val_c, err = validate_fhir_resource("Condition", c_data)
-            if not err: condition_model.create(val_c)
+            val_c, err = validate_fhir_resource("Condition", c_data, canonical=True)
+            if not err: uow.insert(condition_model.collection, condition_model.prepare(val_c, patient_key_str))
 
     # 1.5 Medications (Multi-select)
     medications = data.get('medications', [])
@@ -112,9 +155,9 @@ def register():
                 "medication": {"concept": {"text": clean_text}},
                 "subject": {"reference": f"Patient/{patient_id_str}"}
             }
-            val_m, err = validate_fhir_resource("MedicationRequest", m_data)
+            val_m, err = validate_fhir_resource("MedicationRequest", m_data, canonical=True)
             if not err: 
-                medication_model.create(val_m)
+                uow.insert(medication_model.collection, medication_model.prepare(val_m, patient_key_str))
 
     # 2. Vitals (Observations)
     vitals = data.get('vitals', {})
@@ -153,10 +196,10 @@ def register():
                         "system": "http://unitsofmeasure.org",
                         "code": meta["unit"]
                     },
-                    "effectiveDateTime": datetime.datetime.now(datetime.timezone.utc).isoformat()
+                    "effectiveDateTime": _fhir_now()
                 }
-                val_o, err = validate_fhir_resource("Observation", o_data)
-                if not err: observation_model.create(val_o)
+                val_o, err = validate_fhir_resource("Observation", o_data, canonical=True)
+                if not err: uow.insert(observation_model.collection, observation_model.prepare(val_o, patient_key_str))
 
     # 2.5 Extra Observations
     extras = vitals.get('extras', [])
@@ -183,14 +226,14 @@ def register():
                     "system": "http://unitsofmeasure.org",
                     "code": obs_unit
                 },
-                "effectiveDateTime": datetime.datetime.now(datetime.timezone.utc).isoformat()
+                "effectiveDateTime": _fhir_now()
             }
-            val_o, err = validate_fhir_resource("Observation", o_data)
-            if not err: observation_model.create(val_o)
+            val_o, err = validate_fhir_resource("Observation", o_data, canonical=True)
+            if not err: uow.insert(observation_model.collection, observation_model.prepare(val_o, patient_key_str))
 
 
     # 3. Create initial clinical version (v1)
-    version_model.create(patient_id_str, conditions, vitals, 1, medications=medications)
+    uow.insert(version_model.collection, version_model.prepare(patient_id_str, conditions, vitals, 1, medications=medications))
 
     # 4. Insurance (Coverage)
     insurance_provider = sanitize_text(data.get('insuranceProvider'))
@@ -214,7 +257,7 @@ def register():
             }]
         }
         # Direct save to MongoDB (Bypassing fhir.resources which enforces R5)
-        coverage_model.create(cov_data)
+        uow.insert(coverage_model.collection, coverage_model.prepare(cov_data, patient_key_str))
 
     # Create User
     user_data = {
@@ -224,7 +267,11 @@ def register():
         "name": f"{patient_details.get('firstName')} {patient_details.get('lastName')}",
         "patientId": patient_id_str
     }
-    user_model.create(user_data)
+    uow.insert(user_model.collection, user_model.prepare(user_data))
+    uow.commit()
+    logger.info(f"Registered new patient: {username} (ID: {patient_id_str})")
+
+    _clinical_data_changed(patient_id_str)
     
     return jsonify({"message": "Registration successful", "patientId": patient_id_str}), 201
 
@@ -252,6 +299,10 @@ def handle_crud(model, resource_type):
         if error:
             return jsonify({"error": error}), 400
         inserted_id = model.create(validated_data)
+        if resource_type == "Patient":
+            _clinical_data_changed(validated_data.get("id") or str(inserted_id))
+        elif resource_type in CLINICAL_RESOURCE_TYPES:
+            _clinical_data_changed(_subject_reference(validated_data))
         return jsonify({"id": str(inserted_id)}), 201
         
     elif request.method == 'PUT':
@@ -268,11 +319,28 @@ def handle_crud(model, resource_type):
                 history_model.create(item_id, resource_type, current_item)
         
         if model.update(item_id, data):
+            updated_item = model.find_by_id(item_id)
+            if updated_item and resource_type == "Patient":
+                _clinical_data_changed(updated_item.get("id") or str(updated_item["_id"]))
+            elif updated_item and resource_type in CLINICAL_RESOURCE_TYPES:
+                _clinical_data_changed(_subject_reference(updated_item))
             return jsonify({"message": f"{resource_type} updated successfully"}), 200
         return jsonify({"error": f"{resource_type} not found or update failed"}), 404
 
 # --- Resources ---
 
+@api.route('/', methods=['POST'])
+@jwt_required()
+def bundle_resource():
+    # FHIR batch/transaction Bundle: many resources in one request, one bulk write per type
+    response_bundle, status, patient_keys, error = process_bundle(request.get_json(silent=True))
+    if error:
+        outcome, status = error
+        return jsonify(outcome), status
+    for key in patient_keys:
+        _clinical_data_changed(key)
+    return jsonify(response_bundle), status
+
 @api.route('/Patient', methods=['GET', 'POST', 'PUT'])
 @jwt_required()
 def patient_resource():
@@ -307,6 +375,118 @@ def medication_resource():
         return jsonify([format_id(i) for i in items])
     return handle_crud(medication_model, "MedicationRequest")
 
+# --- Bulk Data $export ---
+
+@api.route('/$export', methods=['GET'])
+@jwt_required()
+def export_kickoff():
+    claims = get_jwt()
+    if claims.get("role") != "admin":
+        return jsonify({"error": "Admin access required"}), 403
+
+    params, error = parse_export_params(request.args)
+    if error:
+        return jsonify({"error": error}), 400
+    job_id = start_export(request.url, params, get_jwt_identity())
+    status_url = url_for('api.export_status', job_id=str(job_id), _external=True)
+    return jsonify({"jobId": str(job_id), "status": status_url}), 202, {"Content-Location": status_url}
+
+@api.route('/$export-status/<job_id>', methods=['GET', 'DELETE'])
+@jwt_required()
+def export_status(job_id):
+    claims = get_jwt()
+    if claims.get("role") != "admin":
+        return jsonify({"error": "Admin access required"}), 403
+
+    if request.method == 'DELETE':
+        if not cancel_export(job_id):
+            return jsonify({"error": "Export job not found"}), 404
+        return jsonify({"message": "Export job cancelled"}), 202
+
+    job = ExportJobModel().find_by_id(job_id)
+    if not job or job["status"] == "cancelled":
+        return jsonify({"error": "Export job not found"}), 404
+    if job["status"] == "failed":
+        return jsonify({"error": job.get("error") or "Export failed"}), 500
+    if job["status"] != "completed":
+        done = sum(job.get("progress", {}).values())
+        return jsonify({"status": job["status"], "progress": job.get("progress", {})}), 202, {
+            "X-Progress": f"{job['status']}: {done} resources written",
+            "Retry-After": "5"
+        }
+
+    file_url = lambda jid, name: url_for('api.export_file', job_id=jid, filename=name, _external=True)
+    return jsonify(export_manifest(job, file_url))
+
+@api.route('/$export-file/<job_id>/<filename>', methods=['GET'])
+@jwt_required()
+def export_file(job_id, filename):
+    claims = get_jwt()
+    if claims.get("role") != "admin":
+        return jsonify({"error": "Admin access required"}), 403
+
+    job = ExportJobModel().find_by_id(job_id)
+    if not job or job["status"] != "completed" or filename not in [o["file"] for o in job.get("output", [])]:
+        return jsonify({"error": "Export file not found"}), 404
+    response = send_from_directory(job_dir(job["_id"]), filename, mimetype=NDJSON_MIMETYPE)
+    if filename.endswith(".gz"):
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+# --- Bulk Data $import ---
+
+@api.route('/$import', methods=['POST'])
+@jwt_required()
+def import_kickoff():
+    claims = get_jwt()
+    if claims.get("role") != "admin":
+        return jsonify({"error": "Admin access required"}), 403
+
+    if request.mimetype in (NDJSON_MIMETYPE, "application/ndjson", "application/x-ndjson"):
+        # NDJSON body: spooled to disk and imported as a single input, deleted after the job
+        inputs = [{"type": None, "name": save_upload(request.stream, uuid.uuid4().hex), "upload": True}]
+    else:
+        inputs, error = parse_import_manifest(request.get_json(silent=True))
+        if error:
+            return jsonify({"error": error}), 400
+    job_id = start_import(request.url, inputs, get_jwt_identity())
+    status_url = url_for('api.import_status', job_id=str(job_id), _external=True)
+    return jsonify({"jobId": str(job_id), "status": status_url}), 202, {"Content-Location": status_url}
+
+@api.route('/$import-status/<job_id>', methods=['GET'])
+@jwt_required()
+def import_status(job_id):
+    claims = get_jwt()
+    if claims.get("role") != "admin":
+        return jsonify({"error": "Admin access required"}), 403
+
+    job = ImportJobModel().find_by_id(job_id)
+    if not job:
+        return jsonify({"error": "Import job not found"}), 404
+    if job["status"] == "failed":
+        return jsonify({"error": job.get("error") or "Import failed"}), 500
+    if job["status"] != "completed":
+        done = sum(job.get("progress", {}).values())
+        return jsonify({"status": job["status"], "progress": job.get("progress", {})}), 202, {
+            "X-Progress": f"{job['status']}: {done} lines processed",
+            "Retry-After": "5"
+        }
+
+    error_url = lambda jid: url_for('api.import_errors', job_id=jid, _external=True)
+    return jsonify(import_manifest(job, error_url))
+
+@api.route('/$import-errors/<job_id>', methods=['GET'])
+@jwt_required()
+def import_errors(job_id):
+    claims = get_jwt()
+    if claims.get("role") != "admin":
+        return jsonify({"error": "Admin access required"}), 403
+
+    job = ImportJobModel().find_by_id(job_id)
+    if not job or job["status"] != "completed" or not job.get("errors"):
+        return jsonify({"error": "Import error file not found"}), 404
+    return send_from_directory(import_job_dir(job["_id"]), ERROR_FILE_NAME, mimetype=NDJSON_MIMETYPE)
+
 # --- History Endpoints ---
 
 @api.route('/Condition/<id>/history', methods=['GET'])
@@ -353,9 +533,13 @@ def update_clinical_data(patient_id):
     new_medications = data.get('medications', [])
     
     logger.info(f"Processing clinical update for patient {patient_id}: {len(new_conditions)} conditions, {len(new_vitals)} vitals, {len(new_medications)} meds")
-    condition_model.update_many({"subject.reference": f"Patient/{patient_id}"}, {"clinicalStatus.text": "Inactive"})
-    observation_model.update_many({"subject.reference": f"Patient/{patient_id}"}, {"status": "preliminary"}) # mark old as preliminary
-    medication_model.update_many({"subject.reference": f"Patient/{patient_id}"}, {"status": "cancelled"}) # mark old medication as cancelled
+    patient_key_str = resolve_patient_key(patient_id)
+    patient_filter = {"_patientKey": patient_key_str}
+    # Queued per collection ahead of the new resources, and flushed together at the end
+    uow = UnitOfWork()
+    uow.update_many(condition_model.collection, patient_filter, {"clinicalStatus.text": "Inactive"})
+    uow.update_many(observation_model.collection, patient_filter, {"status": "preliminary"}) # mark old as preliminary
+    uow.update_many(medication_model.collection, patient_filter, {"status": "cancelled"}) # mark old medication as cancelled
 
     from utils.validation import sanitize_text
     
@@ -369,8 +553,8 @@ def update_clinical_data(patient_id):
                 "code": {"text": clean_text},
                 "subject": {"reference": f"Patient/{patient_id}"}
             }
-            val_c, err = validate_fhir_resource("Condition", c_data)
-            if not err: condition_model.create(val_c)
+            val_c, err = validate_fhir_resource("Condition", c_data, canonical=True)
+            if not err: uow.insert(condition_model.collection, condition_model.prepare(val_c, patient_key_str))
 
     # 3. Add New Vitals
     VITAL_MAP = {
@@ -394,8 +578,8 @@ def update_clinical_data(patient_id):
                     "unit": VITAL_MAP[key]["unit"]
                 }
             }
-            val_o, err = validate_fhir_resource("Observation", o_data)
-            if not err: observation_model.create(val_o)
+            val_o, err = validate_fhir_resource("Observation", o_data, canonical=True)
+            if not err: uow.insert(observation_model.collection, observation_model.prepare(val_o, patient_key_str))
 
     # 3.5 Add New Extra Observations
     extras = new_vitals.get('extras', [])
@@ -421,10 +605,10 @@ def update_clinical_data(patient_id):
                     "system": "http://unitsofmeasure.org",
                     "code": obs_unit
                 },
-                "effectiveDateTime": datetime.datetime.now(datetime.timezone.utc).isoformat()
+                "effectiveDateTime": _fhir_now()
             }
-            val_o, err = validate_fhir_resource("Observation", o_data)
-            if not err: observation_model.create(val_o)
+            val_o, err = validate_fhir_resource("Observation", o_data, canonical=True)
+            if not err: uow.insert(observation_model.collection, observation_model.prepare(val_o, patient_key_str))
 
     # 3.8 Add New Medications
     for m_text in new_medications:
@@ -437,14 +621,17 @@ def update_clinical_data(patient_id):
                 "medication": {"concept": {"text": clean_text}},
                 "subject": {"reference": f"Patient/{patient_id}"}
             }
-            val_m, err = validate_fhir_resource("MedicationRequest", m_data)
+            val_m, err = validate_fhir_resource("MedicationRequest", m_data, canonical=True)
             if not err: 
-                medication_model.create(val_m)
+                uow.insert(medication_model.collection, medication_model.prepare(val_m, patient_key_str))
 
     # 4. Create New Clinical Version Snapshot
     latest = version_model.get_latest(patient_id)
     next_version = (latest.get("versionNum", 0) + 1) if latest else 1
-    version_model.create(patient_id, new_conditions, new_vitals, next_version, medications=new_medications)
+    uow.insert(version_model.collection, version_model.prepare(patient_id, new_conditions, new_vitals, next_version, medications=new_medications))
+    uow.commit()
+
+    _clinical_data_changed(patient_id)
 
     return jsonify({"message": f"Clinical data updated to Version {next_version}", "version": next_version}), 200
 
@@ -522,93 +709,44 @@ def get_trends():
     age_min = request.args.get('age_min')
     age_max = request.args.get('age_max')
     
-    # Base match stage
-    match_stage = {}
-    
-    # Advanced Filtering: Location AND Age
-    valid_patient_ids = []
-    
     if location or age_min or age_max:
-        # Build query for patients
+        # One server-side pipeline: patients matched on the indexed birth date range, then
+        # joined to their conditions, so the cost follows the matching patients only
+        import datetime
+        from utils.birth_date import BIRTH_DATE_FIELD, birth_date_range
+        from services.analytics_pipelines import filtered_trends
+        try:
+            age_min = int(age_min) if age_min else None
+            age_max = int(age_max) if age_max else None
+        except ValueError:
+            return jsonify({"error": "age_min and age_max must be integers"}), 400
+
         query = {}
         if location:
-             query["address.text"] = {"$regex": location, "$options": "i"}
-             
-        # Fetch matching patients to filter by ID (and check Age in Python)
-        patients = list(db.get_db().patients.find(query))
-        
-        filtered_patients = []
-        import datetime
-        now = datetime.datetime.now()
-        
-        for p in patients:
-            is_valid = True
-            bdate = p.get("birthDate")
-            
-            # Age Check
-            if (age_min or age_max) and bdate:
-                try:
-                    dob = None
-                    if isinstance(bdate, str):
-                        # Handle YYYY-MM-DD
-                        dob = datetime.datetime.strptime(bdate, "%Y-%m-%d")
-                    elif isinstance(bdate, (datetime.date, datetime.datetime)):
-                        dob = bdate
-                        # Ensure it's datetime for subtraction if it's just date
-                        if isinstance(dob, datetime.date) and not isinstance(dob, datetime.datetime):
-                             dob = datetime.datetime.combine(dob, datetime.datetime.min.time())
-                    
-                    if dob:
-                        age = (now - dob).days // 365
-                        if age_min and age < int(age_min): is_valid = False
-                        if age_max and age > int(age_max): is_valid = False
-                except Exception as e:
-                    # Log error if needed, but for now just exclude
-                    is_valid = False 
-            
-            if is_valid:
-                filtered_patients.append(p)
-                
-        # Collect IDs for the Condition Aggregation
-        valid_patient_ids = [str(p["_id"]) for p in filtered_patients] + [p.get("id") for p in filtered_patients if p.get("id")]
-        
-        # If filters are active but no patients match, return empty
-        if not valid_patient_ids:
-             return jsonify({"top_conditions": [], "patient_demographics": []})
-             
-        # Add filter to Condition aggregation
-        match_stage = {"subject.reference": {"$in": [f"Patient/{pid}" for pid in valid_patient_ids]}}
+            query["address.text"] = {"$regex": location, "$options": "i"}
+        if age_min is not None or age_max is not None:
+            query[BIRTH_DATE_FIELD] = birth_date_range(datetime.datetime.now(), age_min, age_max)
 
-    # 1. Condition Prevalence (Filtered)
-    pipeline = []
-    if match_stage:
-        pipeline.append({"$match": match_stage})
-        
-    pipeline.extend([
-        {"$group": {"_id": "$code.text", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 5}
-    ])
-    
-    top_conditions = list(db.get_db().conditions.aggregate(pipeline))
-    
-    # 2. Patients by Gender (Filtered)
-    # We already have filtered_patients list from above block if filters applied
-    # Getting gender stats from that list is easier/safer than re-querying
-    
-    if location or age_min or age_max:
-        # Use Python list aggregation
-        from collections import Counter
-        gender_counts = Counter(p.get("gender", "unknown") for p in filtered_patients)
-        gender_stats = [{"_id": k, "count": v} for k, v in gender_counts.items()]
+        top_conditions, gender_stats, total_conditions_count = filtered_trends(db.get_db(), query)
+
+        # If filters are active but no patients match, return empty
+        if not gender_stats:
+            return jsonify({"top_conditions": [], "patient_demographics": []})
     else:
-        # Full scan
+        # 1. Condition Prevalence
+        top_conditions = list(db.get_db().conditions.aggregate([
+            {"$group": {"_id": "$code.text", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}},
+            {"$limit": 5}
+        ]))
+
+        # 2. Patients by Gender
         gender_stats = list(db.get_db().patients.aggregate([
             {"$group": {"_id": "$gender", "count": {"$sum": 1}}}
         ]))
 
-    # 3. Total Conditions Count (Filtered)
-    total_conditions_count = db.get_db().conditions.count_documents(match_stage)
+        # 3. Total Conditions Count
+        total_conditions_count = db.get_db().conditions.count_documents({})
 
     return jsonify({
         "top_conditions": [{"name": i["_id"], "value": i["count"]} for i in top_conditions],
@@ -620,32 +758,32 @@ def get_trends():
 @jwt_required()
 def get_disease_trends_by_age():
     # Simplified logic (same as before but protected)
-    from config import db
+    from config import db, ANALYTICS_BACKEND
     import datetime
-    
-    conditions = list(db.get_db().conditions.find())
-    patients = {str(p["_id"]): p for p in db.get_db().patients.find()}
-    patients_by_custom_id = {p.get("id"): p for p in patients.values()}
-    
-    age_groups = {"0-18": {}, "19-35": {}, "36-60": {}, "60+": {}}
-    
-    for c in conditions:
-        subject_ref = c.get("subject", {}).get("reference", "")
-        p_id = subject_ref.replace("Patient/", "")
-        patient = patients_by_custom_id.get(p_id) or patients.get(p_id)
-        
-        if patient and "birthDate" in patient:
-            try:
-                dob = datetime.datetime.strptime(patient["birthDate"], "%Y-%m-%d")
-                age = (datetime.datetime.now() - dob).days // 365
-                group = "60+"
-                if age <= 18: group = "0-18"
-                elif age <= 35: group = "19-35"
-                elif age <= 60: group = "36-60"
-                
-                cond_name = c.get("code", {}).get("text", "Unknown")
-                age_groups[group][cond_name] = age_groups[group].get(cond_name, 0) + 1
-            except: pass
+
+    if ANALYTICS_BACKEND == "snapshot":
+        from services.population_snapshot import population_snapshot
+        age_groups = population_snapshot.get().condition_counts_by_age([18, 35, 60], ["0-18", "19-35", "36-60", "60+"])
+    else:
+        conditions = db.get_db().conditions.find({}, {"_patientKey": 1, "code.text": 1})
+        patients = {patient_key(p): p for p in db.get_db().patients.find({}, {"id": 1, "birthDate": 1})}
+        age_groups = {"0-18": {}, "19-35": {}, "36-60": {}, "60+": {}}
+
+        for c in conditions:
+            patient = patients.get(c.get("_patientKey"))
+
+            if patient and "birthDate" in patient:
+                try:
+                    dob = datetime.datetime.strptime(patient["birthDate"], "%Y-%m-%d")
+                    age = (datetime.datetime.now() - dob).days // 365
+                    group = "60+"
+                    if age <= 18: group = "0-18"
+                    elif age <= 35: group = "19-35"
+                    elif age <= 60: group = "36-60"
+
+                    cond_name = c.get("code", {}).get("text", "Unknown")
+                    age_groups[group][cond_name] = age_groups[group].get(cond_name, 0) + 1
+                except: pass
 
     result = []
     for group, counts in age_groups.items():
@@ -657,8 +795,14 @@ def get_disease_trends_by_age():
 @api.route('/Patient/<id>/similar', methods=['GET'])
 @jwt_required()
 def get_similar_patients(id):
-    from services.recommendation_service import find_similar_patients
-    cohort = find_similar_patients(id)
+    from services.recommendation_service import find_similar_patients, SIMILARITY_MODES
+    k = request.args.get('k', 5, type=int)
+    if k < 1 or k > MAX_SIMILAR_K:
+        return jsonify({"error": f"k must be an integer between 1 and {MAX_SIMILAR_K}"}), 400
+    mode = request.args.get('mode', 'exact')
+    if mode not in SIMILARITY_MODES:
+        return jsonify({"error": f"mode must be one of {SIMILARITY_MODES}"}), 400
+    cohort = find_similar_patients(id, k=k, mode=mode)
     return jsonify(cohort)
 
 @api.route('/recommendation/<patient_id>', methods=['POST'])
@@ -706,8 +850,8 @@ def get_patient_risk(id):
     if not patient:
         return jsonify({"error": "Patient not found"}), 404
         
-    conditions = condition_model.find_by_patient(id)
-    risk_assessment = calculate_risk_score(patient, conditions)
+    # Served from the materialized patient_risk row (recomputed only on clinical writes)
+    risk_assessment = get_stored_patient_risk(patient)
     
     # Extract score and label from FHIR resource for frontend display
     prediction = risk_assessment.get("prediction", [{}])[0]
@@ -737,11 +881,24 @@ def simulate_patient_risk(id):
         
     data = request.json
     weights = data.get('weights')
+    weight_sets = data.get('weight_sets')
     
-    if not weights:
+    if not weights and not weight_sets:
         return jsonify({"error": "Weights are required for simulation"}), 400
         
     conditions = condition_model.find_by_patient(id)
+
+    if weight_sets:
+        # Sweep mode: raw components are extracted once and all weight sets are scored together
+        if not isinstance(weight_sets, list) or not all(isinstance(w, dict) for w in weight_sets):
+            return jsonify({"error": "weight_sets must be a list of weight objects"}), 400
+        from services.simulation_service import simulate_patient
+        try:
+            results = simulate_patient(patient, weight_sets, conditions)
+        except (TypeError, ValueError):
+            return jsonify({"error": "Weights must be numeric"}), 400
+        return jsonify({"patientId": id, "results": results})
+
     # Simulator returns the calculation but DOES NOT save to DB (handled in risk_service)
     risk_assessment = calculate_risk_score(patient, conditions, weights=weights)
     
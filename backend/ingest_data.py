@@ -0,0 +1,54 @@
+import argparse
+import os
+from config import db
+from services.ingestion_service import ingest_files, DEFAULT_BATCH_SIZE
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FILES = [
+    os.path.join(BASE_DIR, name) for name in (
+        "usa_fresh_patients.json",
+        "usa_fresh_conditions.json",
+        "usa_fresh_observations.json",
+        "usa_fresh_medrequests.json",
+    )
+]
+DEFAULT_CHECKPOINT = os.path.join(BASE_DIR, ".ingest_checkpoint.json")
+
+def print_progress(filename, records, seconds):
+    rate = round(records / seconds) if seconds > 0 else records
+    print(f"  {filename}: {records} records ({rate} records/s)")
+
+if __name__ == "__main__":
+    # Usage: python ingest_data.py [FILE ...] [--batch-size N] [--workers N] [--restart]
+    # Loads FHIR JSON array / NDJSON files (default: the usa_fresh_* datasets). Re-running
+    # after a failure resumes from the checkpoint; --restart ignores it.
+    parser = argparse.ArgumentParser(description="Bulk-load FHIR resource files into MongoDB.")
+    parser.add_argument("files", nargs="*", default=DEFAULT_FILES)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=None, help="Files loaded in parallel (default: all)")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--restart", action="store_true", help="Ignore any existing checkpoint")
+    parser.add_argument("--skip-derived", action="store_true", help="Do not refresh derived data afterwards")
+    args = parser.parse_args()
+
+    missing = [f for f in args.files if not os.path.exists(f)]
+    if missing:
+        parser.error(f"File(s) not found: {', '.join(missing)}")
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    db.connect()
+    print(f"Ingesting {len(args.files)} file(s) in batches of {args.batch_size}...")
+    summary = ingest_files(
+        args.files, batch_size=args.batch_size, workers=args.workers, checkpoint_path=args.checkpoint,
+        progress=print_progress, refresh=not args.skip_derived
+    )
+
+    for stats in summary["files"]:
+        if stats.get("already_complete"):
+            print(f"- {stats['file']}: already loaded (checkpoint)")
+            continue
+        resumed = f", resumed after {stats['resumed_at']}" if stats["resumed_at"] else ""
+        print(f"- {stats['file']}: {stats['read']} read, {stats['written']} written, {stats['skipped']} skipped "
+              f"in {stats['seconds']}s ({stats['records_per_second']} records/s{resumed})")
+    print(f"Total: {summary['read']} records in {summary['seconds']}s ({summary['records_per_second']} records/s)")
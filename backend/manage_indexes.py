@@ -0,0 +1,25 @@
+import sys
+from config import db
+from utils.index_manager import ensure_indexes, report_indexes
+
+def print_report(report):
+    for coll_name, entry in report.items():
+        unused = entry["unused"]
+        print(f"{coll_name}:")
+        print(f"  missing:   {', '.join(entry['missing']) or '-'}")
+        print(f"  unmanaged: {', '.join(entry['unmanaged']) or '-'}")
+        print(f"  unused:    {'n/a' if unused is None else ', '.join(unused) or '-'}")
+
+if __name__ == "__main__":
+    # Usage: python manage_indexes.py [ensure|report]
+    command = sys.argv[1] if len(sys.argv) > 1 else "ensure"
+    database = db.get_db()
+    if command == "ensure":
+        created = ensure_indexes(database)
+        total = sum(len(names) for names in created.values())
+        print(f"Created {total} indexes." if total else "All indexes present.")
+    elif command == "report":
+        print_report(report_indexes(database))
+    else:
+        print("Usage: python manage_indexes.py [ensure|report]")
+        sys.exit(1)
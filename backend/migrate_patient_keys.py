@@ -0,0 +1,19 @@
+import sys
+from config import db
+from utils.patient_key import backfill_patient_keys
+from utils.birth_date import backfill_birth_dates
+from utils.search_keys import backfill_search_keys
+
+if __name__ == "__main__":
+    # Usage: python migrate_patient_keys.py [--all]
+    # Stamps _patientKey on resources, and _birthDate and _searchKeys on patients (and
+    # _searchKeys on users) that lack them; --all re-stamps every document.
+    db.connect()
+    only_missing = "--all" not in sys.argv
+    updated = backfill_patient_keys(only_missing=only_missing)
+    updated["patients (_birthDate)"] = backfill_birth_dates(only_missing=only_missing)
+    for coll_name, count in backfill_search_keys(only_missing=only_missing).items():
+        updated[f"{coll_name} (_searchKeys)"] = count
+    for coll_name, count in updated.items():
+        print(f"- {coll_name}: {count} updated")
+    print("Patient key migration complete.")
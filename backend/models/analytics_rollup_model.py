@@ -0,0 +1,94 @@
+from config import db
+from pymongo import ReturnDocument, UpdateOne, ReplaceOne
+from pymongo.errors import DuplicateKeyError
+import datetime
+
+class AnalyticsRollupModel:
+    """
+    Precomputed population analytics.
+    - analytics_rollup: one counter row per (view, key), e.g. disease x age group
+    - analytics_contributions: the rows each patient currently contributes, so a write
+      can apply only the difference
+    """
+    STATE_KEY = "analytics_rollup"
+
+    def __init__(self):
+        self.rollup = db.get_db().analytics_rollup
+        self.contributions = db.get_db().analytics_contributions
+        self.versions = db.get_db().cache_versions
+
+    # --- Incremental updates ---
+
+    def swap_contribution(self, patient_key, counters):
+        """Stores a patient's new contribution ([[row_id, count], ...]) and returns the previous one."""
+        previous = self.contributions.find_one_and_update(
+            {"_id": str(patient_key)},
+            {"$set": {"counters": counters}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+        return previous.get("counters", []) if previous else []
+
+    def apply_deltas(self, deltas, rows):
+        """$inc each changed counter; rows maps row_id -> {view, key} for counters created here."""
+        ops = [
+            UpdateOne(
+                {"_id": row_id},
+                {"$inc": {"count": delta}, "$setOnInsert": rows[row_id]},
+                upsert=True
+            )
+            for row_id, delta in deltas.items() if delta
+        ]
+        if ops:
+            self.rollup.bulk_write(ops, ordered=False)
+        return len(ops)
+
+    def find_rows(self, views):
+        return list(self.rollup.find({"view": {"$in": list(views)}, "count": {"$gt": 0}}).sort("_id", 1))
+
+    # --- Full rebuild ---
+
+    def replace_all(self, contributions, totals, rows, batch_size=1000):
+        """
+        Writes a freshly computed state, tagged with a new generation, then removes everything
+        the rebuild did not produce (rows that dropped to zero, deleted patients).
+        """
+        generation = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        ops = [
+            ReplaceOne({"_id": row_id}, {**rows[row_id], "count": count, "generation": generation}, upsert=True)
+            for row_id, count in totals.items()
+        ]
+        for i in range(0, len(ops), batch_size):
+            self.rollup.bulk_write(ops[i:i + batch_size], ordered=False)
+        self.rollup.delete_many({"generation": {"$ne": generation}})
+
+        ops = [
+            ReplaceOne({"_id": str(key)}, {"counters": counters, "generation": generation}, upsert=True)
+            for key, counters in contributions.items()
+        ]
+        for i in range(0, len(ops), batch_size):
+            self.contributions.bulk_write(ops[i:i + batch_size], ordered=False)
+        self.contributions.delete_many({"generation": {"$ne": generation}})
+
+        self.versions.update_one({"_id": self.STATE_KEY}, {"$set": {"rebuiltAt": generation}}, upsert=True)
+
+    def is_built(self):
+        doc = self.versions.find_one({"_id": self.STATE_KEY})
+        return bool(doc and doc.get("rebuiltAt"))
+
+    def claim_rebuild(self, min_interval_seconds):
+        """
+        Atomically claims the next rebuild so only one worker runs it per interval.
+        Returns False if another worker rebuilt (or started rebuilding) within the interval.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cutoff = (now - datetime.timedelta(seconds=min_interval_seconds)).isoformat()
+        try:
+            self.versions.update_one(
+                {"_id": self.STATE_KEY, "$or": [{"claimedAt": {"$lt": cutoff}}, {"claimedAt": {"$exists": False}}]},
+                {"$set": {"claimedAt": now.isoformat()}},
+                upsert=True
+            )
+            return True
+        except DuplicateKeyError:
+            return False
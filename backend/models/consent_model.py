@@ -1,5 +1,6 @@
 from config import db
 from bson.objectid import ObjectId
+from utils.patient_key import PATIENT_KEY_FIELD, resolve_patient_key, stamp_patient_key
 
 class ConsentModel:
     def __init__(self):
@@ -7,14 +8,15 @@ class ConsentModel:
 
     def create(self, data):
         data["resourceType"] = "Consent"
+        stamp_patient_key(data, "patient")
         return self.collection.insert_one(data).inserted_id
 
     def find_by_patient(self, patient_id):
         # Check active consents for data access
         return self.collection.find_one({
-            "patient.reference": f"Patient/{patient_id}",
+            PATIENT_KEY_FIELD: resolve_patient_key(patient_id),
             "status": "active"
-        })
+        }, {PATIENT_KEY_FIELD: 0})
 
     def find_all(self):
-        return list(self.collection.find())
+        return list(self.collection.find({}, {PATIENT_KEY_FIELD: 0}))
@@ -1,21 +1,33 @@
 from config import db
 from bson.objectid import ObjectId
+from utils.patient_key import PATIENT_KEY_FIELD, resolve_patient_key, stamp_patient_key
 
 class CoverageModel:
     def __init__(self):
         self.collection = db.get_db().coverage
 
-    def create(self, data):
+    def prepare(self, data, patient_key=None):
+        """The document create() stores; patient_key skips the beneficiary lookup when known."""
         data["resourceType"] = "Coverage"
+        if patient_key is not None:
+            data[PATIENT_KEY_FIELD] = patient_key
+        else:
+            stamp_patient_key(data, "beneficiary")
+        return data
+
+    def create(self, data):
+        self.prepare(data)
         return self.collection.insert_one(data).inserted_id
 
     def find_by_patient(self, patient_id):
-        return list(self.collection.find({"beneficiary.reference": f"Patient/{patient_id}"}))
+        return list(self.collection.find({PATIENT_KEY_FIELD: resolve_patient_key(patient_id)}, {PATIENT_KEY_FIELD: 0}))
 
     def find_all(self):
-        return list(self.collection.find())
+        return list(self.collection.find({}, {PATIENT_KEY_FIELD: 0}))
 
     def update(self, coverage_id, data):
+        if "beneficiary" in data:
+            stamp_patient_key(data, "beneficiary")
         return self.collection.update_one({"_id": ObjectId(coverage_id)}, {"$set": data})
 
     def delete(self, coverage_id):
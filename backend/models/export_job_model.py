@@ -0,0 +1,85 @@
+from config import db
+from bson.objectid import ObjectId
+import datetime
+
+class ExportJobModel:
+    """
+    Bulk $export jobs. Status moves queued -> in-progress -> completed | failed | cancelled;
+    `output` lists the NDJSON file written for each resource type. A running job refreshes
+    `heartbeatAt` with its progress, so one abandoned by a restart can be told apart.
+    """
+    def __init__(self):
+        self.collection = db.get_db().export_jobs
+
+    def create(self, request_url, types, since, gzip, requested_by):
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        job = {
+            "status": "queued",
+            "request": request_url,
+            "types": types,
+            "since": since,
+            "gzip": gzip,
+            "requestedBy": requested_by,
+            "createdAt": now,
+            "transactionTime": now,
+            "progress": {},
+            "output": [],
+            "error": None,
+        }
+        return self.collection.insert_one(job).inserted_id
+
+    def find_by_id(self, job_id):
+        if not ObjectId.is_valid(job_id):
+            return None
+        return self.collection.find_one({"_id": ObjectId(job_id)})
+
+    def mark_started(self, job_id):
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        return self.collection.update_one(
+            {"_id": ObjectId(job_id), "status": "queued"},
+            {"$set": {"status": "in-progress", "startedAt": now, "heartbeatAt": now}}
+        ).modified_count == 1
+
+    def set_progress(self, job_id, resource_type, count):
+        self.collection.update_one({"_id": ObjectId(job_id)}, {"$set": {
+            f"progress.{resource_type}": count,
+            "heartbeatAt": datetime.datetime.now(datetime.timezone.utc).isoformat()
+        }})
+
+    def finish(self, job_id, status, output=None, error=None):
+        """Final state; a job that was cancelled (or failed as stale) meanwhile keeps that state."""
+        self.collection.update_one(
+            {"_id": ObjectId(job_id), "status": "in-progress"},
+            {"$set": {
+                "status": status,
+                "output": output or [],
+                "error": error,
+                "completedAt": datetime.datetime.now(datetime.timezone.utc).isoformat()
+            }}
+        )
+
+    def cancel(self, job_id):
+        return self.collection.update_one(
+            {"_id": ObjectId(job_id)},
+            {"$set": {"status": "cancelled", "completedAt": datetime.datetime.now(datetime.timezone.utc).isoformat()}}
+        )
+
+    def find_queued_ids(self):
+        return [j["_id"] for j in self.collection.find({"status": "queued"}, {"_id": 1}).sort("_id", 1)]
+
+    def fail_stale(self, heartbeat_before, error):
+        """Fails in-progress jobs with no heartbeat since `heartbeat_before`. Returns their ids."""
+        stale = {"status": "in-progress", "$or": [
+            {"heartbeatAt": {"$lt": heartbeat_before}}, {"heartbeatAt": {"$exists": False}}
+        ]}
+        ids = [j["_id"] for j in self.collection.find(stale, {"_id": 1})]
+        if ids:
+            self.collection.update_many(
+                {"_id": {"$in": ids}, "status": "in-progress"},
+                {"$set": {"status": "failed", "error": error, "completedAt": datetime.datetime.now(datetime.timezone.utc).isoformat()}}
+            )
+        return ids
+
+    def is_cancelled(self, job_id):
+        job = self.collection.find_one({"_id": ObjectId(job_id)}, {"status": 1})
+        return not job or job.get("status") == "cancelled"
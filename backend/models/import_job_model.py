@@ -0,0 +1,80 @@
+from config import db
+from bson.objectid import ObjectId
+import datetime
+
+class ImportJobModel:
+    """
+    Bulk $import jobs. Status moves queued -> in-progress -> completed | failed; `output`
+    holds per-input counts and `errors` the number of lines written to the error file.
+    A running job refreshes `heartbeatAt`, so one abandoned by a restart can be told apart.
+    """
+    def __init__(self):
+        self.collection = db.get_db().import_jobs
+
+    def create(self, request_url, inputs, requested_by):
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        job = {
+            "status": "queued",
+            "request": request_url,
+            "inputs": inputs,
+            "requestedBy": requested_by,
+            "createdAt": now,
+            "transactionTime": now,
+            "progress": {},
+            "output": [],
+            "errors": 0,
+            "error": None,
+        }
+        return self.collection.insert_one(job).inserted_id
+
+    def find_by_id(self, job_id):
+        if not ObjectId.is_valid(job_id):
+            return None
+        return self.collection.find_one({"_id": ObjectId(job_id)})
+
+    def mark_started(self, job_id):
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        return self.collection.update_one(
+            {"_id": ObjectId(job_id), "status": "queued"},
+            {"$set": {"status": "in-progress", "startedAt": now, "heartbeatAt": now}}
+        ).modified_count == 1
+
+    def set_progress(self, job_id, input_name, lines):
+        self.collection.update_one({"_id": ObjectId(job_id)}, {"$set": {
+            f"progress.{input_name}": lines,
+            "heartbeatAt": datetime.datetime.now(datetime.timezone.utc).isoformat()
+        }})
+
+    def heartbeat(self, job_id):
+        self.collection.update_one(
+            {"_id": ObjectId(job_id)}, {"$set": {"heartbeatAt": datetime.datetime.now(datetime.timezone.utc).isoformat()}}
+        )
+
+    def finish(self, job_id, status, output=None, errors=0, error=None):
+        """Final state; a job failed as stale meanwhile keeps that state."""
+        self.collection.update_one(
+            {"_id": ObjectId(job_id), "status": "in-progress"},
+            {"$set": {
+                "status": status,
+                "output": output or [],
+                "errors": errors,
+                "error": error,
+                "completedAt": datetime.datetime.now(datetime.timezone.utc).isoformat()
+            }}
+        )
+
+    def find_queued_ids(self):
+        return [j["_id"] for j in self.collection.find({"status": "queued"}, {"_id": 1}).sort("_id", 1)]
+
+    def fail_stale(self, heartbeat_before, error):
+        """Fails in-progress jobs with no heartbeat since `heartbeat_before`. Returns the failed jobs."""
+        stale = {"status": "in-progress", "$or": [
+            {"heartbeatAt": {"$lt": heartbeat_before}}, {"heartbeatAt": {"$exists": False}}
+        ]}
+        jobs = list(self.collection.find(stale, {"inputs": 1}))
+        if jobs:
+            self.collection.update_many(
+                {"_id": {"$in": [j["_id"] for j in jobs]}, "status": "in-progress"},
+                {"$set": {"status": "failed", "error": error, "completedAt": datetime.datetime.now(datetime.timezone.utc).isoformat()}}
+            )
+        return jobs
@@ -2,12 +2,24 @@ from config import db
 from bson.objectid import ObjectId
 
 class InsurancePlanModel:
+    # Document in cache_versions bumped on every plan write so in-process caches can detect staleness
+    VERSION_KEY = "insurance_plans"
+
     def __init__(self):
         self.collection = db.get_db().insurance_plans
+        self.versions = db.get_db().cache_versions
+
+    def get_version(self):
+        doc = self.versions.find_one({"_id": self.VERSION_KEY})
+        return doc.get("version", 0) if doc else 0
+
+    def bump_version(self):
+        self.versions.update_one({"_id": self.VERSION_KEY}, {"$inc": {"version": 1}}, upsert=True)
 
     def create(self, data):
         data["_id"] = ObjectId()
         self.collection.insert_one(data)
+        self.bump_version()
         return data["_id"]
 
     def find_all(self):
@@ -22,6 +34,7 @@ class InsurancePlanModel:
     def update(self, plan_id, data):
         try:
             self.collection.update_one({"_id": ObjectId(plan_id)}, {"$set": data})
+            self.bump_version()
             return True
         except:
             return False
@@ -29,6 +42,7 @@ class InsurancePlanModel:
     def delete(self, plan_id):
         try:
             self.collection.delete_one({"_id": ObjectId(plan_id)})
+            self.bump_version()
             return True
         except:
             return False
@@ -1,12 +1,30 @@
 from config import db
 from bson.objectid import ObjectId
+from utils.patient_key import PATIENT_KEY_FIELD, resolve_patient_key, stamp_patient_key
+from utils.birth_date import BIRTH_DATE_FIELD, parse_birth_date, stamp_birth_date
+from utils.search_keys import (
+    SEARCH_KEYS_FIELD, patient_search_keys, user_search_keys, stamp_search_keys, prefix_query
+)
+from utils.pagination import keyset_page, count_total
+
+# Read projection hiding the internal patient key from API-facing documents
+PUBLIC_FIELDS = {PATIENT_KEY_FIELD: 0}
+# Same for the derived birth date and search keys on patients
+PATIENT_PUBLIC_FIELDS = {BIRTH_DATE_FIELD: 0, SEARCH_KEYS_FIELD: 0}
 
 class PatientModel:
     def __init__(self):
         self.collection = db.get_db().patients
 
-    def create(self, data):
+    def prepare(self, data):
+        """The document create() stores: resourceType and the derived fields stamped."""
         data["resourceType"] = "Patient"
+        stamp_birth_date(data)
+        stamp_search_keys(data, patient_search_keys)
+        return data
+
+    def create(self, data):
+        self.prepare(data)
         if "id" in data:
             # Atomic upsert to prevent duplicates under concurrency
             res = self.collection.update_one(
@@ -23,36 +41,61 @@ class PatientModel:
         return self.collection.insert_one(data).inserted_id
 
     def find_all(self):
-        return list(self.collection.find())
+        return list(self.collection.find({}, PATIENT_PUBLIC_FIELDS))
 
-    def find_paginated(self, page, limit, search=None):
-        skip = (page - 1) * limit
+    def _search_query(self, search, search_mode="contains"):
         query = {"resourceType": "Patient"}
         if search:
-            query["name.text"] = {"$regex": search, "$options": "i"}
+            if search_mode == "prefix":
+                query.update(prefix_query(search))
+            elif search_mode == "text":
+                query["$text"] = {"$search": search}
+            else:
+                query["name.text"] = {"$regex": search, "$options": "i"}
+        return query
+
+    def find_paginated(self, page, limit, search=None, search_mode="contains"):
+        skip = (page - 1) * limit
+        query = self._search_query(search, search_mode)
         
-        items = list(self.collection.find(query).skip(skip).limit(limit))
+        items = list(self.collection.find(query, PATIENT_PUBLIC_FIELDS).skip(skip).limit(limit))
         total = self.collection.count_documents(query)
         return items, total
 
+    def find_page(self, limit, after=None, search=None, search_mode="contains", total="none"):
+        """Keyset page in _id order. Returns (items, next token, total, total is an estimate)."""
+        query = self._search_query(search, search_mode)
+        items, next_token = keyset_page(self.collection, query, limit, after, PATIENT_PUBLIC_FIELDS)
+        return (items, next_token) + count_total(self.collection, query, total, filtered=bool(search))
+
     def find_by_id(self, id):
         # Try finding by ObjectId first
         try:
             if ObjectId.is_valid(id):
-                doc = self.collection.find_one({"_id": ObjectId(id), "resourceType": "Patient"})
+                doc = self.collection.find_one({"_id": ObjectId(id), "resourceType": "Patient"}, PATIENT_PUBLIC_FIELDS)
                 if doc: return doc
         except:
             pass
             
         # Fallback to custom string ID (e.g., "p001")
-        return self.collection.find_one({"id": id, "resourceType": "Patient"})
+        return self.collection.find_one({"id": id, "resourceType": "Patient"}, PATIENT_PUBLIC_FIELDS)
     
     def update(self, id, data):
+        if "name" in data:
+            data = stamp_search_keys(dict(data), patient_search_keys)
+        update = {"$set": data}
+        if "birthDate" in data:
+            # Keep the derived birth date in step
+            birth_date = parse_birth_date(data["birthDate"])
+            if birth_date:
+                update["$set"] = {**data, BIRTH_DATE_FIELD: birth_date}
+            else:
+                update["$unset"] = {BIRTH_DATE_FIELD: ""}
         try:
             # Handle both ObjectId and string ID
             if ObjectId.is_valid(id):
-                return self.collection.update_one({"_id": ObjectId(id)}, {"$set": data})
-            return self.collection.update_one({"id": id}, {"$set": data})
+                return self.collection.update_one({"_id": ObjectId(id)}, update)
+            return self.collection.update_one({"id": id}, update)
         except:
             return None
 
@@ -85,9 +128,9 @@ class ClinicalVersionModel:
     def __init__(self):
         self.collection = db.get_db().clinical_versions
 
-    def create(self, patient_id, conditions, vitals, version_num, medications=None):
+    def prepare(self, patient_id, conditions, vitals, version_num, medications=None):
         import datetime
-        snapshot = {
+        return {
             "patientId": str(patient_id),
             "conditions": conditions,
             "vitals": vitals,
@@ -95,6 +138,9 @@ class ClinicalVersionModel:
             "versionNum": version_num,
             "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()
         }
+
+    def create(self, patient_id, conditions, vitals, version_num, medications=None):
+        snapshot = self.prepare(patient_id, conditions, vitals, version_num, medications)
         return self.collection.insert_one(snapshot).inserted_id
 
     def get_latest(self, patient_id):
@@ -107,51 +153,54 @@ class ConditionModel:
     def __init__(self):
         self.collection = db.get_db().conditions
 
+    def prepare(self, data, patient_key=None):
+        """
+        The document create() stores: resourceType and _patientKey stamped. A caller that
+        already knows the canonical patient key passes it to skip the lookup.
+        """
+        data["resourceType"] = "Condition"
+        if patient_key is not None:
+            data[PATIENT_KEY_FIELD] = patient_key
+        else:
+            stamp_patient_key(data)
+        return data
+
     def create(self, data):
         if "id" in data:
             existing = self.collection.find_one({"id": data["id"], "resourceType": "Condition"})
             if existing:
                 return existing["_id"]
-        data["resourceType"] = "Condition"
+        self.prepare(data)
         return self.collection.insert_one(data).inserted_id
 
     def find_by_patient(self, patient_id, status=None):
-        # Support both 'Patient/ID' and 'ID' formats
-        patient_refs = [
-            f"Patient/{patient_id}",
-            str(patient_id),
-            patient_id.replace("Patient/", "") if isinstance(patient_id, str) and patient_id.startswith("Patient/") else patient_id
-        ]
-        
-        query = {"subject.reference": {"$in": patient_refs}}
+        # _patientKey is canonical whichever reference spelling the resource used
+        query = {PATIENT_KEY_FIELD: resolve_patient_key(patient_id)}
         
         if status:
             status_regex = {"$regex": f"^{status}$", "$options": "i"}
             # Condition specific status fields
-            query = {
-                "$and": [
-                    {"subject.reference": {"$in": patient_refs}},
-                    {"$or": [
-                        {"clinicalStatus.text": status_regex},
-                        {"clinicalStatus.coding.code": status_regex}
-                    ]}
-                ]
-            }
-        return list(self.collection.find(query))
+            query["$or"] = [
+                {"clinicalStatus.text": status_regex},
+                {"clinicalStatus.coding.code": status_regex}
+            ]
+        return list(self.collection.find(query, PUBLIC_FIELDS))
 
     def find_all(self):
-        return list(self.collection.find())
+        return list(self.collection.find({}, PUBLIC_FIELDS))
 
     def find_by_id(self, id):
         try:
             if ObjectId.is_valid(id):
-                return self.collection.find_one({"_id": ObjectId(id)})
-            return self.collection.find_one({"id": id})
+                return self.collection.find_one({"_id": ObjectId(id)}, PUBLIC_FIELDS)
+            return self.collection.find_one({"id": id}, PUBLIC_FIELDS)
         except:
             return None
 
     def update(self, id, data):
         try:
+            if "subject" in data:
+                stamp_patient_key(data)
             if ObjectId.is_valid(id):
                 return self.collection.update_one({"_id": ObjectId(id)}, {"$set": data})
             return self.collection.update_one({"id": id}, {"$set": data})
@@ -173,46 +222,49 @@ class ObservationModel:
     def __init__(self):
         self.collection = db.get_db().observations
 
+    def prepare(self, data, patient_key=None):
+        """
+        The document create() stores: resourceType and _patientKey stamped. A caller that
+        already knows the canonical patient key passes it to skip the lookup.
+        """
+        data["resourceType"] = "Observation"
+        if patient_key is not None:
+            data[PATIENT_KEY_FIELD] = patient_key
+        else:
+            stamp_patient_key(data)
+        return data
+
     def create(self, data):
         if "id" in data:
             existing = self.collection.find_one({"id": data["id"], "resourceType": "Observation"})
             if existing:
                 return existing["_id"]
-        data["resourceType"] = "Observation"
+        self.prepare(data)
         return self.collection.insert_one(data).inserted_id
 
     def find_by_patient(self, patient_id, status=None):
-         # Support both 'Patient/ID' and 'ID' formats
-        patient_refs = [
-            f"Patient/{patient_id}",
-            str(patient_id),
-            patient_id.replace("Patient/", "") if isinstance(patient_id, str) and patient_id.startswith("Patient/") else patient_id
-        ]
-        
-        query = {"subject.reference": {"$in": patient_refs}}
+        # _patientKey is canonical whichever reference spelling the resource used
+        query = {PATIENT_KEY_FIELD: resolve_patient_key(patient_id)}
         
         if status:
-            query = {
-                "$and": [
-                    {"subject.reference": {"$in": patient_refs}},
-                    {"status": {"$regex": f"^{status}$", "$options": "i"}}
-                ]
-            }
-        return list(self.collection.find(query))
+            query["status"] = {"$regex": f"^{status}$", "$options": "i"}
+        return list(self.collection.find(query, PUBLIC_FIELDS))
 
     def find_all(self):
-        return list(self.collection.find())
+        return list(self.collection.find({}, PUBLIC_FIELDS))
 
     def find_by_id(self, id):
         try:
             if ObjectId.is_valid(id):
-                return self.collection.find_one({"_id": ObjectId(id)})
-            return self.collection.find_one({"id": id})
+                return self.collection.find_one({"_id": ObjectId(id)}, PUBLIC_FIELDS)
+            return self.collection.find_one({"id": id}, PUBLIC_FIELDS)
         except:
             return None
 
     def update(self, id, data):
         try:
+            if "subject" in data:
+                stamp_patient_key(data)
             if ObjectId.is_valid(id):
                 return self.collection.update_one({"_id": ObjectId(id)}, {"$set": data})
             return self.collection.update_one({"id": id}, {"$set": data})
@@ -226,46 +278,49 @@ class MedicationModel:
     def __init__(self):
         self.collection = db.get_db().medications
 
+    def prepare(self, data, patient_key=None):
+        """
+        The document create() stores: resourceType and _patientKey stamped. A caller that
+        already knows the canonical patient key passes it to skip the lookup.
+        """
+        data["resourceType"] = "MedicationRequest"
+        if patient_key is not None:
+            data[PATIENT_KEY_FIELD] = patient_key
+        else:
+            stamp_patient_key(data)
+        return data
+
     def create(self, data):
         if "id" in data:
             existing = self.collection.find_one({"id": data["id"], "resourceType": "MedicationRequest"})
             if existing:
                 return existing["_id"]
-        data["resourceType"] = "MedicationRequest"
+        self.prepare(data)
         return self.collection.insert_one(data).inserted_id
 
     def find_by_patient(self, patient_id, status=None):
-        # Support both 'Patient/ID' and 'ID' formats
-        patient_refs = [
-            f"Patient/{patient_id}",
-            str(patient_id),
-            patient_id.replace("Patient/", "") if isinstance(patient_id, str) and patient_id.startswith("Patient/") else patient_id
-        ]
-        
-        query = {"subject.reference": {"$in": patient_refs}}
+        # _patientKey is canonical whichever reference spelling the resource used
+        query = {PATIENT_KEY_FIELD: resolve_patient_key(patient_id)}
         
         if status:
-            query = {
-                "$and": [
-                    {"subject.reference": {"$in": patient_refs}},
-                    {"status": {"$regex": f"^{status}$", "$options": "i"}}
-                ]
-            }
-        return list(self.collection.find(query))
+            query["status"] = {"$regex": f"^{status}$", "$options": "i"}
+        return list(self.collection.find(query, PUBLIC_FIELDS))
 
     def find_all(self):
-        return list(self.collection.find())
+        return list(self.collection.find({}, PUBLIC_FIELDS))
 
     def find_by_id(self, id):
         try:
             if ObjectId.is_valid(id):
-                return self.collection.find_one({"_id": ObjectId(id)})
-            return self.collection.find_one({"id": id})
+                return self.collection.find_one({"_id": ObjectId(id)}, PUBLIC_FIELDS)
+            return self.collection.find_one({"id": id}, PUBLIC_FIELDS)
         except:
             return None
 
     def update(self, id, data):
         try:
+            if "subject" in data:
+                stamp_patient_key(data)
             if ObjectId.is_valid(id):
                 return self.collection.update_one({"_id": ObjectId(id)}, {"$set": data})
             return self.collection.update_one({"id": id}, {"$set": data})
@@ -279,25 +334,42 @@ class UserModel:
     def __init__(self):
         self.collection = db.get_db().users
 
+    def prepare(self, data):
+        return stamp_search_keys(data, user_search_keys)
+
     def create(self, data):
+        self.prepare(data)
         return self.collection.insert_one(data).inserted_id
 
     def find_all(self):
         return list(self.collection.find())
 
-    def find_paginated(self, page, limit, search=None):
+    def _search_query(self, search, search_mode="contains"):
+        if not search:
+            return {}
+        if search_mode == "prefix":
+            return prefix_query(search)
+        if search_mode == "text":
+            return {"$text": {"$search": search}}
+        return {"$or": [
+            {"username": {"$regex": search, "$options": "i"}},
+            {"name": {"$regex": search, "$options": "i"}}
+        ]}
+
+    def find_paginated(self, page, limit, search=None, search_mode="contains"):
         skip = (page - 1) * limit
-        query = {}
-        if search:
-            query["$or"] = [
-                {"username": {"$regex": search, "$options": "i"}},
-                {"name": {"$regex": search, "$options": "i"}}
-            ]
+        query = self._search_query(search, search_mode)
         
         items = list(self.collection.find(query).skip(skip).limit(limit))
         total = self.collection.count_documents(query)
         return items, total
 
+    def find_page(self, limit, after=None, search=None, search_mode="contains", total="none"):
+        """Keyset page in _id order. Returns (items, next token, total, total is an estimate)."""
+        query = self._search_query(search, search_mode)
+        items, next_token = keyset_page(self.collection, query, limit, after)
+        return (items, next_token) + count_total(self.collection, query, total, filtered=bool(search))
+
     def find_by_username(self, username):
         return self.collection.find_one({"username": username})
 
@@ -0,0 +1,74 @@
+from config import db
+from pymongo import UpdateOne
+import datetime
+
+class PatientRiskModel:
+    """Materialized current risk score, one row per patient (keyed by FHIR id or MongoDB _id)."""
+    def __init__(self):
+        self.collection = db.get_db().patient_risk
+
+    def upsert(self, patient_key, score, label, assessment=None):
+        row = {
+            "patientKey": str(patient_key),
+            "score": score,
+            "label": label,
+            "assessment": assessment,
+            "updatedAt": datetime.datetime.now(datetime.timezone.utc).isoformat()
+        }
+        self.collection.update_one({"patientKey": str(patient_key)}, {"$set": row}, upsert=True)
+        return row
+
+    def insert_missing(self, rows):
+        """Bulk-inserts rows for patients that do not have one yet; existing rows are left untouched."""
+        if not rows:
+            return 0
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        ops = [
+            UpdateOne(
+                {"patientKey": r["patientKey"]},
+                {"$setOnInsert": {**r, "assessment": None, "updatedAt": now}},
+                upsert=True
+            )
+            for r in rows
+        ]
+        return self.collection.bulk_write(ops, ordered=False).upserted_count
+
+    def replace_all(self, rows, batch_size=1000):
+        """
+        Overwrites the rows for the given patients (the stored assessment is cleared and
+        recomputed on its next read) and deletes every row not written here.
+        Returns (rows written, rows deleted).
+        """
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        written = 0
+        for i in range(0, len(rows), batch_size):
+            ops = [
+                UpdateOne(
+                    {"patientKey": r["patientKey"]},
+                    {"$set": {**r, "assessment": None, "updatedAt": now}},
+                    upsert=True
+                )
+                for r in rows[i:i + batch_size]
+            ]
+            result = self.collection.bulk_write(ops, ordered=False)
+            written += result.upserted_count + result.matched_count
+        # Rows refreshed by a clinical write since `now` carry a later timestamp and are kept
+        deleted = self.collection.delete_many({"updatedAt": {"$not": {"$gte": now}}}).deleted_count
+        return written, deleted
+
+    def find_by_patient(self, patient_key):
+        return self.collection.find_one({"patientKey": str(patient_key)})
+
+    def find_keys(self):
+        return {r["patientKey"] for r in self.collection.find({}, {"patientKey": 1})}
+
+    def count(self):
+        return self.collection.count_documents({})
+
+    def get_label_counts(self):
+        return {r["_id"]: r["count"] for r in self.collection.aggregate([
+            {"$group": {"_id": "$label", "count": {"$sum": 1}}}
+        ])}
+
+    def delete_by_patient(self, patient_key):
+        return self.collection.delete_one({"patientKey": str(patient_key)})
@@ -0,0 +1,47 @@
+from config import db
+import heapq
+from pymongo import UpdateOne, ASCENDING, DESCENDING
+
+class PatientSignatureModel:
+    """MinHash signature, LSH band keys and birth ordinal of each patient (keyed by FHIR id, else MongoDB _id)."""
+    def __init__(self):
+        self.collection = db.get_db().patient_signatures
+
+    def upsert(self, patient_id, data):
+        data["patientId"] = str(patient_id)
+        return self.collection.update_one({"patientId": str(patient_id)}, {"$set": data}, upsert=True)
+
+    def bulk_upsert(self, rows):
+        if not rows:
+            return 0
+        ops = [UpdateOne({"patientId": r["patientId"]}, {"$set": r}, upsert=True) for r in rows]
+        result = self.collection.bulk_write(ops, ordered=False)
+        return result.upserted_count + result.modified_count
+
+    def find_candidates(self, bands, gender, exclude_id, limit):
+        """Patients of the same gender that share at least one LSH band with the query."""
+        return list(self.collection.find(
+            {"bands": {"$in": bands}, "gender": gender, "patientId": {"$ne": str(exclude_id)}},
+            {"patientId": 1, "birthDate": 1, "conditions": 1}
+        ).limit(limit))
+
+    def find_in_birth_window(self, gender, lo_ordinal, hi_ordinal, center, exclude_id, limit):
+        """
+        Up to `limit` patients of the same gender born between two day ordinals, closest to
+        `center` first: two indexed range scans walking away from it, merged by distance.
+        """
+        base = {"gender": gender, "patientId": {"$ne": str(exclude_id)}}
+        projection = {"patientId": 1, "birthDate": 1, "conditions": 1, "birthOrdinal": 1}
+        older = list(self.collection.find(
+            {**base, "birthOrdinal": {"$gte": lo_ordinal, "$lt": center}}, projection
+        ).sort("birthOrdinal", DESCENDING).limit(limit))
+        younger = list(self.collection.find(
+            {**base, "birthOrdinal": {"$gte": center, "$lte": hi_ordinal}}, projection
+        ).sort("birthOrdinal", ASCENDING).limit(limit))
+        return heapq.nsmallest(limit, older + younger, key=lambda r: abs(r["birthOrdinal"] - center))
+
+    def find_patient_ids(self):
+        return {r["patientId"] for r in self.collection.find({}, {"patientId": 1})}
+
+    def delete_by_patient(self, patient_id):
+        return self.collection.delete_one({"patientId": str(patient_id)})
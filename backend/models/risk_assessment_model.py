@@ -1,5 +1,6 @@
 from config import db
 from bson.objectid import ObjectId
+from utils.patient_key import PATIENT_KEY_FIELD, resolve_patient_key, stamp_patient_key
 
 class RiskAssessmentModel:
     def __init__(self):
@@ -7,14 +8,16 @@ class RiskAssessmentModel:
 
     def create(self, data):
         data["resourceType"] = "RiskAssessment"
+        stamp_patient_key(data)
         return self.collection.insert_one(data).inserted_id
 
     def find_latest_by_patient(self, patient_id):
         # Sort by date (assuming we store 'occurrenceDateTime' or created timestamp)
         return self.collection.find_one(
-            {"subject.reference": f"Patient/{patient_id}"},
+            {PATIENT_KEY_FIELD: resolve_patient_key(patient_id)},
+            {PATIENT_KEY_FIELD: 0},
             sort=[("_id", -1)]
         )
 
     def find_all(self):
-        return list(self.collection.find())
+        return list(self.collection.find({}, {PATIENT_KEY_FIELD: 0}))
@@ -0,0 +1,8 @@
+from config import db
+from services.analytics_rollup import rebuild_rollups
+
+if __name__ == "__main__":
+    # Recomputes the analytics_rollup counters from scratch (same as the periodic reconciler)
+    db.connect()
+    rows = rebuild_rollups()
+    print(f"Analytics rollup rebuilt: {rows} rows.")
@@ -61,6 +61,23 @@ def seed_data():
 
 if __name__ == "__main__":
     seed_data()
+    # Stamp the canonical patient key the models query by
+    from utils.patient_key import backfill_patient_keys
+    backfill_patient_keys()
+    from utils.birth_date import backfill_birth_dates
+    backfill_birth_dates()
+    from utils.search_keys import backfill_search_keys
+    backfill_search_keys()
+    from config import ANALYTICS_BACKEND
+    if ANALYTICS_BACKEND == "rollup":
+        from services.analytics_rollup import rebuild_rollups
+        rebuild_rollups()
+    from services.population_snapshot import mark_population_changed
+    mark_population_changed()
+    from services.risk_service import rebuild_patient_risk
+    rebuild_patient_risk()
+    from services.cohort_lsh import rebuild_signatures
+    rebuild_signatures()
     print("\nData ingestion complete.")
     
     # Final count summary
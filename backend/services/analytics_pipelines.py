@@ -0,0 +1,236 @@
+import re
+import time
+from datetime import datetime
+from utils.classification import (
+    CHRONIC_INDICATORS, BLOOD_PRESSURE_KEYWORDS, GLUCOSE_KEYWORDS, VITAL_THRESHOLDS
+)
+from utils.logger import logger
+
+# MongoDB execution backend for AnalyticsService (ANALYTICS_BACKEND=mongo). Every view is one
+# aggregation pipeline: clinical records are joined to their patient on _patientKey, ages are
+# bucketed with $dateDiff and keyword classification runs as $regexMatch, so only the grouped
+# rows come back. Requires MongoDB 5.0+ ($dateDiff, $lookup with localField and pipeline).
+
+def _keyword_regex(keywords):
+    # Same matching as KeywordMatcher: case-insensitive substring of any keyword
+    return "|".join(re.escape(k.lower()) for k in sorted(set(keywords), key=len, reverse=True))
+
+def _matches(field, keywords):
+    return {"$regexMatch": {"input": {"$ifNull": [field, ""]}, "regex": _keyword_regex(keywords), "options": "i"}}
+
+def _non_empty_string(expr):
+    return {"$and": [{"$eq": [{"$type": expr}, "string"]}, {"$ne": [expr, ""]}]}
+
+def _age_group(birth_date, now):
+    """$switch equivalent of AnalyticsService._get_age_group(_calculate_age(birthDate))."""
+    dob = {"$cond": [
+        {"$eq": [{"$type": birth_date}, "string"]},
+        {"$dateFromString": {"dateString": birth_date, "format": "%Y-%m-%d", "onError": None, "onNull": None}},
+        None
+    ]}
+    # Whole days between midnight of the birth date and `now`, as (now - dob).days in Python
+    age = {"$let": {
+        "vars": {"dob": dob},
+        "in": {"$cond": [
+            {"$eq": ["$$dob", None]},
+            None,
+            {"$floor": {"$divide": [{"$dateDiff": {"startDate": "$$dob", "endDate": now, "unit": "day"}}, 365]}}
+        ]}
+    }}
+    return {"$let": {"vars": {"age": age}, "in": {"$switch": {
+        "branches": [
+            {"case": {"$eq": ["$$age", None]}, "then": "Unknown"},
+            {"case": {"$lte": ["$$age", 18]}, "then": "0-18"},
+            {"case": {"$lte": ["$$age", 30]}, "then": "19-30"},
+            {"case": {"$lte": ["$$age", 45]}, "then": "31-45"},
+            {"case": {"$lte": ["$$age", 60]}, "then": "46-60"},
+        ],
+        "default": ">60"
+    }}}}
+
+def _join_patient(now):
+    """
+    Stages attaching `patient` (and `ageGroup`) to each record by _patientKey, dropping records
+    whose patient does not exist. The key is either a FHIR id or the _id of a patient without one.
+    """
+    patient_fields = {"_id": 0, "birthDate": 1, "address": 1}
+    return [
+        {"$match": {"_patientKey": {"$type": "string"}}},
+        {"$lookup": {
+            "from": "patients", "localField": "_patientKey", "foreignField": "id",
+            "pipeline": [{"$project": patient_fields}], "as": "_byId"
+        }},
+        {"$addFields": {"_patientOid": {"$convert": {"input": "$_patientKey", "to": "objectId", "onError": None}}}},
+        {"$lookup": {
+            "from": "patients", "localField": "_patientOid", "foreignField": "_id",
+            "pipeline": [{"$match": {"id": {"$in": [None, ""]}}}, {"$project": patient_fields}], "as": "_byOid"
+        }},
+        {"$addFields": {"patient": {"$first": {"$concatArrays": ["$_byId", "$_byOid"]}}}},
+        {"$match": {"patient": {"$ne": None}}},
+        {"$addFields": {"ageGroup": _age_group("$patient.birthDate", now)}},
+    ]
+
+def _group_rows(key_fields):
+    """Group by the given {output name: expression} and keep first-seen order like the Python backend."""
+    return [
+        {"$group": {"_id": key_fields, "count": {"$sum": 1}, "first": {"$min": "$_id"}}},
+        {"$sort": {"first": 1}},
+    ]
+
+# _get_medication_name as an expression
+_MEDICATION_NAME = {"$let": {
+    "vars": {
+        "coding": {"$cond": [
+            {"$isArray": "$medicationCodeableConcept.coding"},
+            {"$arrayElemAt": ["$medicationCodeableConcept.coding", 0]},
+            None
+        ]}
+    },
+    "in": {"$switch": {
+        "branches": [
+            {"case": _non_empty_string("$medicationCodeableConcept.text"), "then": "$medicationCodeableConcept.text"},
+            {"case": _non_empty_string("$code.text"), "then": "$code.text"},
+            {"case": _non_empty_string("$$coding.display"), "then": "$$coding.display"},
+            {"case": _non_empty_string("$medicationReference.display"), "then": "$medicationReference.display"},
+        ],
+        "default": "Unknown Med"
+    }}
+}}
+
+class MongoAnalyticsBackend:
+    """Runs AnalyticsService views as aggregation pipelines; same view names and output shapes."""
+    def __init__(self, database):
+        self.db = database
+
+    def run(self, views):
+        start_time = time.time()
+        now = datetime.now()
+        results = {name: getattr(self, name)(now) for name in views}
+        logger.info(f"Analytics pipelines ({', '.join(views)}) in {round(time.time() - start_time, 3)}s")
+        return results
+
+    def _aggregate(self, collection, pipeline):
+        return list(self.db[collection].aggregate(pipeline, allowDiskUse=True))
+
+    def disease_distribution(self, now):
+        rows = self._aggregate("conditions", _group_rows({"disease": {"$ifNull": ["$code.text", "Unknown Condition"]}}))
+        return [{"disease": r["_id"]["disease"], "count": r["count"]} for r in rows]
+
+    def disease_trends_by_age(self, now):
+        rows = self._aggregate("conditions", _join_patient(now) + _group_rows({
+            "disease": {"$ifNull": ["$code.text", "Unknown"]}, "age_group": "$ageGroup"
+        }))
+        return [{"disease": r["_id"]["disease"], "age_group": r["_id"]["age_group"], "count": r["count"]} for r in rows]
+
+    def disease_trends_by_location(self, now):
+        city = {"$let": {
+            "vars": {"address": {"$arrayElemAt": [{"$ifNull": ["$patient.address", []]}, 0]}},
+            "in": {"$ifNull": ["$$address.city", "Unknown"]}
+        }}
+        rows = self._aggregate("conditions", _join_patient(now) + _group_rows({
+            "disease": {"$ifNull": ["$code.text", "Unknown"]}, "location": city
+        }))
+        return [{"disease": r["_id"]["disease"], "location": r["_id"]["location"], "count": r["count"]} for r in rows]
+
+    def vitals(self, now):
+        value = "$valueQuantity.value"
+        vital_type = {"$switch": {
+            "branches": [
+                {"case": _matches("$code.text", BLOOD_PRESSURE_KEYWORDS), "then": "High BP"},
+                {"case": _matches("$code.text", GLUCOSE_KEYWORDS), "then": "High Sugar"},
+            ],
+            "default": None
+        }}
+        pipeline = [
+            {"$match": {"valueQuantity.value": {"$type": "number"}}},
+            {"$addFields": {"vitalType": vital_type}},
+            {"$match": {"$expr": {"$or": [
+                {"$and": [{"$eq": ["$vitalType", vital]}, {"$gt": [value, threshold]}]}
+                for vital, threshold in VITAL_THRESHOLDS.items()
+            ]}}},
+        ] + _join_patient(now) + _group_rows({"vital": "$vitalType", "age_group": "$ageGroup"})
+        rows = self._aggregate("observations", pipeline)
+        return [{"vital": r["_id"]["vital"], "age_group": r["_id"]["age_group"], "count": r["count"]} for r in rows]
+
+    def medications(self, now):
+        pipeline = _join_patient(now) + [
+            {"$addFields": {"medName": _MEDICATION_NAME}},
+            {"$lookup": {
+                "from": "conditions", "localField": "_patientKey", "foreignField": "_patientKey",
+                "pipeline": [{"$project": {"_id": 0, "name": {"$ifNull": ["$code.text", "Unknown"]}}}],
+                "as": "_conditions"
+            }},
+            {"$addFields": {"conditionNames": {"$let": {
+                "vars": {"names": {"$setUnion": ["$_conditions.name", []]}},
+                "in": {"$cond": [{"$gt": [{"$size": "$$names"}, 0]}, "$$names", ["Unknown / Prophylactic"]]}
+            }}}},
+            {"$facet": {
+                "by_age": _group_rows({"medication": "$medName", "age_group": "$ageGroup"}),
+                "by_disease": [{"$unwind": "$conditionNames"}] + _group_rows({
+                    "medication": "$medName", "disease": "$conditionNames"
+                }),
+                "unique_usage": [
+                    {"$group": {"_id": "$medName", "patients": {"$addToSet": "$_patientKey"}, "first": {"$min": "$_id"}}},
+                    {"$sort": {"first": 1}},
+                ],
+            }},
+        ]
+        facets = self._aggregate("medications", pipeline)[0]
+        return {
+            "by_age": [{"medication": r["_id"]["medication"], "age_group": r["_id"]["age_group"], "count": r["count"]} for r in facets["by_age"]],
+            "by_disease": [{"medication": r["_id"]["medication"], "disease": r["_id"]["disease"], "count": r["count"]} for r in facets["by_disease"]],
+            "unique_usage": [{"medication": r["_id"], "count": len(r["patients"])} for r in facets["unique_usage"]]
+        }
+
+    def chronic_acute(self, now):
+        c_type = {"$cond": [_matches("$code.text", CHRONIC_INDICATORS), "Chronic", "Acute"]}
+        rows = self._aggregate("conditions", _join_patient(now) + _group_rows({"type": c_type, "age_group": "$ageGroup"}))
+        return [{"type": r["_id"]["type"], "age_group": r["_id"]["age_group"], "count": r["count"]} for r in rows]
+
+    def comorbidity(self, now):
+        pipeline = [
+            {"$match": {"_patientKey": {"$type": "string"}}},
+            {"$group": {"_id": "$_patientKey", "conditionCount": {"$sum": 1}, "first": {"$min": "$_id"}}},
+            {"$project": {"_patientKey": "$_id", "conditionCount": 1, "first": 1}},
+            {"$addFields": {"_id": "$first"}},
+        ] + _join_patient(now) + _group_rows({
+            "category": {"$cond": [{"$gt": ["$conditionCount", 1]}, "Multi-condition", "Single-condition"]},
+            "age_group": "$ageGroup"
+        })
+        rows = self._aggregate("conditions", pipeline)
+        return [{"category": r["_id"]["category"], "age_group": r["_id"]["age_group"], "count": r["count"]} for r in rows]
+
+# --- /stats/trends with location / age filters ---
+
+# patient_key() as an expression: the FHIR id, else the _id as a string
+_PATIENT_KEY = {"$cond": [{"$in": [{"$ifNull": ["$id", ""]}, [""]]}, {"$toString": "$_id"}, "$id"]}
+
+def filtered_trends(database, patient_match, top=5):
+    """
+    Top conditions, gender counts and total conditions for the patients matching `patient_match`,
+    as one pipeline on patients: the match runs on indexed fields (_birthDate), and each matching
+    patient is joined to its conditions through the _patientKey index. Nothing proportional to
+    the whole population is sent to the application.
+    Returns (top_conditions, demographics, total_conditions) with rows as {"_id", "count"}.
+    """
+    pipeline = [
+        {"$match": patient_match},
+        {"$project": {"_id": 0, "gender": {"$ifNull": ["$gender", "unknown"]}, "key": _PATIENT_KEY}},
+        {"$facet": {
+            "demographics": [{"$group": {"_id": "$gender", "count": {"$sum": 1}}}],
+            "conditions": [
+                {"$lookup": {
+                    "from": "conditions", "localField": "key", "foreignField": "_patientKey",
+                    "pipeline": [{"$project": {"_id": 0, "text": "$code.text"}}], "as": "conditions"
+                }},
+                {"$unwind": "$conditions"},
+                {"$group": {"_id": "$conditions.text", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1}},
+                {"$group": {"_id": None, "rows": {"$push": {"_id": "$_id", "count": "$count"}}, "total": {"$sum": "$count"}}},
+                {"$project": {"_id": 0, "rows": {"$slice": ["$rows", top]}, "total": 1}},
+            ],
+        }},
+    ]
+    result = list(database.patients.aggregate(pipeline, allowDiskUse=True))[0]
+    conditions = result["conditions"][0] if result["conditions"] else {"rows": [], "total": 0}
+    return conditions["rows"], result["demographics"], conditions["total"]
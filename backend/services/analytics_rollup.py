@@ -0,0 +1,175 @@
+import json
+import os
+import threading
+import time
+from models.analytics_rollup_model import AnalyticsRollupModel
+from config import ANALYTICS_BACKEND
+from models.models import PatientModel, ConditionModel, ObservationModel, MedicationModel
+from services.analytics_service import (
+    POPULATION_VIEWS, PATIENT_FIELDS, CONDITION_FIELDS, OBSERVATION_FIELDS, MEDICATION_FIELDS, _ScanContext
+)
+from utils.patient_key import patient_key as _patient_key, resolve_patient_key
+from utils.logger import logger
+
+# Seconds between full rebuilds; also corrects age-group drift, which no write triggers
+RECONCILE_INTERVAL = int(os.getenv("ANALYTICS_ROLLUP_RECONCILE_SECONDS", "3600"))
+
+# Records without a patient reference only count towards disease_distribution; they are
+# tracked under this key and only refreshed by a rebuild.
+UNLINKED_KEY = "__unlinked__"
+
+def _row_id(view, key):
+    return f"{view}|{json.dumps(key, sort_keys=True, default=str)}"
+
+def _result_rows(view, result):
+    """Flattens a view result into (view, key fields, count); medications has three sub-views."""
+    if isinstance(result, dict):
+        for sub, items in result.items():
+            yield from _result_rows(f"{view}.{sub}", items)
+        return
+    for item in result:
+        yield view, {k: v for k, v in item.items() if k != "count"}, item["count"]
+
+def compute_contribution(service, key, patient, conditions, observations, medications):
+    """
+    The counters one patient contributes to every view, computed by the same aggregators as
+    the population scan restricted to that patient's records.
+    Returns ({row_id: count}, {row_id: {view, key}}).
+    """
+    ctx = _ScanContext(service, {key: patient} if patient else {})
+    aggregators = [cls(ctx) for cls in POPULATION_VIEWS.values()]
+    for records, stream, handler in (
+        (conditions, "conditions", "condition"),
+        (observations, "observations", "observation"),
+        (medications, "medications", "medication"),
+    ):
+        consumers = [getattr(a, handler) for a in aggregators if stream in a.streams]
+        for record in records:
+            for consume in consumers:
+                consume(record)
+
+    counters, rows = {}, {}
+    for name, aggregator in zip(POPULATION_VIEWS, aggregators):
+        for view, row_key, count in _result_rows(name, aggregator.result()):
+            row_id = _row_id(view, row_key)
+            counters[row_id] = counters.get(row_id, 0) + count
+            rows[row_id] = {"view": view, "key": row_key}
+    return counters, rows
+
+def _service():
+    from services.analytics_service import AnalyticsService
+    return AnalyticsService()
+
+# --- Write path ---
+
+def refresh_patient_rollup(patient_ref, service=None):
+    """
+    Recomputes one patient's contribution after a write and $incs the difference into the
+    rollup. No-op unless the rollup backend is enabled and has been built once.
+    """
+    if ANALYTICS_BACKEND != "rollup":
+        return 0
+    model = AnalyticsRollupModel()
+    if not model.is_built():
+        return 0
+    key = resolve_patient_key(patient_ref)
+    if not key:
+        return 0
+    patient = PatientModel().find_by_id(key)
+    if patient and _patient_key(patient) != key:
+        patient = None
+    conditions = ConditionModel().collection.find({"_patientKey": key}, CONDITION_FIELDS)
+    observations = ObservationModel().collection.find({"_patientKey": key}, OBSERVATION_FIELDS)
+    medications = MedicationModel().collection.find({"_patientKey": key}, MEDICATION_FIELDS)
+    counters, rows = compute_contribution(service or _service(), key, patient, conditions, observations, medications)
+
+    # Swap first, then apply new - previous: concurrent writers for the same patient still net out
+    previous = dict(model.swap_contribution(key, [[row_id, n] for row_id, n in counters.items()]))
+    deltas = {row_id: n - previous.get(row_id, 0) for row_id, n in counters.items()}
+    for row_id, n in previous.items():
+        if row_id not in counters:
+            deltas[row_id] = -n
+            rows[row_id] = _row_meta(row_id)
+    return model.apply_deltas(deltas, rows)
+
+def _row_meta(row_id):
+    view, key = row_id.split("|", 1)
+    return {"view": view, "key": json.loads(key)}
+
+# --- Rebuild / Reconcile ---
+
+def rebuild_rollups(service=None):
+    """Recomputes every contribution and counter from scratch in one pass over each collection."""
+    start_time = time.time()
+    service = service or _service()
+    patients = {_patient_key(p): p for p in PatientModel().collection.find({}, PATIENT_FIELDS)}
+
+    records = {}  # key -> (conditions, observations, medications)
+    for index, (model, fields) in enumerate((
+        (ConditionModel(), CONDITION_FIELDS),
+        (ObservationModel(), OBSERVATION_FIELDS),
+        (MedicationModel(), MEDICATION_FIELDS),
+    )):
+        for record in model.collection.find({}, fields):
+            key = record.get("_patientKey") or UNLINKED_KEY
+            records.setdefault(key, ([], [], []))[index].append(record)
+
+    contributions, totals, rows = {}, {}, {}
+    for key in set(patients) | set(records):
+        conditions, observations, medications = records.get(key, ([], [], []))
+        counters, key_rows = compute_contribution(
+            service, key, patients.get(key), conditions, observations, medications
+        )
+        if not counters: continue
+        contributions[key] = [[row_id, n] for row_id, n in counters.items()]
+        rows.update(key_rows)
+        for row_id, n in counters.items():
+            totals[row_id] = totals.get(row_id, 0) + n
+
+    AnalyticsRollupModel().replace_all(contributions, totals, rows)
+    logger.info(f"Analytics rollup rebuilt: {len(totals)} rows from {len(contributions)} patients in {round(time.time() - start_time, 3)}s")
+    return len(totals)
+
+def reconcile_once(service=None):
+    """Rebuilds if no other worker has done so within RECONCILE_INTERVAL."""
+    if AnalyticsRollupModel().claim_rebuild(RECONCILE_INTERVAL):
+        return rebuild_rollups(service)
+    return None
+
+def start_reconciler(interval=RECONCILE_INTERVAL):
+    """Background thread running reconcile_once every interval (the first run is immediate)."""
+    def loop():
+        while True:
+            try:
+                reconcile_once()
+            except Exception as e:
+                logger.error(f"Analytics rollup reconcile failed: {str(e)}")
+            time.sleep(interval)
+    thread = threading.Thread(target=loop, name="analytics-rollup-reconciler", daemon=True)
+    thread.start()
+    return thread
+
+# --- Read path ---
+
+class RollupAnalyticsBackend:
+    """Serves AnalyticsService views from the precomputed counters (ANALYTICS_BACKEND=rollup)."""
+    def __init__(self, service):
+        self.service = service
+
+    def run(self, views):
+        model = AnalyticsRollupModel()
+        if not model.is_built():
+            rebuild_rollups(self.service)
+        wanted = []
+        for name in views:
+            wanted.extend([f"{name}.by_age", f"{name}.by_disease", f"{name}.unique_usage"] if name == "medications" else [name])
+
+        results = {name: ({"by_age": [], "by_disease": [], "unique_usage": []} if name == "medications" else []) for name in views}
+        for row in model.find_rows(wanted):
+            item = {**row["key"], "count": row["count"]}
+            view, _, sub = row["view"].partition(".")
+            if sub:
+                results[view][sub].append(item)
+            else:
+                results[view].append(item)
+        return results
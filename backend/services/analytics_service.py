@@ -1,15 +1,227 @@
+from config import ANALYTICS_BACKEND, db
 from models.models import PatientModel, ConditionModel, ObservationModel, MedicationModel
 from datetime import datetime
 from utils.logger import logger
+from utils.classification import classify_vital, is_chronic_condition, VITAL_THRESHOLDS
+from utils.patient_key import patient_key
 import time
 
+# Fields each stream needs; everything else is left on the server
+PATIENT_FIELDS = {"id": 1, "birthDate": 1, "address": 1}
+CONDITION_FIELDS = {"_patientKey": 1, "code.text": 1}
+OBSERVATION_FIELDS = {"_patientKey": 1, "code.text": 1, "valueQuantity.value": 1}
+MEDICATION_FIELDS = {
+    "_patientKey": 1, "medicationCodeableConcept": 1, "code.text": 1, "medicationReference.display": 1
+}
+
+class _Aggregator:
+    """
+    One population view. The engine feeds it every record of the streams it declares
+    (conditions before observations before medications) and then asks for the result.
+    """
+    streams = ()
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    def condition(self, c): pass
+    def observation(self, o): pass
+    def medication(self, m): pass
+
+class _ScanContext:
+    """State shared by the aggregators of one scan: patients by key and their memoized age groups."""
+    def __init__(self, service, patients):
+        self.service = service
+        self.patients = patients
+        self._age_groups = {}
+
+    def age_group(self, key):
+        group = self._age_groups.get(key)
+        if group is None:
+            patient = self.patients[key]
+            group = self.service._get_age_group(self.service._calculate_age(patient.get("birthDate")))
+            self._age_groups[key] = group
+        return group
+
+class DiseaseDistribution(_Aggregator):
+    streams = ("conditions",)
+
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        self.distribution = {}
+
+    def condition(self, c):
+        code_text = c.get("code", {}).get("text", "Unknown Condition")
+        self.distribution[code_text] = self.distribution.get(code_text, 0) + 1
+
+    def result(self):
+        return [{"disease": k, "count": v} for k, v in self.distribution.items()]
+
+class DiseaseTrendsByAge(_Aggregator):
+    streams = ("conditions",)
+
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        self.data = {} # (Disease, AgeGroup) -> Count
+
+    def condition(self, c):
+        key = c.get("_patientKey")
+        if key not in self.ctx.patients: return
+        k = (c.get("code", {}).get("text", "Unknown"), self.ctx.age_group(key))
+        self.data[k] = self.data.get(k, 0) + 1
+
+    def result(self):
+        return [{"disease": d, "age_group": a, "count": c} for (d, a), c in self.data.items()]
+
+class DiseaseTrendsByLocation(_Aggregator):
+    streams = ("conditions",)
+
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        self.data = {} # (Disease, City) -> Count
+
+    def condition(self, c):
+        patient = self.ctx.patients.get(c.get("_patientKey"))
+        if not patient: return
+        # Assuming address is a list and we take the first one's city
+        city = "Unknown"
+        if "address" in patient and len(patient["address"]) > 0:
+            city = patient["address"][0].get("city", "Unknown")
+        k = (c.get("code", {}).get("text", "Unknown"), city)
+        self.data[k] = self.data.get(k, 0) + 1
+
+    def result(self):
+        return [{"disease": d, "location": l, "count": c} for (d, l), c in self.data.items()]
+
+class VitalAnalytics(_Aggregator):
+    streams = ("observations",)
+
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        self.abnormal_counts = {} # (VitalType, AgeGroup) -> Count
+
+    def observation(self, o):
+        value = o.get("valueQuantity", {}).get("value")
+        if value is None: return
+        # Memoized keyword classification of the code text
+        vital_type = classify_vital(o.get("code", {}).get("text", ""))
+        if vital_type is None or not value > VITAL_THRESHOLDS[vital_type]: return
+        key = o.get("_patientKey")
+        if key not in self.ctx.patients: return
+        k = (vital_type, self.ctx.age_group(key))
+        self.abnormal_counts[k] = self.abnormal_counts.get(k, 0) + 1
+
+    def result(self):
+        return [{"vital": v, "age_group": a, "count": c} for (v, a), c in self.abnormal_counts.items()]
+
+class MedicationAnalytics(_Aggregator):
+    streams = ("conditions", "medications")
+
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        self.conditions_map = {} # PatientID -> List of Condition Names
+        self.med_vs_age = {} # (Medication, AgeGroup) -> Count
+        self.med_vs_disease = {} # (Medication, Disease) -> Count
+        self.usage_counts = {} # Medication -> Set of PatientIDs (for unique usage)
+
+    def condition(self, c):
+        pid = c.get("_patientKey")
+        if not pid: return
+        c_name = c.get("code", {}).get("text", "Unknown")
+        names = self.conditions_map.setdefault(pid, [])
+        if c_name not in names:
+            names.append(c_name)
+
+    def medication(self, m):
+        pid = m.get("_patientKey")
+        if not pid or pid not in self.ctx.patients: return
+        med_name = self.ctx.service._get_medication_name(m)
+
+        # Age Group Analysis
+        k1 = (med_name, self.ctx.age_group(pid))
+        self.med_vs_age[k1] = self.med_vs_age.get(k1, 0) + 1
+
+        # Unique usage (Total Patients per Medication)
+        self.usage_counts.setdefault(med_name, set()).add(pid)
+
+        # Disease Analysis (associating med with all patient conditions as proxy)
+        for cond in self.conditions_map.get(pid, ["Unknown / Prophylactic"]):
+            k2 = (med_name, cond)
+            self.med_vs_disease[k2] = self.med_vs_disease.get(k2, 0) + 1
+
+    def result(self):
+        return {
+            "by_age": [{"medication": m, "age_group": a, "count": c} for (m, a), c in self.med_vs_age.items()],
+            "by_disease": [{"medication": m, "disease": d, "count": c} for (m, d), c in self.med_vs_disease.items()],
+            "unique_usage": [{"medication": m, "count": len(pids)} for m, pids in self.usage_counts.items()]
+        }
+
+class ChronicVsAcute(_Aggregator):
+    streams = ("conditions",)
+
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        self.data = {} # (Type, AgeGroup) -> Count
+
+    def condition(self, c):
+        key = c.get("_patientKey")
+        if key not in self.ctx.patients: return
+        # Default to Acute, check if it matches Chronic indicators (one memo lookup per distinct text)
+        c_type = "Chronic" if is_chronic_condition(c.get("code", {}).get("text", "")) else "Acute"
+        k = (c_type, self.ctx.age_group(key))
+        self.data[k] = self.data.get(k, 0) + 1
+
+    def result(self):
+        return [{"type": t, "age_group": a, "count": c} for (t, a), c in self.data.items()]
+
+class Comorbidity(_Aggregator):
+    streams = ("conditions",)
+
+    def __init__(self, ctx):
+        super().__init__(ctx)
+        self.patient_counts = {} # Pid -> Count
+
+    def condition(self, c):
+        pid = c.get("_patientKey")
+        self.patient_counts[pid] = self.patient_counts.get(pid, 0) + 1
+
+    def result(self):
+        results = {} # (Category, AgeGroup) -> Count
+        for pid, count in self.patient_counts.items():
+            if pid not in self.ctx.patients: continue
+            category = "Multi-condition" if count > 1 else "Single-condition"
+            k = (category, self.ctx.age_group(pid))
+            results[k] = results.get(k, 0) + 1
+        return [{"category": cat, "age_group": ag, "count": c} for (cat, ag), c in results.items()]
+
+# View name -> aggregator, in the order the summary endpoint returns them
+POPULATION_VIEWS = {
+    "disease_distribution": DiseaseDistribution,
+    "disease_trends_by_age": DiseaseTrendsByAge,
+    "disease_trends_by_location": DiseaseTrendsByLocation,
+    "vitals": VitalAnalytics,
+    "medications": MedicationAnalytics,
+    "chronic_acute": ChronicVsAcute,
+    "comorbidity": Comorbidity,
+}
+
 class AnalyticsService:
     def __init__(self):
         self.patient_model = PatientModel()
         self.condition_model = ConditionModel()
         self.observation_model = ObservationModel()
         self.medication_model = MedicationModel()
-        logger.info("AnalyticsService initialized")
+        self.backend = None
+        if ANALYTICS_BACKEND == "mongo":
+            from services.analytics_pipelines import MongoAnalyticsBackend
+            self.backend = MongoAnalyticsBackend(db.get_db())
+        elif ANALYTICS_BACKEND == "rollup":
+            from services.analytics_rollup import RollupAnalyticsBackend
+            self.backend = RollupAnalyticsBackend(self)
+        elif ANALYTICS_BACKEND == "snapshot":
+            from services.population_snapshot import SnapshotAnalyticsBackend
+            self.backend = SnapshotAnalyticsBackend(self)
+        logger.info(f"AnalyticsService initialized ({ANALYTICS_BACKEND} backend)")
 
     def _calculate_age(self, dob_str):
         if not dob_str:
@@ -28,28 +240,49 @@ class AnalyticsService:
         if age <= 60: return "46-60"
         return ">60"
 
+    def _scan(self, views):
+        """
+        Streams patients and then only the clinical collections the requested views need,
+        feeding every record to every interested aggregator. Returns {view name: result}.
+        """
+        if self.backend is not None:
+            return self.backend.run(views)
+        start_time = time.time()
+        patients = {patient_key(p): p for p in self.patient_model.collection.find({}, PATIENT_FIELDS)}
+        ctx = _ScanContext(self, patients)
+        aggregators = {name: POPULATION_VIEWS[name](ctx) for name in views}
+
+        streams = [
+            ("conditions", self.condition_model, CONDITION_FIELDS, "condition"),
+            ("observations", self.observation_model, OBSERVATION_FIELDS, "observation"),
+            ("medications", self.medication_model, MEDICATION_FIELDS, "medication"),
+        ]
+        counts = {}
+        for stream, model, fields, handler in streams:
+            consumers = [getattr(a, handler) for a in aggregators.values() if stream in a.streams]
+            if not consumers: continue
+            n = 0
+            for record in model.collection.find({}, fields):
+                n += 1
+                for consume in consumers:
+                    consume(record)
+            counts[stream] = n
+
+        results = {name: a.result() for name, a in aggregators.items()}
+        logger.info(f"Analytics scan ({', '.join(views)}) over {len(patients)} patients, {counts} in {round(time.time() - start_time, 3)}s")
+        return results
+
+    def get_population_summary(self):
+        """Every population view from a single pass over each collection (dashboard load)."""
+        return self._scan(list(POPULATION_VIEWS))
+
     def get_disease_distribution(self):
         """
         1) Disease Distribution Analytics (Population Level)
         - Group all condition records by disease name
         - Count number of patients per disease
         """
-        start_time = time.time()
-        conditions = self.condition_model.find_all()
-        distribution = {}
-        logger.info(f"Disease Distribution: Processing {len(conditions)} records.")
-        
-        for condition in conditions:
-            # Check for active status if available, optionally. 
-            # Requirement says "Group all condition records", but usually active is implied.
-            # We'll include all for now or filter by active if clear. Let's stick to simple grouping.
-            
-            code_text = condition.get("code", {}).get("text", "Unknown Condition")
-            distribution[code_text] = distribution.get(code_text, 0) + 1
-            
-        res = [{"disease": k, "count": v} for k, v in distribution.items()]
-        logger.info(f"Disease Distribution complete in {round(time.time() - start_time, 3)}s")
-        return res
+        return self._scan(["disease_distribution"])["disease_distribution"]
 
     def get_disease_trends_by_age(self):
         """
@@ -58,42 +291,7 @@ class AnalyticsService:
         - Map patient age to conditions
         - Group by disease + age group
         """
-        start_time = time.time()
-        conditions = self.condition_model.find_all()
-        # Cache patients to avoid N+1 DB calls if possible, or fetch as needed.
-        # For this scale, finding by ID is okay, or fetching all patients once.
-        patients = {}
-        for p in self.patient_model.find_all():
-            patients[str(p["_id"])] = p
-            if "id" in p:
-                patients[p["id"]] = p
-        
-        data = {} # (Disease, AgeGroup) -> Count
-        
-        for condition in conditions:
-            subject_ref = condition.get("subject", {}).get("reference", "")
-            patient_id = subject_ref.split("/")[-1] if "/" in subject_ref else subject_ref
-            
-            patient = patients.get(patient_id)
-            if not patient: continue
-            
-            age = self._calculate_age(patient.get("birthDate"))
-            age_group = self._get_age_group(age)
-            disease = condition.get("code", {}).get("text", "Unknown")
-            
-            key = (disease, age_group)
-            data[key] = data.get(key, 0) + 1
-            
-        # Format output
-        result = []
-        for (disease, age_group), count in data.items():
-            result.append({
-                "disease": disease,
-                "age_group": age_group,
-                "count": count
-            })
-        logger.info(f"Disease Trends by Age complete in {round(time.time() - start_time, 3)}s")
-        return result
+        return self._scan(["disease_trends_by_age"])["disease_trends_by_age"]
 
     def get_disease_trends_by_location(self):
         """
@@ -102,35 +300,7 @@ class AnalyticsService:
         - Map diseases to patient city
         - Group by disease + location
         """
-        start_time = time.time()
-        conditions = self.condition_model.find_all()
-        patients = {}
-        for p in self.patient_model.find_all():
-            patients[str(p["_id"])] = p
-            if "id" in p:
-                patients[p["id"]] = p
-        
-        data = {} # (Disease, City) -> Count
-        
-        for condition in conditions:
-            subject_ref = condition.get("subject", {}).get("reference", "")
-            patient_id = subject_ref.split("/")[-1]
-            
-            patient = patients.get(patient_id)
-            if not patient: continue
-            
-            # Assuming address is a list and we take the first one's city
-            city = "Unknown"
-            if "address" in patient and len(patient["address"]) > 0:
-                city = patient["address"][0].get("city", "Unknown")
-            
-            disease = condition.get("code", {}).get("text", "Unknown")
-            key = (disease, city)
-            data[key] = data.get(key, 0) + 1
-        
-        res = [{"disease": d, "location": l, "count": c} for (d, l), c in data.items()]
-        logger.info(f"Disease Trends by Location complete in {round(time.time() - start_time, 3)}s")
-        return res
+        return self._scan(["disease_trends_by_location"])["disease_trends_by_location"]
 
     def get_vital_analytics(self):
         """
@@ -145,44 +315,7 @@ class AnalyticsService:
         We will attribute the abnormal vital to ALL active diseases the patient has, or just Count by Age Group if disease is ambiguous.
         Let's do: Count of Abnormal Vitals by Age Group.
         """
-        observations = self.observation_model.find_all()
-        patients = {}
-        for p in self.patient_model.find_all():
-            patients[str(p["_id"])] = p
-            if "id" in p:
-                patients[p["id"]] = p
-        
-        abnormal_counts = {} # (VitalType, AgeGroup) -> Count
-        
-        for obs in observations:
-            code_text = obs.get("code", {}).get("text", "").lower()
-            value = obs.get("valueQuantity", {}).get("value")
-            if value is None: continue
-            
-            is_abnormal = False
-            vital_type = "Unknown"
-            
-            # Simple substring matching for types
-            if "blood pressure" in code_text or "systolic" in code_text:
-                vital_type = "High BP"
-                if value > 140: is_abnormal = True
-            elif "glucose" in code_text or "sugar" in code_text:
-                vital_type = "High Sugar"
-                if value > 180: is_abnormal = True
-                
-            if is_abnormal:
-                subject_ref = obs.get("subject", {}).get("reference", "")
-                patient_id = subject_ref.split("/")[-1]
-                patient = patients.get(patient_id)
-                if not patient: continue
-                
-                age = self._calculate_age(patient.get("birthDate"))
-                age_group = self._get_age_group(age)
-                
-                key = (vital_type, age_group)
-                abnormal_counts[key] = abnormal_counts.get(key, 0) + 1
-                
-        return [{"vital": v, "age_group": a, "count": c} for (v, a), c in abnormal_counts.items()]
+        return self._scan(["vitals"])["vitals"]
 
     def _get_medication_name(self, med):
         """Robustly extract medication name from various possible FHIR fields."""
@@ -211,101 +344,14 @@ class AnalyticsService:
         5) Medication Analytics
         - Analyze: Medication vs disease, Medication vs age group, and unique usage
         """
-        medications = self.medication_model.find_all()
-        patients = {}
-        for p in self.patient_model.find_all():
-            patients[str(p["_id"])] = p
-            if "id" in p:
-                patients[p["id"]] = p
-
-        conditions_map = {} # PatientID -> List of Condition Names
-        all_conditions = self.condition_model.find_all()
-        
-        for c in all_conditions:
-            subject_ref = c.get("subject", {}).get("reference", "")
-            if not subject_ref: continue
-            pid = subject_ref.split("/")[-1]
-            c_name = c.get("code", {}).get("text", "Unknown")
-            if pid not in conditions_map: conditions_map[pid] = []
-            if c_name not in conditions_map[pid]:
-                conditions_map[pid].append(c_name)
-            
-        med_vs_age = {} # (Medication, AgeGroup) -> Count
-        med_vs_disease = {} # (Medication, Disease) -> Count
-        usage_counts = {} # Medication -> Set of PatientIDs (for unique usage)
-        
-        for med in medications:
-            med_name = self._get_medication_name(med)
-            subject_ref = med.get("subject", {}).get("reference", "")
-            if not subject_ref: continue
-            pid = subject_ref.split("/")[-1]
-            
-            patient = patients.get(pid)
-            if not patient: continue
-            
-            # Age Group Analysis
-            age = self._calculate_age(patient.get("birthDate"))
-            age_group = self._get_age_group(age)
-            k1 = (med_name, age_group)
-            med_vs_age[k1] = med_vs_age.get(k1, 0) + 1
-            
-            # Unique usage (Total Patients per Medication)
-            if med_name not in usage_counts: usage_counts[med_name] = set()
-            usage_counts[med_name].add(pid)
-            
-            # Disease Analysis (associating med with all patient conditions as proxy)
-            p_conditions = conditions_map.get(pid, ["Unknown / Prophylactic"])
-            for cond in p_conditions:
-                k2 = (med_name, cond)
-                med_vs_disease[k2] = med_vs_disease.get(k2, 0) + 1
-                
-        return {
-            "by_age": [{"medication": m, "age_group": a, "count": c} for (m, a), c in med_vs_age.items()],
-            "by_disease": [{"medication": m, "disease": d, "count": c} for (m, d), c in med_vs_disease.items()],
-            "unique_usage": [{"medication": m, "count": len(pids)} for m, pids in usage_counts.items()]
-        }
+        return self._scan(["medications"])["medications"]
 
     def get_chronic_vs_acute_analytics(self):
         """
         8) Chronic vs Acute
         Strictly binary classification: everything is either Chronic or Acute.
         """
-        CHRONIC_INDICATORS = [
-            "diabetes", "hypertension", "heart", "asthma", "arthritis", 
-            "chronic", "alzheimer", "parkinson", "bipolar", "schizophrenia", 
-            "ptsd", "obesity", "thyroid", "osteoporosis", "copd", "gerd",
-            "glaucoma", "hiv", "tuberculosis", "hepatitis", "anemia"
-        ]
-        
-        conditions = self.condition_model.find_all()
-        logger.info(f"Chronic vs Acute: Classifying {len(conditions)} conditions.")
-        patients = {}
-        for p in self.patient_model.find_all():
-            patients[str(p["_id"])] = p
-            if "id" in p:
-                patients[p["id"]] = p
-        
-        data = {} # (Type, AgeGroup) -> Count
-        
-        for c in conditions:
-            name = c.get("code", {}).get("text", "").lower()
-            # Default to Acute, check if it matches Chronic indicators
-            c_type = "Acute"
-            if any(indicator in name for indicator in CHRONIC_INDICATORS):
-                c_type = "Chronic"
-                
-            subject_ref = c.get("subject", {}).get("reference", "")
-            pid = subject_ref.split("/")[-1]
-            patient = patients.get(pid)
-            if not patient: continue
-            
-            age = self._calculate_age(patient.get("birthDate"))
-            age_group = self._get_age_group(age)
-            
-            key = (c_type, age_group)
-            data[key] = data.get(key, 0) + 1
-            
-        return [{"type": t, "age_group": a, "count": c} for (t, a), c in data.items()]
+        return self._scan(["chronic_acute"])["chronic_acute"]
     
     def get_comorbidity_analytics(self):
         """
@@ -313,32 +359,4 @@ class AnalyticsService:
         - Count number of active conditions per patient
         - Classify: Single-condition, Multi-condition
         """
-        conditions = self.condition_model.find_all()
-        patients = {}
-        for p in self.patient_model.find_all():
-            patients[str(p["_id"])] = p
-            if "id" in p:
-                patients[p["id"]] = p
-        
-        patient_counts = {} # Pid -> Count
-        for c in conditions:
-            subject_ref = c.get("subject", {}).get("reference", "")
-            pid = subject_ref.split("/")[-1]
-            patient_counts[pid] = patient_counts.get(pid, 0) + 1
-            
-        results = {} # (Category, AgeGroup) -> Count
-        
-        for pid, count in patient_counts.items():
-            category = "Multi-condition" if count > 1 else "Single-condition"
-            
-            patient = patients.get(pid)
-            if not patient: continue
-            age = self._calculate_age(patient.get("birthDate"))
-            age_group = self._get_age_group(age)
-            
-            key = (category, age_group)
-            results[key] = results.get(key, 0) + 1
-            
-        res = [{"category": cat, "age_group": ag, "count": c} for (cat, ag), c in results.items()]
-        logger.info(f"Comorbidity Analytics complete.")
-        return res
+        return self._scan(["comorbidity"])["comorbidity"]
@@ -0,0 +1,388 @@
+import datetime
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from config import db
+from utils.validation import validate_fhir_resource
+from utils.patient_key import PATIENT_KEY_FIELD, PATIENT_REFERENCE_FIELDS, patient_key, reference_key
+from utils.birth_date import BIRTH_DATE_FIELD, parse_birth_date, stamp_birth_date
+from utils.search_keys import stamp_search_keys, patient_search_keys
+from utils.unit_of_work import transactions_supported
+from utils.logger import logger
+
+# FHIR batch/transaction Bundles (POST /api/). Every entry is validated and its urn:uuid
+# references resolved before anything is written; the writes for each resource type then go
+# out as a single unordered bulk_write, and the response Bundle carries a status per entry.
+# A transaction is all-or-nothing at the request level: if any entry is invalid, refers to
+# an unknown urn:uuid or targets a missing resource, nothing is written. On a replica set its
+# writes also run in one multi-document transaction, so a failed write rolls back the rest.
+
+BUNDLE_COLLECTIONS = {
+    "Patient": "patients",
+    "Condition": "conditions",
+    "Observation": "observations",
+    "MedicationRequest": "medications",
+}
+# Updates archive the previous version, as PUT /api/Condition and /api/Medication do
+HISTORY_RESOURCE_TYPES = ("Condition", "MedicationRequest")
+MAX_BUNDLE_ENTRIES = 1000
+
+URN_PREFIX = "urn:uuid:"
+
+_STATUS_TEXT = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 409: "Conflict", 500: "Internal Server Error"}
+
+def _outcome(message, code="processing"):
+    return {
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": "error", "code": code, "diagnostics": message}],
+    }
+
+def _status(code):
+    return f"{code} {_STATUS_TEXT[code]}"
+
+class _Entry:
+    """Working state of one bundle entry."""
+    def __init__(self, index, raw):
+        self.index = index
+        self.raw = raw if isinstance(raw, dict) else {}
+        self.resource = self.raw.get("resource")
+        self.full_url = self.raw.get("fullUrl")
+        self.method = None
+        self.resource_type = None
+        self.target_id = None   # PUT: the id from Type/id
+        self.object_id = None   # POST: _id allocated up front so references can point at it
+        self.current = None     # PUT: the stored document being updated
+        self.depends_on = []    # Entries this one refers to by urn:uuid
+        self.document = None
+        self.status = None
+        self.outcome = None
+        self.location = None
+
+    def fail(self, code, message, issue="processing"):
+        if self.status is None:
+            self.status, self.outcome = code, _outcome(message, issue)
+
+    @property
+    def failed(self):
+        return self.status is not None and self.status >= 400
+
+    @property
+    def reference(self):
+        """How other resources refer to this entry once written."""
+        if self.method == "PUT":
+            return f"{self.resource_type}/{self.target_id}"
+        return f"{self.resource_type}/{self.resource.get('id') or self.object_id}"
+
+def _parse_entry(entry):
+    """Fills method, type and target of an entry; records a 400 if the request is malformed."""
+    request = entry.raw.get("request") or {}
+    method = str(request.get("method", "")).upper()
+    url = str(request.get("url", "")).strip("/")
+    if not isinstance(entry.resource, dict):
+        return entry.fail(400, "Entry has no resource", "required")
+    resource_type = entry.resource.get("resourceType")
+    if resource_type not in BUNDLE_COLLECTIONS:
+        return entry.fail(400, f"Unsupported resourceType: {resource_type}", "not-supported")
+    if method not in ("POST", "PUT"):
+        return entry.fail(400, f"Unsupported request method: {method or 'none'}", "not-supported")
+
+    parts = url.split("/") if url else []
+    if not parts or parts[0] != resource_type:
+        return entry.fail(400, f"request.url must start with {resource_type}", "invalid")
+    if method == "POST" and len(parts) != 1:
+        return entry.fail(400, "POST request.url must be the resource type", "invalid")
+    if method == "PUT":
+        if len(parts) != 2 or not parts[1]:
+            return entry.fail(400, "PUT request.url must be Type/id", "invalid")
+        entry.target_id = parts[1]
+        if entry.resource.get("id") not in (None, entry.target_id):
+            return entry.fail(400, "Resource id does not match request.url", "invalid")
+
+    entry.method, entry.resource_type = method, resource_type
+    if method == "POST":
+        entry.object_id = ObjectId()
+
+def _replace_references(value, targets, used, missing):
+    """
+    Copy of value with urn:uuid references rewritten to Type/id. Entries referred to are
+    added to used, unresolved urns to missing.
+    """
+    if isinstance(value, dict):
+        out = {}
+        for k, v in value.items():
+            if k == "reference" and isinstance(v, str) and v.startswith(URN_PREFIX):
+                if v in targets:
+                    used.append(targets[v])
+                    out[k] = targets[v].reference
+                else:
+                    missing.add(v)
+                    out[k] = v
+            else:
+                out[k] = _replace_references(v, targets, used, missing)
+        return out
+    if isinstance(value, list):
+        return [_replace_references(v, targets, used, missing) for v in value]
+    return value
+
+def _resolve_patient_keys(database, entries):
+    """
+    Stamps _patientKey on the clinical documents. ObjectId-shaped references to patients
+    created in this bundle are known already; any others are looked up in one query.
+    """
+    known = {}
+    for entry in entries:
+        if entry.resource_type == "Patient" and entry.method == "POST":
+            known[str(entry.object_id)] = entry.resource.get("id") or str(entry.object_id)
+
+    pending = []
+    for entry in entries:
+        field = PATIENT_REFERENCE_FIELDS.get(BUNDLE_COLLECTIONS[entry.resource_type])
+        holder = entry.document.get(field) if field else None
+        key = reference_key(holder.get("reference")) if isinstance(holder, dict) else None
+        if not key:
+            continue
+        if ObjectId.is_valid(key) and key not in known:
+            pending.append((entry, key))
+        else:
+            entry.document[PATIENT_KEY_FIELD] = known.get(key, key)
+
+    if pending:
+        ids = list({ObjectId(key) for _, key in pending})
+        for p in database.patients.find({"_id": {"$in": ids}, "resourceType": "Patient"}, {"id": 1}):
+            known[str(p["_id"])] = patient_key(p)
+        for entry, key in pending:
+            entry.document[PATIENT_KEY_FIELD] = known.get(key, key)
+
+def _find_update_targets(database, entries):
+    """Current documents for the PUT entries, one query per collection. Missing targets get a 404."""
+    by_collection = {}
+    for entry in entries:
+        if entry.method == "PUT":
+            by_collection.setdefault(BUNDLE_COLLECTIONS[entry.resource_type], []).append(entry)
+
+    for collection_name, group in by_collection.items():
+        object_ids = [ObjectId(e.target_id) for e in group if ObjectId.is_valid(e.target_id)]
+        ids = [e.target_id for e in group if not ObjectId.is_valid(e.target_id)]
+        clauses = ([{"_id": {"$in": object_ids}}] if object_ids else []) + ([{"id": {"$in": ids}}] if ids else [])
+        found = {}
+        for doc in database[collection_name].find({"$or": clauses}):
+            found[str(doc["_id"])] = doc
+            if doc.get("id"):
+                found.setdefault(doc["id"], doc)
+        for entry in group:
+            current = found.get(entry.target_id)
+            if current is None:
+                entry.fail(404, f"{entry.resource_type}/{entry.target_id} not found", "not-found")
+            else:
+                entry.current = current
+
+def _build_document(entry):
+    doc = dict(entry.document)
+    doc["resourceType"] = entry.resource_type
+    if entry.resource_type == "Patient":
+        if entry.method == "POST" or "name" in doc:
+            stamp_search_keys(doc, patient_search_keys)
+        if entry.method == "POST":
+            stamp_birth_date(doc)
+    return doc
+
+def _write_op(entry):
+    doc = _build_document(entry)
+    if entry.method == "PUT":
+        doc.pop("id", None)
+        update = {"$set": doc}
+        if entry.resource_type == "Patient" and "birthDate" in doc:
+            birth_date = parse_birth_date(doc["birthDate"])
+            if birth_date:
+                doc[BIRTH_DATE_FIELD] = birth_date
+            else:
+                update["$unset"] = {BIRTH_DATE_FIELD: ""}
+        return UpdateOne({"_id": entry.current["_id"]}, update)
+
+    doc["_id"] = entry.object_id
+    if doc.get("id"):
+        # Create-if-absent on the FHIR id, like the single-resource POST
+        return UpdateOne({"id": doc["id"], "resourceType": entry.resource_type}, {"$setOnInsert": doc}, upsert=True)
+    return InsertOne(doc)
+
+def _write_collection(database, collection_name, entries, session=None):
+    """One bulk_write for a collection; sets each entry's status from the per-op results."""
+    ops = [_write_op(e) for e in entries]
+    try:
+        result = database[collection_name].bulk_write(ops, ordered=False, session=session).bulk_api_result
+    except BulkWriteError as e:
+        result = e.details
+    for error in result.get("writeErrors", []):
+        code = 409 if error.get("code") == 11000 else 500
+        entries[error["index"]].fail(code, error.get("errmsg", "Write failed"), "conflict" if code == 409 else "exception")
+    upserted = {u["index"] for u in result.get("upserted", [])}
+
+    existing = [e for i, e in enumerate(entries)
+                if e.method == "POST" and e.resource.get("id") and i not in upserted and not e.failed]
+    existing_ids = {}
+    if existing:
+        ids = [e.resource["id"] for e in existing]
+        for doc in database[collection_name].find({"id": {"$in": ids}, "resourceType": existing[0].resource_type}, {"id": 1}, session=session):
+            existing_ids[doc["id"]] = doc["_id"]
+
+    for i, entry in enumerate(entries):
+        if entry.failed:
+            continue
+        if entry.method == "PUT":
+            entry.status, entry.location = 200, entry.reference
+        elif entry.resource.get("id") and i not in upserted:
+            # Already stored under this id: nothing was written
+            entry.object_id = existing_ids.get(entry.resource["id"], entry.object_id)
+            entry.status, entry.location = 200, entry.reference
+        else:
+            entry.status, entry.location = 201, entry.reference
+
+def _archive_history(database, entries, session=None):
+    """Archives the previous version of every PUT that was written."""
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    docs = []
+    for entry in entries:
+        if entry.method == "PUT" and entry.resource_type in HISTORY_RESOURCE_TYPES and not entry.failed:
+            current = dict(entry.current)
+            current.pop(PATIENT_KEY_FIELD, None)
+            docs.append({"original_id": str(entry.target_id), "resourceType": entry.resource_type, "data": current, "timestamp": now})
+    if docs:
+        database.clinical_history.insert_many(docs, session=session)
+
+def _write_entries(database, entries, session=None):
+    by_collection = {}
+    for entry in entries:
+        by_collection.setdefault(BUNDLE_COLLECTIONS[entry.resource_type], []).append(entry)
+    for collection_name, group in by_collection.items():
+        _write_collection(database, collection_name, group, session)
+    _archive_history(database, entries, session)
+
+class _TransactionAborted(Exception):
+    """Raised inside a transaction Bundle's database transaction when a write failed."""
+
+def _write_transaction(database, entries):
+    """Writes a transaction Bundle's entries in one multi-document transaction. Returns False if it was rolled back."""
+    def write(session):
+        for entry in entries:  # with_transaction may run this again after a transient error
+            entry.status = entry.outcome = entry.location = None
+        _write_entries(database, entries, session)
+        if any(e.failed for e in entries):
+            raise _TransactionAborted()
+
+    try:
+        with db.client.start_session() as session:
+            session.with_transaction(write)
+        return True
+    except _TransactionAborted:
+        return False
+
+def _response(bundle_type, entries):
+    response_entries = []
+    for entry in entries:
+        response = {"status": _status(entry.status)}
+        if entry.location:
+            response["location"] = entry.location
+        if entry.outcome:
+            response["outcome"] = entry.outcome
+        response_entries.append({"response": response})
+    return {"resourceType": "Bundle", "type": f"{bundle_type}-response", "entry": response_entries}
+
+def affected_patient_keys(entries):
+    keys = []
+    for entry in entries:
+        if entry.failed or entry.document is None:
+            continue
+        key = entry.document.get(PATIENT_KEY_FIELD)
+        if entry.resource_type == "Patient":
+            key = patient_key(entry.current) if entry.method == "PUT" else (entry.resource.get("id") or str(entry.object_id))
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+def process_bundle(bundle):
+    """
+    Processes a batch or transaction Bundle.
+    Returns (response bundle, HTTP status, patient keys whose data changed, error); on error
+    the first three are None and error is (OperationOutcome, HTTP status).
+    """
+    if not isinstance(bundle, dict) or bundle.get("resourceType") != "Bundle":
+        return None, None, None, (_outcome("Body must be a Bundle", "invalid"), 400)
+    bundle_type = bundle.get("type")
+    if bundle_type not in ("batch", "transaction"):
+        return None, None, None, (_outcome("Bundle.type must be 'batch' or 'transaction'", "not-supported"), 400)
+    raw_entries = bundle.get("entry") or []
+    if not isinstance(raw_entries, list):
+        return None, None, None, (_outcome("Bundle.entry must be a list", "invalid"), 400)
+    if len(raw_entries) > MAX_BUNDLE_ENTRIES:
+        return None, None, None, (_outcome(f"A Bundle may hold at most {MAX_BUNDLE_ENTRIES} entries", "too-costly"), 400)
+
+    database = db.get_db()
+    entries = [_Entry(i, raw) for i, raw in enumerate(raw_entries)]
+    for entry in entries:
+        _parse_entry(entry)
+
+    # Targets for urn:uuid references (fullUrl of entries being written)
+    targets, seen = {}, set()
+    for entry in entries:
+        if entry.failed:
+            continue
+        if entry.full_url and entry.full_url.startswith(URN_PREFIX):
+            if entry.full_url in targets:
+                entry.fail(400, f"Duplicate fullUrl {entry.full_url}", "duplicate")
+                continue
+            targets[entry.full_url] = entry
+        identity = (entry.resource_type, entry.target_id or entry.resource.get("id"))
+        if identity[1]:
+            if identity in seen:
+                entry.fail(400, f"{identity[0]}/{identity[1]} appears more than once in the Bundle", "duplicate")
+                continue
+            seen.add(identity)
+
+    # Resolve references, then validate
+    for entry in entries:
+        if entry.failed:
+            continue
+        missing = set()
+        resource = _replace_references(entry.resource, targets, entry.depends_on, missing)
+        if missing:
+            entry.fail(400, f"Unresolved reference(s): {', '.join(sorted(missing))}", "not-found")
+            continue
+        validated, error = validate_fhir_resource(entry.resource_type, resource)
+        if error:
+            entry.fail(400, error, "invalid")
+            continue
+        if entry.method == "PUT":
+            validated.pop("id", None)
+        entry.document = validated
+
+    # An entry pointing at a failed entry cannot be written either
+    changed = True
+    while changed:
+        changed = False
+        for entry in entries:
+            if not entry.failed and any(t.failed for t in entry.depends_on):
+                entry.fail(400, "References an entry that failed", "processing")
+                changed = True
+
+    live = [e for e in entries if not e.failed]
+    if live:
+        _find_update_targets(database, live)
+        live = [e for e in live if not e.failed]
+
+    if bundle_type == "transaction" and len(live) != len(entries):
+        failures = [f"entry {e.index}: {e.outcome['issue'][0]['diagnostics']}" for e in entries if e.failed]
+        return None, None, None, (_outcome("Transaction rejected; " + "; ".join(failures)), 400)
+
+    if live:
+        _resolve_patient_keys(database, live)
+        if bundle_type == "transaction" and transactions_supported(db.client):
+            if not _write_transaction(database, live):
+                failures = [f"entry {e.index}: {e.outcome['issue'][0]['diagnostics']}" for e in live if e.failed]
+                return None, None, None, (_outcome("Transaction rolled back; " + "; ".join(failures)), 400)
+        else:
+            # Without a replica set a transaction is only all-or-nothing up to this point
+            _write_entries(database, live)
+
+    written = sum(1 for e in entries if not e.failed)
+    logger.info(f"Processed {bundle_type} Bundle: {written} of {len(entries)} entries succeeded")
+    return _response(bundle_type, entries), 200, affected_patient_keys(entries), None
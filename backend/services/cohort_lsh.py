@@ -0,0 +1,189 @@
+import hashlib
+import heapq
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from bson.objectid import ObjectId
+from models.models import PatientModel, ConditionModel
+from models.patient_signature_model import PatientSignatureModel
+from services.similarity_index import _birth_ordinal, AGE_WINDOW
+from utils.patient_key import patient_key
+from utils.logger import logger
+
+# MinHash / LSH parameters: NUM_PERM = BANDS * ROWS. Two condition sets with Jaccard
+# similarity s collide in at least one band with probability 1 - (1 - s^ROWS)^BANDS.
+# Condition sets are small (1-6 codes), so bands are short to keep recall high.
+NUM_PERM = 64
+BANDS = 32
+ROWS = 2
+MAX_LSH_CANDIDATES = int(os.getenv("MAX_LSH_CANDIDATES", "5000"))
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20240601)  # Fixed seed: signatures must be identical across workers and restarts
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+def _token_hash(token):
+    return int.from_bytes(hashlib.blake2b(str(token).encode("utf-8"), digest_size=8).digest(), "big")
+
+def minhash_signature(codes):
+    """MinHash signature (NUM_PERM ints) of a set of condition code texts."""
+    hashes = [_token_hash(c) for c in codes]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+def band_keys(signature):
+    """One bucket key per band; patients sharing a key are LSH candidates."""
+    keys = []
+    for band in range(BANDS):
+        rows = signature[band * ROWS:(band + 1) * ROWS]
+        digest = hashlib.blake2b(",".join(map(str, rows)).encode("utf-8"), digest_size=8).hexdigest()
+        keys.append(f"{band}:{digest}")
+    return keys
+
+def _condition_codes(pid):
+    conditions = ConditionModel().collection.find({"_patientKey": pid}, {"code": 1})
+    return sorted({c["code"].get("text") for c in conditions if c.get("code")}, key=str)
+
+def _signature_row(patient, codes):
+    signature = minhash_signature(codes) if codes else []
+    return {
+        "patientId": patient_key(patient),
+        "gender": patient.get("gender"),
+        "birthDate": patient.get("birthDate"),
+        "birthOrdinal": _birth_ordinal(patient.get("birthDate")),
+        "conditions": codes,
+        "signature": signature,
+        "bands": band_keys(signature) if codes else []
+    }
+
+# --- Maintenance ---
+
+def update_patient_signature(patient_ref):
+    """Recomputes one patient's signature after a write. Patients without conditions get no bands."""
+    signature_model = PatientSignatureModel()
+    patient = PatientModel().find_by_id(patient_ref)
+    if not patient:
+        signature_model.delete_by_patient(patient_ref)
+        return None
+    row = _signature_row(patient, _condition_codes(patient_key(patient)))
+    signature_model.upsert(row["patientId"], row)
+    return row
+
+def rebuild_signatures(batch_size=1000):
+    """Recomputes every signature from two bulk cursors and writes them in batches."""
+    start_time = time.time()
+    codes_by_patient = {}
+    conditions = ConditionModel().collection.find({"_patientKey": {"$exists": True}}, {"_patientKey": 1, "code": 1})
+    for c in conditions:
+        if not c.get("code"): continue
+        pid = c["_patientKey"]
+        codes_by_patient.setdefault(pid, set()).add(c["code"].get("text"))
+
+    signature_model = PatientSignatureModel()
+    rows, written = [], 0
+    for p in PatientModel().collection.find({"resourceType": "Patient"}, {"id": 1, "gender": 1, "birthDate": 1}):
+        codes = codes_by_patient.get(patient_key(p), set())
+        rows.append(_signature_row(p, sorted(codes, key=str)))
+        if len(rows) >= batch_size:
+            written += signature_model.bulk_upsert(rows)
+            rows = []
+    written += signature_model.bulk_upsert(rows)
+    logger.info(f"Rebuilt {written} patient signatures in {round(time.time() - start_time, 3)}s")
+    return written
+
+_signatures_checked = False
+_signatures_lock = threading.Lock()
+
+def ensure_signatures():
+    """
+    Builds signatures for patients that have none, once per process, like
+    similarity_index.ensure_built(): data loaded before this feature (or by a script that
+    did not rebuild them) would otherwise be invisible to approximate search.
+    """
+    global _signatures_checked
+    with _signatures_lock:
+        if _signatures_checked:
+            return
+        keys = {patient_key(p) for p in PatientModel().collection.find({"resourceType": "Patient"}, {"id": 1})}
+        if keys - PatientSignatureModel().find_patient_ids():
+            rebuild_signatures()
+        _signatures_checked = True
+
+# --- Approximate Similarity ---
+
+def find_similar_patients_approx(target_patient_id, k=5):
+    """
+    Approximate variant of find_similar_patients. Candidates come from two bounded, indexed
+    lookups on patient_signatures: LSH buckets of the target's condition set, and the
+    +/-5 year birth-date window (capped). They are then scored exactly.
+    Recall is lost when a shared-condition patient misses every band, or the age window is
+    larger than the cap; there is no gender-only padding.
+    """
+    from services.recommendation_service import find_similar_patients
+
+    ensure_signatures()
+    patient_model = PatientModel()
+    target_patient = patient_model.find_by_id(target_patient_id)
+    if not target_patient: return []
+
+    target_conditions = ConditionModel().find_by_patient(target_patient_id)
+    target_codes = {c.get("code", {}).get("text") for c in target_conditions}
+    if not target_conditions:
+        # Nothing to hash: the exact path is already bounded by the age window
+        return find_similar_patients(target_patient_id, k=k)
+
+    target_age = 0
+    target_dob = _birth_ordinal(target_patient.get("birthDate"))
+    today = datetime.now().toordinal()
+    if target_dob is not None:
+        target_age = (today - target_dob) // 365
+
+    bands = band_keys(minhash_signature(sorted(target_codes, key=str)))
+    signature_model = PatientSignatureModel()
+    gender = target_patient.get("gender")
+    exclude_id = patient_key(target_patient)
+    candidates = signature_model.find_candidates(bands, gender, exclude_id, MAX_LSH_CANDIDATES)
+    lo = today - (365 * (target_age + AGE_WINDOW) + 364)
+    hi = today - 365 * (target_age - AGE_WINDOW)
+    seen = {c["patientId"] for c in candidates}
+    center = target_dob if target_dob is not None else today - 365 * target_age
+    for cand in signature_model.find_in_birth_window(gender, lo, hi, center, exclude_id, MAX_LSH_CANDIDATES):
+        if cand["patientId"] not in seen:
+            candidates.append(cand)
+
+    heap = []
+    for seq, cand in enumerate(candidates):
+        score = 1 # Gender match (pre-filtered)
+        c_age = None
+        dob = _birth_ordinal(cand.get("birthDate"))
+        if dob is not None and abs((today - dob) // 365 - target_age) <= AGE_WINDOW:
+            c_age = (today - dob) // 365
+            score += 2
+        shared = len(target_codes.intersection(cand.get("conditions", [])))
+        score += shared
+        item = (score, -seq, cand["patientId"], c_age, shared)
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    winners = sorted(heap, reverse=True)
+    names = {}
+    if winners:
+        winner_ids = [w[2] for w in winners]
+        object_ids = [ObjectId(pid) for pid in winner_ids if ObjectId.is_valid(pid)]
+        query = {"$or": [{"id": {"$in": winner_ids}}, {"_id": {"$in": object_ids}, "id": {"$exists": False}}]}
+        for p in patient_model.collection.find(query, {"id": 1, "name": 1}):
+            names[patient_key(p)] = p.get("name", [{}])[0].get("text", "Unknown")
+
+    logger.info(f"Approximate similarity for {target_patient_id}: {len(candidates)} LSH candidates, returning top {len(winners)}.")
+    results = []
+    for score, _, pid, c_age, shared in winners:
+        reasons = []
+        if c_age is not None:
+            reasons.append(f"Similar Age ({c_age})")
+        if shared:
+            reasons.append(f"Shared Conditions")
+        results.append({"patient_id": pid, "name": names.get(pid, "Unknown"), "similarity_score": score, "reasons": reasons})
+    return results
@@ -0,0 +1,207 @@
+import datetime
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bson.objectid import ObjectId
+from config import db
+from models.export_job_model import ExportJobModel
+from services.ingestion_service import RESOURCE_COLLECTIONS
+from utils.patient_key import PATIENT_KEY_FIELD
+from utils.birth_date import BIRTH_DATE_FIELD
+from utils.search_keys import SEARCH_KEYS_FIELD
+from utils.streaming import CURSOR_BATCH_SIZE
+from utils.logger import logger
+
+# FHIR Bulk Data $export. The kick-off request only records a job; a small pool of
+# background threads streams each requested collection through a cursor into one NDJSON
+# file per resource type (optionally gzip-compressed), so a full-population extract holds
+# neither a request worker nor more than one cursor batch in memory.
+
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "exports"))
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+OUTPUT_FORMATS = ("application/fhir+ndjson", "application/ndjson", "ndjson")
+# Job state is written back every this many resources (also when cancellation is checked)
+PROGRESS_INTERVAL = 5000
+# An in-progress job whose heartbeat is older than this was abandoned (e.g. by a restart)
+EXPORT_STALE_SECONDS = int(os.getenv("EXPORT_STALE_SECONDS", "900"))
+# How often the running server looks for such jobs
+EXPORT_SWEEP_INTERVAL = int(os.getenv("EXPORT_SWEEP_INTERVAL", "60"))
+
+# Derived fields the app maintains on stored documents; never exported
+_INTERNAL_FIELDS = {PATIENT_KEY_FIELD: 0, BIRTH_DATE_FIELD: 0, SEARCH_KEYS_FIELD: 0}
+
+_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="fhir-export")
+
+class ExportCancelled(Exception):
+    pass
+
+def parse_export_params(args):
+    """
+    Reads _outputFormat, _type, _since and gzip from the kick-off request.
+    Returns ({"types", "since", "gzip"}, error).
+    """
+    output_format = args.get("_outputFormat", OUTPUT_FORMATS[0])
+    if output_format not in OUTPUT_FORMATS:
+        return None, f"_outputFormat must be one of {list(OUTPUT_FORMATS)}"
+
+    types = list(RESOURCE_COLLECTIONS)
+    if args.get("_type"):
+        types = [t.strip() for t in args["_type"].split(",") if t.strip()]
+        unknown = [t for t in types if t not in RESOURCE_COLLECTIONS]
+        if unknown or not types:
+            return None, f"Unsupported _type: {', '.join(unknown) or args['_type']}"
+
+    since = args.get("_since")
+    if since:
+        try:
+            parsed = datetime.datetime.fromisoformat(since.replace("Z", "+00:00"))
+        except ValueError:
+            return None, "_since must be an ISO 8601 instant"
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+        since = parsed.isoformat()
+
+    compress = str(args.get("gzip", "false")).lower()
+    if compress not in ("true", "false", "1", "0"):
+        return None, "gzip must be true or false"
+    return {"types": types, "since": since, "gzip": compress in ("true", "1")}, None
+
+def since_query(since):
+    """
+    Resources changed at or after `since`: meta.lastUpdated when the resource carries it,
+    else the creation time embedded in its ObjectId.
+    """
+    if not since:
+        return {}
+    since_dt = datetime.datetime.fromisoformat(since)
+    return {"$or": [
+        {"meta.lastUpdated": {"$gte": since}},
+        {"meta.lastUpdated": {"$exists": False}, "_id": {"$gte": ObjectId.from_datetime(since_dt)}},
+    ]}
+
+def job_dir(job_id):
+    return os.path.join(EXPORT_DIR, str(job_id))
+
+def file_name(resource_type, compressed):
+    return f"{resource_type}.ndjson" + (".gz" if compressed else "")
+
+def _export_resource(job_id, resource_type, query, compressed, directory):
+    """Streams one collection into its NDJSON file. Returns the number of resources written."""
+    collection = db.get_db()[RESOURCE_COLLECTIONS[resource_type]]
+    final_path = os.path.join(directory, file_name(resource_type, compressed))
+    tmp_path = final_path + ".part"
+    model = ExportJobModel()
+    count = 0
+    opener = (lambda p: gzip.open(p, "wt", encoding="utf-8")) if compressed else (lambda p: open(p, "w", encoding="utf-8"))
+    with opener(tmp_path) as out:
+        cursor = collection.find(query, _INTERNAL_FIELDS, batch_size=CURSOR_BATCH_SIZE).sort("_id", 1)
+        for doc in cursor:
+            object_id = doc.pop("_id")
+            doc["id"] = doc.get("id") or str(object_id)
+            out.write(json.dumps(doc, default=str, separators=(",", ":")))
+            out.write("\n")
+            count += 1
+            if count % PROGRESS_INTERVAL == 0:
+                if model.is_cancelled(job_id):
+                    cursor.close()
+                    raise ExportCancelled()
+                model.set_progress(job_id, resource_type, count)
+    if count:
+        os.replace(tmp_path, final_path)
+    else:
+        # Types with no matching resources are left out of the output
+        os.remove(tmp_path)
+    model.set_progress(job_id, resource_type, count)
+    return count
+
+def run_export(job_id):
+    """Background body of a job: writes every requested type, then records the output."""
+    model = ExportJobModel()
+    if not model.mark_started(job_id):
+        return
+    job = model.find_by_id(str(job_id))
+    directory = job_dir(job_id)
+    os.makedirs(directory, exist_ok=True)
+    start_time = datetime.datetime.now(datetime.timezone.utc)
+    try:
+        query = since_query(job.get("since"))
+        output = []
+        for resource_type in job["types"]:
+            count = _export_resource(job_id, resource_type, query, job["gzip"], directory)
+            if count:
+                output.append({"type": resource_type, "file": file_name(resource_type, job["gzip"]), "count": count})
+        model.finish(job_id, "completed", output=output)
+        seconds = round((datetime.datetime.now(datetime.timezone.utc) - start_time).total_seconds(), 3)
+        logger.info(f"Export {job_id} completed: {sum(o['count'] for o in output)} resources in {len(output)} files in {seconds}s")
+    except ExportCancelled:
+        shutil.rmtree(directory, ignore_errors=True)
+        logger.info(f"Export {job_id} cancelled")
+    except Exception as e:
+        logger.error(f"Export {job_id} failed: {str(e)}")
+        shutil.rmtree(directory, ignore_errors=True)
+        model.finish(job_id, "failed", error=str(e))
+
+def start_export(request_url, params, requested_by):
+    """Records a job and queues it on the export pool. Returns the job id."""
+    job_id = ExportJobModel().create(request_url, params["types"], params["since"], params["gzip"], requested_by)
+    _executor.submit(run_export, job_id)
+    return job_id
+
+def fail_stale_exports():
+    """Fails in-progress jobs whose heartbeat is older than EXPORT_STALE_SECONDS and removes their files."""
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=EXPORT_STALE_SECONDS)
+    failed = ExportJobModel().fail_stale(cutoff.isoformat(), "Interrupted: the job stopped reporting progress")
+    for job_id in failed:
+        shutil.rmtree(job_dir(job_id), ignore_errors=True)
+        logger.warning(f"Export {job_id} was interrupted; marked failed")
+    return failed
+
+def recover_exports(interval=EXPORT_SWEEP_INTERVAL):
+    """
+    Called at startup: jobs are only queued in memory, so after a restart queued jobs are
+    queued again. A job that was running when the server stopped only goes stale once its
+    heartbeat ages past EXPORT_STALE_SECONDS, so a background thread keeps sweeping for
+    such jobs every interval (the first sweep is immediate) instead of checking once.
+    """
+    queued = ExportJobModel().find_queued_ids()
+    for job_id in queued:
+        _executor.submit(run_export, job_id)
+    if queued:
+        logger.info(f"Re-queued {len(queued)} export jobs")
+
+    def loop():
+        while True:
+            try:
+                fail_stale_exports()
+            except Exception as e:
+                logger.error(f"Export stale-job sweep failed: {str(e)}")
+            time.sleep(interval)
+    thread = threading.Thread(target=loop, name="fhir-export-sweeper", daemon=True)
+    thread.start()
+    return thread
+
+def cancel_export(job_id):
+    """Cancels a job and deletes its files. Returns False if there is no such job."""
+    model = ExportJobModel()
+    if not model.find_by_id(job_id):
+        return False
+    model.cancel(job_id)
+    shutil.rmtree(job_dir(job_id), ignore_errors=True)
+    return True
+
+def export_manifest(job, file_url):
+    """Bulk Data completion manifest; file_url(job_id, file name) gives each output URL."""
+    return {
+        "transactionTime": job["transactionTime"],
+        "request": job["request"],
+        "requiresAccessToken": True,
+        "output": [
+            {"type": o["type"], "url": file_url(str(job["_id"]), o["file"]), "count": o["count"]}
+            for o in job.get("output", [])
+        ],
+        "error": [],
+    }
@@ -0,0 +1,257 @@
+import datetime
+import json
+import multiprocessing
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from config import db
+from models.import_job_model import ImportJobModel
+from services.ingestion_service import RESOURCE_COLLECTIONS, DEFAULT_BATCH_SIZE, prepare_record, refresh_derived_data
+from utils.validation import validate_ndjson_lines
+from utils.logger import logger
+
+# FHIR Bulk Data $import. NDJSON input is read line by line and handed to a process pool in
+# chunks, so fhir.resources validation (the CPU-heavy part) runs outside the GIL and in
+# parallel; valid resources come back in order and are written as batched unordered
+# bulk_write upserts, invalid lines become OperationOutcome lines in an error NDJSON file.
+
+IMPORT_DIR = os.getenv("IMPORT_DIR", os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "imports"))
+IMPORT_PROCESSES = int(os.getenv("IMPORT_PROCESSES", str(os.cpu_count() or 2)))
+# Lines per validation task: large enough to amortize pickling, small enough to spread work
+VALIDATION_CHUNK_SIZE = 500
+ERROR_FILE_NAME = "errors.ndjson"
+# An in-progress job whose heartbeat is older than this was abandoned (e.g. by a restart)
+IMPORT_STALE_SECONDS = int(os.getenv("IMPORT_STALE_SECONDS", "3600"))
+# How often the running server looks for such jobs
+IMPORT_SWEEP_INTERVAL = int(os.getenv("IMPORT_SWEEP_INTERVAL", "60"))
+
+_INPUT_NAME = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]*$")
+
+_job_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fhir-import")
+_pool = None
+_pool_lock = threading.Lock()
+
+def _validation_pool():
+    """Shared process pool, started on first use. Spawned rather than forked so children do
+    not inherit the parent's MongoDB connections and threads."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=IMPORT_PROCESSES, mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def _chunks(path, chunk_size):
+    """Yields [(line_no, text)] chunks of the non-blank lines of an NDJSON file."""
+    chunk = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if line.strip():
+                chunk.append((line_no, line))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+def _error_line(source, line_no, message):
+    return json.dumps({
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": "error", "code": "invalid", "location": [f"{source}:{line_no}"], "diagnostics": message}]
+    }) + "\n"
+
+def import_ndjson(path, errors_out, resource_type=None, batch_size=DEFAULT_BATCH_SIZE, chunk_size=VALIDATION_CHUNK_SIZE, pool=None, progress=None):
+    """
+    Imports one NDJSON file; invalid lines are written to errors_out (a text file object).
+    With resource_type (the input's declared type) lines of any other type are invalid.
+    Returns stats: lines, imported (upserted/inserted/modified), invalid, seconds, lines_per_second.
+    """
+    database = db.get_db()
+    pool = pool or _validation_pool()
+    source = os.path.basename(path)
+    allowed = (resource_type,) if resource_type else tuple(RESOURCE_COLLECTIONS)
+    stats = {"input": source, "lines": 0, "imported": 0, "invalid": 0}
+    start_time = time.time()
+    batch, batch_records = {}, 0
+
+    def flush():
+        for collection_name, ops in batch.items():
+            result = database[collection_name].bulk_write(ops, ordered=False)
+            stats["imported"] += result.upserted_count + result.inserted_count + result.modified_count
+        batch.clear()
+
+    def consume(results):
+        nonlocal batch_records
+        for line_no, resource, error in results:
+            stats["lines"] += 1
+            if error:
+                stats["invalid"] += 1
+                errors_out.write(_error_line(source, line_no, error))
+                continue
+            collection_name, op = prepare_record(resource)
+            batch.setdefault(collection_name, []).append(op)
+            batch_records += 1
+            if batch_records >= batch_size:
+                flush()
+                batch_records = 0
+        if progress:
+            progress(source, stats["lines"])
+
+    # Keep a bounded number of chunks in flight so memory stays flat on large files
+    in_flight = deque()
+    max_in_flight = max(2, IMPORT_PROCESSES * 2)
+    for chunk in _chunks(path, chunk_size):
+        in_flight.append(pool.submit(validate_ndjson_lines, chunk, allowed))
+        if len(in_flight) >= max_in_flight:
+            consume(in_flight.popleft().result())
+    while in_flight:
+        consume(in_flight.popleft().result())
+    flush()
+
+    elapsed = time.time() - start_time
+    stats["seconds"] = round(elapsed, 3)
+    stats["lines_per_second"] = round(stats["lines"] / elapsed) if elapsed > 0 else stats["lines"]
+    logger.info(f"Imported {source}: {stats['imported']} of {stats['lines']} lines ({stats['invalid']} invalid) in {stats['seconds']}s")
+    return stats
+
+# --- Jobs ---
+
+def job_dir(job_id):
+    return os.path.join(IMPORT_DIR, "jobs", str(job_id))
+
+def input_path(name):
+    """Path of an input file under IMPORT_DIR; None if the name is not a plain file name."""
+    if not isinstance(name, str) or not _INPUT_NAME.match(name):
+        return None
+    return os.path.join(IMPORT_DIR, name)
+
+def parse_import_manifest(body):
+    """
+    Reads {"input": [{"type": "Patient", "url": "patients.ndjson"}, ...]}; each url names a
+    file already placed in IMPORT_DIR. Returns ([{"type", "name"}], error).
+    """
+    inputs = (body or {}).get("input") if isinstance(body, dict) else None
+    if not isinstance(inputs, list) or not inputs:
+        return None, "input must be a non-empty list of {type, url}"
+    parsed = []
+    for item in inputs:
+        if not isinstance(item, dict):
+            return None, "input entries must be objects"
+        if item.get("type") and item["type"] not in RESOURCE_COLLECTIONS:
+            return None, f"Unsupported type: {item['type']}"
+        path = input_path(item.get("url"))
+        if not path:
+            return None, f"Invalid input url: {item.get('url')}"
+        if not os.path.isfile(path):
+            return None, f"Input not found: {item['url']}"
+        parsed.append({"type": item.get("type"), "name": item["url"]})
+    return parsed, None
+
+def save_upload(stream, job_name, chunk_size=1 << 20):
+    """Copies an uploaded NDJSON body to IMPORT_DIR without holding it in memory. Returns the file name."""
+    os.makedirs(IMPORT_DIR, exist_ok=True)
+    name = f"upload-{job_name}.ndjson"
+    with open(os.path.join(IMPORT_DIR, name), "wb") as f:
+        while True:
+            data = stream.read(chunk_size)
+            if not data:
+                break
+            f.write(data)
+    return name
+
+def _remove_uploads(inputs):
+    """Deletes the spooled request bodies of a finished job; manifest inputs are left alone."""
+    for item in inputs:
+        if item.get("upload"):
+            try:
+                os.remove(input_path(item["name"]))
+            except OSError:
+                pass
+
+def run_import(job_id):
+    """Background body of a job: imports every input, then refreshes derived data."""
+    model = ImportJobModel()
+    if not model.mark_started(job_id):
+        return
+    job = model.find_by_id(str(job_id))
+    directory = job_dir(job_id)
+    os.makedirs(directory, exist_ok=True)
+    error_path = os.path.join(directory, ERROR_FILE_NAME)
+    try:
+        output = []
+        with open(error_path, "w", encoding="utf-8") as errors_out:
+            for item in job["inputs"]:
+                stats = import_ndjson(
+                    input_path(item["name"]), errors_out, resource_type=item.get("type"),
+                    progress=lambda source, lines: model.set_progress(job_id, source.replace(".", "_"), lines)
+                )
+                output.append({"type": item.get("type"), "inputUrl": item["name"], "count": stats["imported"],
+                               "lines": stats["lines"], "invalid": stats["invalid"]})
+        errors = sum(o["invalid"] for o in output)
+        if not errors:
+            os.remove(error_path)
+        model.heartbeat(job_id)
+        refresh_derived_data()
+        model.finish(job_id, "completed", output=output, errors=errors)
+    except Exception as e:
+        logger.error(f"Import {job_id} failed: {str(e)}")
+        model.finish(job_id, "failed", error=str(e))
+    finally:
+        _remove_uploads(job["inputs"])
+
+def start_import(request_url, inputs, requested_by):
+    """Records a job and queues it (one import runs at a time). Returns the job id."""
+    job_id = ImportJobModel().create(request_url, inputs, requested_by)
+    _job_executor.submit(run_import, job_id)
+    return job_id
+
+def fail_stale_imports():
+    """Fails in-progress jobs whose heartbeat is older than IMPORT_STALE_SECONDS and removes their uploads."""
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=IMPORT_STALE_SECONDS)
+    failed = ImportJobModel().fail_stale(cutoff.isoformat(), "Interrupted: the job stopped reporting progress")
+    for job in failed:
+        _remove_uploads(job.get("inputs", []))
+        logger.warning(f"Import {job['_id']} was interrupted; marked failed")
+    return failed
+
+def recover_imports(interval=IMPORT_SWEEP_INTERVAL):
+    """
+    Called at startup: jobs are only queued in memory, so after a restart queued jobs are
+    queued again. A job that was running when the server stopped only goes stale once its
+    heartbeat ages past IMPORT_STALE_SECONDS, so a background thread keeps sweeping for
+    such jobs every interval (the first sweep is immediate) instead of checking once.
+    """
+    queued = ImportJobModel().find_queued_ids()
+    for job_id in queued:
+        _job_executor.submit(run_import, job_id)
+    if queued:
+        logger.info(f"Re-queued {len(queued)} import jobs")
+
+    def loop():
+        while True:
+            try:
+                fail_stale_imports()
+            except Exception as e:
+                logger.error(f"Import stale-job sweep failed: {str(e)}")
+            time.sleep(interval)
+    thread = threading.Thread(target=loop, name="fhir-import-sweeper", daemon=True)
+    thread.start()
+    return thread
+
+def import_manifest(job, error_url):
+    """Completion manifest; error_url(job_id) gives the URL of the error file."""
+    manifest = {
+        "transactionTime": job["transactionTime"],
+        "request": job["request"],
+        "requiresAccessToken": True,
+        "output": [
+            {"type": o["type"], "inputUrl": o["inputUrl"], "count": o["count"]}
+            for o in job.get("output", [])
+        ],
+        "error": [],
+    }
+    if job.get("errors"):
+        manifest["error"].append({"type": "OperationOutcome", "url": error_url(str(job["_id"])), "count": job["errors"]})
+    return manifest
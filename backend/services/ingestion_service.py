@@ -0,0 +1,255 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne
+from config import db, ANALYTICS_BACKEND
+from utils.patient_key import PATIENT_KEY_FIELD, PATIENT_REFERENCE_FIELDS, reference_key
+from utils.birth_date import stamp_birth_date
+from utils.search_keys import stamp_search_keys, patient_search_keys
+from utils.logger import logger
+
+# Bulk loading of FHIR resource files (JSON arrays or NDJSON). Files are stream-parsed, so
+# memory does not grow with file size; records are routed to their collection by
+# resourceType and written as unordered bulk upserts keyed on the FHIR id. Progress is
+# checkpointed after every batch so an interrupted load resumes where it stopped.
+
+RESOURCE_COLLECTIONS = {
+    "Patient": "patients",
+    "Condition": "conditions",
+    "Observation": "observations",
+    "MedicationRequest": "medications",
+    "RiskAssessment": "risk_assessments",
+    "Coverage": "coverage",
+    "Consent": "consents",
+}
+
+DEFAULT_BATCH_SIZE = 1000
+CHUNK_SIZE = 1 << 20  # Characters read from a file at a time
+
+_PENDING = object()
+
+# --- Parsing ---
+
+def _skip(buf, pos, chars=" \t\r\n,"):
+    while pos < len(buf) and buf[pos] in chars:
+        pos += 1
+    return pos
+
+def iter_json_records(path, chunk_size=CHUNK_SIZE):
+    """
+    Yields the records of a JSON array file or an NDJSON file one at a time, reading
+    chunk_size characters at a time.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf = f.read(chunk_size)
+        pos = _skip(buf, 0, " \t\r\n")
+        while pos >= len(buf) and buf:
+            # Leading whitespace filled the chunk; read on to see how the file starts
+            buf = f.read(chunk_size)
+            pos = _skip(buf, 0, " \t\r\n")
+        if pos >= len(buf) or buf[pos] != "[":
+            # NDJSON: one record per non-blank line
+            f.seek(0)
+            for line_no, line in enumerate(f, 1):
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError as e:
+                        raise ValueError(f"{path}: invalid JSON on line {line_no}: {e}")
+            return
+
+        pos += 1
+        eof = False
+        while True:
+            pos = _skip(buf, pos)
+            record = _PENDING
+            if pos < len(buf):
+                if buf[pos] == "]":
+                    return
+                try:
+                    record, end = decoder.raw_decode(buf, pos)
+                    if end == len(buf) and not eof:
+                        record = _PENDING  # May be cut off at the chunk boundary; read more first
+                except ValueError:
+                    if eof:
+                        raise ValueError(f"{path}: invalid JSON near character {pos}")
+            if record is not _PENDING:
+                yield record
+                pos = end
+                continue
+            if eof:
+                raise ValueError(f"{path}: unterminated JSON array")
+            more = f.read(chunk_size)
+            buf, pos, eof = buf[pos:] + more, 0, not more
+
+# --- Record preparation ---
+
+def prepare_record(record):
+    """
+    Returns (collection name, write op) for a raw resource, or (None, None) if its resourceType
+    is not stored here. Derived fields the models maintain are stamped on the way in.
+    """
+    collection_name = RESOURCE_COLLECTIONS.get(record.get("resourceType"))
+    if not collection_name:
+        return None, None
+
+    if collection_name == "patients":
+        stamp_birth_date(record)
+        stamp_search_keys(record, patient_search_keys)
+    else:
+        holder = record.get(PATIENT_REFERENCE_FIELDS.get(collection_name, "subject"))
+        key = reference_key(holder.get("reference")) if isinstance(holder, dict) else None
+        # An ObjectId-shaped reference may name a patient that has a FHIR id; those are
+        # resolved in one pass by backfill_patient_keys after the load
+        if key and not ObjectId.is_valid(key):
+            record[PATIENT_KEY_FIELD] = key
+
+    if record.get("id"):
+        return collection_name, UpdateOne(
+            {"id": record["id"], "resourceType": record["resourceType"]}, {"$set": record}, upsert=True
+        )
+    return collection_name, InsertOne(record)
+
+# --- Checkpoints ---
+
+class Checkpoint:
+    """
+    Records consumed per file, persisted as JSON. An entry only applies to the same file
+    (size and modification time), so an edited file is loaded from the start.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.state = {}
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                self.state = json.load(f)
+
+    @staticmethod
+    def _signature(file_path):
+        stat = os.stat(file_path)
+        return f"{stat.st_size}:{int(stat.st_mtime)}"
+
+    def position(self, file_path):
+        entry = self.state.get(os.path.abspath(file_path))
+        if entry and entry.get("signature") == self._signature(file_path):
+            return entry.get("records", 0), entry.get("complete", False)
+        return 0, False
+
+    def save(self, file_path, records, complete=False):
+        if not self.path:
+            return
+        with self._lock:
+            self.state[os.path.abspath(file_path)] = {
+                "signature": self._signature(file_path), "records": records, "complete": complete
+            }
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.state, f, indent=2)
+            os.replace(tmp, self.path)
+
+    def clear(self):
+        with self._lock:
+            self.state = {}
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+
+# --- Loading ---
+
+def ingest_file(path, batch_size=DEFAULT_BATCH_SIZE, checkpoint=None, progress=None):
+    """
+    Loads one file. Returns stats: records read, written (upserted/inserted/modified), skipped,
+    seconds and records per second. Resumes after the records the checkpoint already covers.
+    """
+    database = db.get_db()
+    checkpoint = checkpoint or Checkpoint(None)
+    done, complete = checkpoint.position(path)
+    stats = {"file": os.path.basename(path), "read": 0, "written": 0, "skipped": 0, "resumed_at": done}
+    if complete:
+        stats.update(seconds=0, records_per_second=0, already_complete=True)
+        return stats
+
+    start_time = time.time()
+    batch, batch_records, consumed = {}, 0, 0
+
+    def flush():
+        for collection_name, ops in batch.items():
+            result = database[collection_name].bulk_write(ops, ordered=False)
+            stats["written"] += result.upserted_count + result.inserted_count + result.modified_count
+        batch.clear()
+        checkpoint.save(path, consumed)
+        if progress:
+            progress(stats["file"], consumed, time.time() - start_time)
+
+    for record in iter_json_records(path):
+        consumed += 1
+        if consumed <= done:
+            continue
+        stats["read"] += 1
+        collection_name, op = prepare_record(record) if isinstance(record, dict) else (None, None)
+        if op is None:
+            stats["skipped"] += 1
+            continue
+        batch.setdefault(collection_name, []).append(op)
+        batch_records += 1
+        if batch_records >= batch_size:
+            flush()
+            batch_records = 0
+    flush()
+    checkpoint.save(path, consumed, complete=True)
+
+    elapsed = time.time() - start_time
+    stats["seconds"] = round(elapsed, 3)
+    stats["records_per_second"] = round(stats["read"] / elapsed) if elapsed > 0 else stats["read"]
+    logger.info(f"Ingested {stats['file']}: {stats['read']} records in {stats['seconds']}s ({stats['records_per_second']} records/s)")
+    return stats
+
+def refresh_derived_data():
+    """
+    Brings the data derived from the clinical collections up to date after a bulk load:
+    patient keys on clinical records, analytics rollups (rollup backend), the population
+    snapshot version, stored patient risk, LSH signatures and this process's similarity
+    index. Birth dates and search keys need no pass here; prepare_record stamps them.
+    """
+    from utils.patient_key import backfill_patient_keys
+    from services.analytics_rollup import rebuild_rollups
+    from services.population_snapshot import mark_population_changed
+    from services.risk_service import rebuild_patient_risk
+    from services.cohort_lsh import rebuild_signatures
+    from services.similarity_index import similarity_index
+    backfill_patient_keys()
+    if ANALYTICS_BACKEND == "rollup":
+        rebuild_rollups()
+    mark_population_changed()
+    rebuild_patient_risk()
+    rebuild_signatures()
+    # Other processes pick the load up when their index expires (SIMILARITY_INDEX_TTL)
+    similarity_index.invalidate()
+
+def ingest_files(paths, batch_size=DEFAULT_BATCH_SIZE, workers=None, checkpoint_path=None, progress=None, refresh=True):
+    """
+    Loads several files in parallel (one thread per file, up to `workers`). Returns
+    {"files": [per-file stats], "read", "written", "seconds", "records_per_second"}.
+    The checkpoint is removed once every file has loaded.
+    """
+    checkpoint = Checkpoint(checkpoint_path)
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=workers or len(paths) or 1) as pool:
+        results = list(pool.map(lambda p: ingest_file(p, batch_size, checkpoint, progress), paths))
+    if refresh:
+        refresh_derived_data()
+    checkpoint.clear()
+
+    elapsed = time.time() - start_time
+    read = sum(r["read"] for r in results)
+    return {
+        "files": results,
+        "read": read,
+        "written": sum(r["written"] for r in results),
+        "seconds": round(elapsed, 3),
+        "records_per_second": round(read / elapsed) if elapsed > 0 else read,
+    }
@@ -0,0 +1,435 @@
+import os
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from config import ANALYTICS_BACKEND, db
+from models.models import PatientModel, ConditionModel, ObservationModel, MedicationModel
+from services.analytics_service import MEDICATION_FIELDS
+from services.risk_service import _age_factor, _condition_points, _observation_points, _is_active_medication
+from utils.classification import classify_vital, is_chronic_condition, VITAL_THRESHOLDS
+from utils.patient_key import patient_key as _patient_key
+from utils.logger import logger
+
+# Columnar, in-memory copy of the population (ANALYTICS_BACKEND=snapshot). Every record is
+# parsed once when the snapshot is built; analytics views, the age trend endpoint and batch
+# risk scoring then run as np.unique / np.bincount over integer columns.
+
+# Seconds after which the snapshot is rebuilt even if nothing was written (ages move on)
+SNAPSHOT_TTL = int(os.getenv("POPULATION_SNAPSHOT_TTL", "900"))
+# Seconds between checks of the shared change counter
+SNAPSHOT_CHECK_INTERVAL = float(os.getenv("POPULATION_SNAPSHOT_CHECK_SECONDS", "5"))
+
+VERSION_KEY = "population_snapshot"
+
+AGE_GROUPS = ["Unknown", "0-18", "19-30", "31-45", "46-60", ">60"]
+AGE_BOUNDS = [18, 30, 45, 60]  # Upper bounds of the AnalyticsService buckets after "Unknown"
+
+PATIENT_FIELDS = {"id": 1, "birthDate": 1, "address": 1}
+CONDITION_FIELDS = {"_patientKey": 1, "code.text": 1, "clinicalStatus.text": 1}
+OBSERVATION_FIELDS = {"_patientKey": 1, "code.text": 1, "valueQuantity.value": 1, "status": 1}
+SNAPSHOT_MEDICATION_FIELDS = {**MEDICATION_FIELDS, "status": 1}
+
+_MISSING = object()  # code.text absent from the document; each view substitutes its own default
+NO_CONDITIONS = "Unknown / Prophylactic"
+
+class _Vocabulary:
+    """Dictionary encoding: value -> dense integer code, assigned in first-seen order."""
+    def __init__(self, values=()):
+        self.codes = {}
+        self.values = []
+        for value in values:
+            self.encode(value)
+
+    def encode(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.values)
+
+def _pairs(a, b, nb):
+    """
+    Counts (a, b) code pairs. Returns [(a, b, count)] ordered by first occurrence, the same
+    order the dict-based aggregators produce.
+    """
+    if not len(a):
+        return []
+    combined = a.astype(np.int64) * nb + b
+    keys, first, counts = np.unique(combined, return_index=True, return_counts=True)
+    order = np.argsort(first, kind="stable")
+    return [(int(k // nb), int(k % nb), int(n)) for k, n in zip(keys[order].tolist(), counts[order].tolist())]
+
+def _text(record):
+    code = record.get("code")
+    return code.get("text", _MISSING) if isinstance(code, dict) else _MISSING
+
+class PopulationSnapshot:
+    """
+    Patients, conditions, observations and medications as NumPy columns.
+    Clinical records point at their patient by row index (-1 if the patient does not exist);
+    texts, cities and medication names are dictionary-encoded.
+    """
+    def __init__(self, service):
+        self.service = service
+        self.built_at = time.time()
+        now = datetime.now()
+
+        # --- Patients ---
+        self.keys = []
+        rows = {}
+        ages, age_valid, age_factors, cities = [], [], [], []
+        self.cities = _Vocabulary()
+        for p in PatientModel().collection.find({}, PATIENT_FIELDS):
+            key = _patient_key(p)
+            rows[key] = len(self.keys)
+            self.keys.append(key)
+            age = service._calculate_age(p.get("birthDate"))
+            ages.append(age or 0)
+            age_valid.append(age is not None)
+            factor, _ = _age_factor(p.get("birthDate"), now)
+            age_factors.append(np.nan if factor is None else factor)
+            city = "Unknown"
+            if "address" in p and len(p["address"]) > 0:
+                city = p["address"][0].get("city", "Unknown")
+            cities.append(self.cities.encode(city))
+        self.age = np.array(ages, dtype=np.int32)
+        self.age_valid = np.array(age_valid, dtype=bool)
+        self.age_group = np.where(self.age_valid, 1 + np.searchsorted(AGE_BOUNDS, self.age), 0).astype(np.int32)
+        self.age_factor = np.array(age_factors, dtype=np.float64)
+        self.city = np.array(cities, dtype=np.int32)
+        self.rows = rows
+
+        failed = set()  # Keys with a record the risk engine could not score
+
+        # --- Conditions ---
+        self.texts = _Vocabulary()
+        c_row, c_text, c_points = [], [], []
+        for c in ConditionModel().collection.find({}, CONDITION_FIELDS):
+            key = c.get("_patientKey")
+            c_row.append(rows.get(key, -1))
+            c_text.append(self.texts.encode(_text(c)))
+            points = None
+            if key is not None and key not in failed:
+                try:
+                    points = _condition_points(c)
+                except Exception:
+                    failed.add(key)
+            c_points.append(np.nan if points is None else points)
+        self.condition_patient = np.array(c_row, dtype=np.int32)
+        self.condition_text = np.array(c_text, dtype=np.int32)
+        self.condition_points = np.array(c_points, dtype=np.float64)  # NaN: not Active
+
+        # --- Observations ---
+        self.vitals = _Vocabulary(VITAL_THRESHOLDS)
+        o_row, o_abnormal, o_vital, o_points = [], [], [], []
+        for o in ObservationModel().collection.find({}, OBSERVATION_FIELDS):
+            key = o.get("_patientKey")
+            o_row.append(rows.get(key, -1))
+            value = o.get("valueQuantity", {}).get("value")
+            vital_type = classify_vital(o.get("code", {}).get("text", "")) if value is not None else None
+            try:
+                abnormal = vital_type is not None and value > VITAL_THRESHOLDS[vital_type]
+            except TypeError:
+                abnormal = False
+            o_abnormal.append(abnormal)
+            o_vital.append(self.vitals.codes[vital_type] if abnormal else 0)
+            points = 0
+            if key is not None and key not in failed:
+                try:
+                    points = _observation_points(o)
+                except Exception:
+                    failed.add(key)
+            o_points.append(points)
+        self.observation_patient = np.array(o_row, dtype=np.int32)
+        self.observation_abnormal = np.array(o_abnormal, dtype=bool)
+        self.observation_vital = np.array(o_vital, dtype=np.int32)
+        self.observation_points = np.array(o_points, dtype=np.float64)
+
+        # --- Medications ---
+        self.medications = _Vocabulary()
+        m_row, m_name, m_active = [], [], []
+        for m in MedicationModel().collection.find({}, SNAPSHOT_MEDICATION_FIELDS):
+            key = m.get("_patientKey")
+            m_row.append(rows.get(key, -1) if key else -1)
+            m_name.append(self.medications.encode(service._get_medication_name(m)))
+            m_active.append(_is_active_medication(m))
+        self.medication_patient = np.array(m_row, dtype=np.int32)
+        self.medication_name = np.array(m_name, dtype=np.int32)
+        self.medication_active = np.array(m_active, dtype=bool)
+
+        self.failed = np.array([key in failed for key in self.keys], dtype=bool)
+
+        logger.info(
+            f"Population snapshot built: {len(self.keys)} patients, {len(c_row)} conditions, "
+            f"{len(o_row)} observations, {len(m_row)} medications in {round(time.time() - self.built_at, 3)}s"
+        )
+
+    # --- Helpers ---
+
+    def _labels(self, default):
+        """Maps text codes to label codes with `default` for missing texts. Returns (map, labels)."""
+        labels = _Vocabulary()
+        mapping = np.array(
+            [labels.encode(default if v is _MISSING else v) for v in self.texts.values], dtype=np.int32
+        )
+        return mapping, labels
+
+    def _linked(self, patient_rows):
+        return patient_rows >= 0
+
+    # --- AnalyticsService views ---
+
+    def disease_distribution(self):
+        mapping, labels = self._labels("Unknown Condition")
+        codes = mapping[self.condition_text] if len(self.condition_text) else self.condition_text
+        if not len(codes):
+            return []
+        keys, first, counts = np.unique(codes, return_index=True, return_counts=True)
+        order = np.argsort(first, kind="stable")
+        return [{"disease": labels.values[k], "count": n} for k, n in zip(keys[order].tolist(), counts[order].tolist())]
+
+    def disease_trends_by_age(self):
+        mapping, labels = self._labels("Unknown")
+        linked = self._linked(self.condition_patient)
+        rows = self.condition_patient[linked]
+        return [
+            {"disease": labels.values[d], "age_group": AGE_GROUPS[a], "count": n}
+            for d, a, n in _pairs(mapping[self.condition_text[linked]], self.age_group[rows], len(AGE_GROUPS))
+        ]
+
+    def disease_trends_by_location(self):
+        mapping, labels = self._labels("Unknown")
+        linked = self._linked(self.condition_patient)
+        rows = self.condition_patient[linked]
+        return [
+            {"disease": labels.values[d], "location": self.cities.values[c], "count": n}
+            for d, c, n in _pairs(mapping[self.condition_text[linked]], self.city[rows], max(len(self.cities), 1))
+        ]
+
+    def vitals_view(self):
+        selected = self.observation_abnormal & self._linked(self.observation_patient)
+        rows = self.observation_patient[selected]
+        return [
+            {"vital": self.vitals.values[v], "age_group": AGE_GROUPS[a], "count": n}
+            for v, a, n in _pairs(self.observation_vital[selected], self.age_group[rows], len(AGE_GROUPS))
+        ]
+
+    def medications_view(self):
+        linked = self._linked(self.medication_patient)
+        rows = self.medication_patient[linked]
+        names = self.medication_name[linked]
+        n_patients = max(len(self.keys), 1)
+
+        by_age = [
+            {"medication": self.medications.values[m], "age_group": AGE_GROUPS[a], "count": n}
+            for m, a, n in _pairs(names, self.age_group[rows], len(AGE_GROUPS))
+        ]
+
+        # Distinct patients per medication, in first-seen medication order
+        unique_usage = []
+        if len(names):
+            distinct = np.unique(names.astype(np.int64) * n_patients + rows) // n_patients
+            patients_per_med = np.bincount(distinct, minlength=len(self.medications))
+            _, first = np.unique(names, return_index=True)
+            for m in names[np.sort(first)].tolist():
+                unique_usage.append({"medication": self.medications.values[m], "count": int(patients_per_med[m])})
+
+        # Each medication counts once for every distinct condition name of its patient
+        mapping, labels = self._labels("Unknown")
+        proxy = labels.encode(NO_CONDITIONS)
+        c_linked = self._linked(self.condition_patient)
+        c_rows = self.condition_patient[c_linked]
+        c_labels = mapping[self.condition_text[c_linked]]
+        pair_keys, first = np.unique(c_rows.astype(np.int64) * len(labels) + c_labels, return_index=True)
+        pair_keys = pair_keys[np.argsort(first, kind="stable")]
+        pair_keys = pair_keys[np.argsort(pair_keys // len(labels), kind="stable")]  # By patient, first-seen within
+        patient_labels = (pair_keys % len(labels)).astype(np.int32)
+        degree = np.bincount((pair_keys // len(labels)).astype(np.int64), minlength=len(self.keys))
+        starts = np.concatenate(([0], np.cumsum(degree)[:-1])) if len(degree) else degree
+
+        by_disease = []
+        if len(rows):
+            med_degree = degree[rows]
+            repeats = np.maximum(med_degree, 1)
+            med_index = np.repeat(np.arange(len(rows)), repeats)
+            offsets = np.arange(int(repeats.sum())) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+            position = np.repeat(starts[rows], repeats) + offsets
+            padded = np.append(patient_labels, proxy).astype(np.int32)
+            diseases = np.where(
+                np.repeat(med_degree, repeats) > 0, padded[np.minimum(position, len(patient_labels))], proxy
+            )
+            by_disease = [
+                {"medication": self.medications.values[m], "disease": labels.values[d], "count": n}
+                for m, d, n in _pairs(names[med_index], diseases, len(labels))
+            ]
+
+        return {"by_age": by_age, "by_disease": by_disease, "unique_usage": unique_usage}
+
+    def chronic_acute(self):
+        types = ["Chronic", "Acute"]
+        chronic = np.array(
+            [0 if is_chronic_condition("" if v is _MISSING else v) else 1 for v in self.texts.values], dtype=np.int32
+        )
+        linked = self._linked(self.condition_patient)
+        rows = self.condition_patient[linked]
+        codes = chronic[self.condition_text[linked]] if len(chronic) else self.condition_text[linked]
+        return [
+            {"type": types[t], "age_group": AGE_GROUPS[a], "count": n}
+            for t, a, n in _pairs(codes, self.age_group[rows], len(AGE_GROUPS))
+        ]
+
+    def comorbidity(self):
+        categories = ["Single-condition", "Multi-condition"]
+        rows = self.condition_patient[self._linked(self.condition_patient)]
+        if not len(rows):
+            return []
+        counts = np.bincount(rows, minlength=len(self.keys))
+        patients, first = np.unique(rows, return_index=True)
+        patients = patients[np.argsort(first, kind="stable")]
+        category = (counts[patients] > 1).astype(np.int32)
+        return [
+            {"category": categories[c], "age_group": AGE_GROUPS[a], "count": n}
+            for c, a, n in _pairs(category, self.age_group[patients], len(AGE_GROUPS))
+        ]
+
+    # --- /stats/disease-trends-by-age ---
+
+    def condition_counts_by_age(self, bounds, groups):
+        """
+        {group: {condition name: count}} over patients with a parsable birthDate, where
+        groups[i] holds ages <= bounds[i] and the last group everything above.
+        """
+        mapping, labels = self._labels("Unknown")
+        linked = self._linked(self.condition_patient)
+        rows = self.condition_patient[linked]
+        dated = self.age_valid[rows]
+        rows = rows[dated]
+        result = {group: {} for group in groups}
+        for g, d, n in _pairs(np.searchsorted(bounds, self.age[rows]), mapping[self.condition_text[linked][dated]], len(labels) or 1):
+            result[groups[g]][labels.values[d]] = n
+        return result
+
+    # --- Batch risk scoring ---
+
+    def risk_arrays(self):
+        """
+        Raw risk components as a (4, N) array over the patients that could be scored, with their
+        keys and the number that could not. Same values as risk_service.extract_population_components.
+        """
+        n = len(self.keys)
+        active = self._linked(self.condition_patient) & ~np.isnan(self.condition_points)
+        rows = self.condition_patient[active]
+        cond_raw = np.bincount(rows, weights=self.condition_points[active], minlength=n)
+        cond_raw += np.where(np.bincount(rows, minlength=n) > 1, 0.5, 0)
+
+        scored = self._linked(self.observation_patient) & (self.observation_points != 0)
+        obs_raw = np.bincount(self.observation_patient[scored], weights=self.observation_points[scored], minlength=n)
+
+        active_meds = self._linked(self.medication_patient) & self.medication_active
+        med_raw = np.bincount(self.medication_patient[active_meds], minlength=n) * 0.5
+
+        components = np.vstack([np.nan_to_num(self.age_factor), cond_raw, obs_raw, med_raw])
+        ok = ~self.failed
+        keys = [k for k, good in zip(self.keys, ok.tolist()) if good]
+        return keys, components[:, ok], int(self.failed.sum())
+
+    def risk_components(self):
+        """{patient_key: (age_factor, cond_raw, obs_raw, med_raw)} or None, as extract_population_components."""
+        keys, components, _ = self.risk_arrays()
+        scored = dict(zip(keys, components.T.tolist()))
+        result = {}
+        for key, factor, failed in zip(self.keys, self.age_factor.tolist(), self.failed.tolist()):
+            if failed:
+                result[key] = None
+                continue
+            _, c, o, m = scored[key]
+            # Zero stays an int, as when the dict-based engine saw no records for the patient
+            result[key] = (None if factor != factor else factor, c or 0, o or 0, m)
+        return result
+
+# --- Refresh ---
+
+def mark_population_changed():
+    """Bumps the shared change counter after a write. No-op unless the snapshot backend is enabled."""
+    if ANALYTICS_BACKEND != "snapshot":
+        return
+    db.get_db().cache_versions.update_one({"_id": VERSION_KEY}, {"$inc": {"version": 1}}, upsert=True)
+
+def _current_version():
+    doc = db.get_db().cache_versions.find_one({"_id": VERSION_KEY})
+    return doc.get("version", 0) if doc else 0
+
+class SnapshotHolder:
+    """
+    The process-wide snapshot. It is rebuilt when the change counter moves (checked at most every
+    SNAPSHOT_CHECK_INTERVAL seconds) or after SNAPSHOT_TTL. One thread rebuilds while the others
+    keep reading the previous snapshot.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = None
+        self._checked_at = 0
+
+    def _service(self):
+        from services.analytics_service import AnalyticsService
+        return AnalyticsService()
+
+    def _stale(self):
+        now = time.time()
+        if now - self._snapshot.built_at >= SNAPSHOT_TTL:
+            return True
+        if now - self._checked_at < SNAPSHOT_CHECK_INTERVAL:
+            return False
+        self._checked_at = now
+        return _current_version() != self._version
+
+    def _rebuild(self, service=None):
+        version = _current_version()  # Read first: a write during the build triggers another one
+        self._snapshot = PopulationSnapshot(service or self._service())
+        self._version = version
+        self._checked_at = time.time()
+
+    def get(self, service=None):
+        if self._snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._rebuild(service)
+            return self._snapshot
+        if self._stale() and self._lock.acquire(blocking=False):
+            try:
+                self._rebuild(service)
+            except Exception as e:
+                logger.error(f"Population snapshot rebuild failed, serving the previous one: {str(e)}")
+            finally:
+                self._lock.release()
+        return self._snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self._snapshot = None
+
+population_snapshot = SnapshotHolder()
+
+class SnapshotAnalyticsBackend:
+    """Serves AnalyticsService views from the columnar snapshot (ANALYTICS_BACKEND=snapshot)."""
+    VIEWS = {
+        "disease_distribution": PopulationSnapshot.disease_distribution,
+        "disease_trends_by_age": PopulationSnapshot.disease_trends_by_age,
+        "disease_trends_by_location": PopulationSnapshot.disease_trends_by_location,
+        "vitals": PopulationSnapshot.vitals_view,
+        "medications": PopulationSnapshot.medications_view,
+        "chronic_acute": PopulationSnapshot.chronic_acute,
+        "comorbidity": PopulationSnapshot.comorbidity,
+    }
+
+    def __init__(self, service):
+        self.service = service
+
+    def run(self, views):
+        snapshot = population_snapshot.get(self.service)
+        return {name: self.VIEWS[name](snapshot) for name in views}
@@ -1,8 +1,11 @@
 
 # Health Plan Definitions and Rules
 
+import threading
+import time
 from models.insurance_plan_model import InsurancePlanModel
 from utils.logger import logger
+from utils.classification import KeywordMatcher, MAX_CACHE_SIZE
 
 # Default plans for fallback/seeding
 DEFAULT_PLANS = [
@@ -43,20 +46,68 @@ DEFAULT_PLANS = [
     }
 ]
 
-def get_all_plans():
-    """Fetch plans from DB or use defaults if empty."""
-    model = InsurancePlanModel()
-    plans = model.find_all()
-    if not plans:
-        # Auto-seed if empty
-        print("Auto-seeding plans...")
-        for p in DEFAULT_PLANS:
-            model.create(p)
+class CoverageTable:
+    """
+    One loaded version of the plan catalog. Plans are sorted by cost and bit i of a coverage
+    mask stands for plans[i]; the "ALL" plan's bit is set in every mask. The cheapest plan
+    covering a set of conditions is the lowest set bit of the AND of their masks.
+    """
+    def __init__(self, plans):
+        self.plans = plans
+        self._matchers = [
+            None if "ALL" in p.get("coverage", []) else KeywordMatcher(p.get("coverage", []))
+            for p in plans
+        ]
+        self.full_mask = (1 << len(plans)) - 1
+        self._masks = {}  # Condition text -> mask; the vocabulary is small, see MAX_CACHE_SIZE
+
+    def coverage_mask(self, condition_text):
+        mask = self._masks.get(condition_text)
+        if mask is None:
+            mask = 0
+            for i, matcher in enumerate(self._matchers):
+                if matcher is None or matcher.matches(condition_text):
+                    mask |= 1 << i
+            if len(self._masks) >= MAX_CACHE_SIZE:
+                self._masks.clear()
+            self._masks[condition_text] = mask
+        return mask
+
+    def cheapest(self, condition_names):
+        """Cheapest plan covering every condition; Basic (cheapest) if none, most expensive if nothing fits."""
+        if not condition_names:
+            return self.plans[0]
+        mask = self.full_mask
+        for name in condition_names:
+            mask &= self.coverage_mask(name)
+            if not mask: break
+        if not mask:
+            return self.plans[-1]
+        return self.plans[(mask & -mask).bit_length() - 1]
+
+class PlanCatalog:
+    """
+    In-process cache of the insurance plan catalog as a CoverageTable. Plan writes bump a
+    version counter in MongoDB, so each worker only re-reads the catalog when that counter has moved.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = None
+        self._table = None
+
+    def _load(self, model):
+        """Returns (CoverageTable, seeded); seeded is True if the defaults had to be inserted."""
         plans = model.find_all()
-    
-    # Format for usage (remove _id if needed or handle it)
-    results = []
-    if plans:
+        seeded = not plans
+        if seeded:
+            # Auto-seed if empty
+            print("Auto-seeding plans...")
+            for p in DEFAULT_PLANS:
+                model.create(dict(p))
+            plans = model.find_all()
+
+        # Format for usage (remove _id if needed or handle it)
+        results = []
         for p in plans:
             # Preserve original 'id' (slug) if present, otherwise use stringified _id
             if 'id' not in p:
@@ -64,58 +115,98 @@ def get_all_plans():
             p['mongo_id'] = str(p['_id'])
             del p['_id']
             results.append(p)
-            
-    return results or DEFAULT_PLANS
+        results = results or [dict(p) for p in DEFAULT_PLANS]
+
+        # Sort plans by cost so the cheapest match is found first
+        try:
+            results.sort(key=lambda x: x.get("cost", 9999))
+        except:
+            pass
+        return CoverageTable(results), seeded
+
+    def refresh(self):
+        """Returns the current CoverageTable, reloading it if the stored version has moved."""
+        model = InsurancePlanModel()
+        version = model.get_version()
+        with self._lock:
+            if version != self._version:
+                self._table, seeded = self._load(model)
+                # Keep the version read before the load: a write landing during the load
+                # then triggers another reload. Only our own seeding moved it on purpose.
+                self._version = model.get_version() if seeded else version
+                logger.info(f"Plan catalog loaded: {len(self._table.plans)} plans (version {self._version})")
+            return self._table
+
+plan_catalog = PlanCatalog()
+
+def get_all_plans():
+    """Plans sorted by cost, from the versioned in-process catalog (seeded with defaults if empty)."""
+    return list(plan_catalog.refresh().plans)
 
 def recommend_plan(conditions):
     """
     Recommend a plan based on the patient's active conditions.
     Logic: Find the cheapest plan that covers ALL the patient's conditions.
     """
-    plans = get_all_plans()
+    table = plan_catalog.refresh()
     logger.info(f"Recommending plan for {len(conditions)} conditions.")
-    
-    # Sort plans by cost to ensure we find cheapest first
-    # Assuming 'cost' is present.
-    try:
-        plans.sort(key=lambda x: x.get("cost", 9999))
-    except:
-        pass
+    plan = table.cheapest([(c.get("code") or {}).get("text") or "" for c in conditions])
+    logger.info(f"Recommended plan: {plan.get('name')}")
+    return plan
 
-    if not conditions:
-        return plans[0] # Return Basic (cheapest) if no conditions
+def recommend_plans_for_population():
+    """
+    recommend_plan for every patient in one pass over the patients and conditions collections.
+    Returns {patient_key: plan id}.
+    """
+    from utils.patient_key import patient_key
 
-    condition_names = [c.get("code", {}).get("text", "") for c in conditions]
-    
-    for plan in plans:
-        coverage = plan.get("coverage", [])
-        if "ALL" in coverage:
-            return plan
-        
-        covered_count = 0
-        for cond_name in condition_names:
-            if any(c.lower() in cond_name.lower() for c in coverage):
-                covered_count += 1
-        
-        if covered_count == len(condition_names):
-            logger.info(f"Match found: {plan.get('name')}")
-            return plan
+    start_time = time.time()
+    table = plan_catalog.refresh()
+    masks = {}  # Patient key -> AND of the coverage masks of their conditions
+    for c in ConditionModel().collection.find({}, {"_patientKey": 1, "code": 1}):
+        key = c.get("_patientKey")
+        if key is None: continue
+        mask = table.coverage_mask((c.get("code") or {}).get("text") or "")
+        masks[key] = masks.get(key, table.full_mask) & mask
 
-    # Default to most expensive if nothing else fits
-    return plans[-1]
+    results = {}
+    for p in PatientModel().collection.find({}, {"id": 1}):
+        key = patient_key(p)
+        mask = masks.get(key)
+        if mask is None:
+            plan = table.plans[0]
+        elif not mask:
+            plan = table.plans[-1]
+        else:
+            plan = table.plans[(mask & -mask).bit_length() - 1]
+        results[key] = plan["id"]
+    logger.info(f"Recommended plans for {len(results)} patients in {round(time.time() - start_time, 3)}s")
+    return results
 
+import heapq
 from datetime import datetime
+from bson.objectid import ObjectId
 from models.models import PatientModel, ConditionModel
 from models.risk_assessment_model import RiskAssessmentModel
+from services.similarity_index import similarity_index
+from utils.patient_key import patient_key
+
+SIMILARITY_MODES = ["exact", "approximate"]
 
-def find_similar_patients(target_patient_id):
+def find_similar_patients(target_patient_id, k=5, mode="exact"):
     """
-    Finds a cohort of similar patients based on:
+    Finds the top-k cohort of similar patients based on:
     - Gender (Exact match)
     - Age Group (+/- 5 years)
     - Risk Label (Same category)
     - Shared Conditions
+    mode="approximate" retrieves candidates from MinHash/LSH buckets instead (see cohort_lsh).
     """
+    if mode == "approximate":
+        from services.cohort_lsh import find_similar_patients_approx
+        return find_similar_patients_approx(target_patient_id, k=k)
+
     patient_model = PatientModel()
     condition_model = ConditionModel()
     risk_model = RiskAssessmentModel()
@@ -142,66 +233,66 @@ def find_similar_patients(target_patient_id):
             target_age = (datetime.now() - dob).days // 365
         except: pass
         
-    # 2. Find Candidates (Filter by Gender first for speed)
+    # 2. Candidates from the in-process index: only patients of the same gender that share a
+    # condition or fall inside the +/-5 year window are touched.
     logger.info(f"Finding similar patients for {target_patient_id} ({target_age}y, {target_gender})")
-    # 2. Optimized Candidate Fetch
-    candidates = list(patient_model.collection.find({"gender": target_gender}))
-    candidate_ids = [c.get("id") for c in candidates if c.get("id")]
-    
-    # Pre-fetch all conditions for these candidates to avoid N queries
-    all_conds = list(condition_model.collection.find({
-        "subject.reference": {"$in": [f"Patient/{pid}" for pid in candidate_ids]}
-    }))
-    cond_map = {}
-    for c in all_conds:
-        pid = c.get("subject", {}).get("reference", "").replace("Patient/", "")
-        if pid not in cond_map: cond_map[pid] = []
-        cond_map[pid].append(c)
+    similarity_index.ensure_built()
+    today = datetime.now().toordinal()
+    candidates = similarity_index.candidates(target_gender, target_age, target_condition_codes, today)
+    target_key = patient_key(target_patient)
+    candidates.pop(target_key, None)
 
-    scored_candidates = []
-    now = datetime.now()
+    # Stream candidates through a bounded min-heap of size k. Ties keep index order,
+    # so the key is (score, -sequence): the weakest / latest candidate is evicted first.
+    heap = []
+    for fh_id, (c_age, shared) in candidates.items():
+        score = 1 # Gender match (pre-filtered)
+        if c_age is not None:
+            score += 2
+        score += shared
+        item = (score, -similarity_index.sequence(fh_id), fh_id, c_age, shared)
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
 
-    for cand in candidates:
-        fh_id = cand.get("id")
-        if not fh_id or fh_id == target_patient_id:
-            continue
-        
-        score = 0
+    # Reasons are only materialized for the winners
+    top = []
+    for score, _, fh_id, c_age, shared in sorted(heap, reverse=True):
         reasons = []
-        score += 1 # Gender match (pre-filtered)
-        
-        # Age
-        dob_str = cand.get("birthDate")
-        if dob_str and isinstance(dob_str, str) and len(dob_str) == 10:
-            try:
-                c_dob = datetime.strptime(dob_str, "%Y-%m-%d")
-                c_age = (now - c_dob).days // 365
-                if abs(c_age - target_age) <= 5:
-                    score += 2
-                    reasons.append(f"Similar Age ({c_age})")
-            except: pass
-
-        # Conditions
-        p_conds = cond_map.get(fh_id, [])
-        p_codes = {c.get("code", {}).get("text") for c in p_conds if c.get("code")}
-        shared = target_condition_codes.intersection(p_codes)
+        if c_age is not None:
+            reasons.append(f"Similar Age ({c_age})")
         if shared:
-            score += len(shared)
             reasons.append(f"Shared Conditions")
+        top.append((score, fh_id, reasons))
 
-        if score > 0:
-            scored_candidates.append({
-                "patient_id": fh_id,
-                "name": cand.get("name", [{}])[0].get("text", "Unknown"),
-                "similarity_score": score,
-                "reasons": reasons
-            })
-            
-    logger.info(f"Found {len(scored_candidates)} candidates, returning top 5.")
-    return sorted(scored_candidates, key=lambda x: x["similarity_score"], reverse=True)[:5]
+    # Not enough overlap: pad with gender-only matches (score 1), as the full scan would
+    if len(top) < k:
+        exclude = set(candidates) | {target_key}
+        for fh_id in similarity_index.fill(target_gender, exclude, k - len(top)):
+            top.append((1, fh_id, []))
+
+    names = {}
+    if top:
+        top_ids = [t[1] for t in top]
+        object_ids = [ObjectId(pid) for pid in top_ids if ObjectId.is_valid(pid)]
+        query = {"$or": [{"id": {"$in": top_ids}}, {"_id": {"$in": object_ids}, "id": {"$exists": False}}]}
+        for p in patient_model.collection.find(query, {"id": 1, "name": 1}):
+            names[patient_key(p)] = p.get("name", [{}])[0].get("text", "Unknown")
+
+    logger.info(f"Found {len(candidates)} overlapping candidates, returning top {len(top)}.")
+    return [
+        {
+            "patient_id": fh_id,
+            "name": names.get(fh_id, "Unknown"),
+            "similarity_score": score,
+            "reasons": reasons
+        }
+        for score, fh_id, reasons in top
+    ]
 
 
-def get_insurance_recommendation_for_patient(patient_id):
+def get_insurance_recommendation_for_patient(patient_id, similarity_mode="exact"):
     """
     7) Insurance Recommendation
     - Identify similar patients
@@ -222,8 +313,7 @@ def get_insurance_recommendation_for_patient(patient_id):
         import services.risk_service as rs
         patient = PatientModel().find_by_id(patient_id)
         if patient:
-            conds = ConditionModel().find_by_patient(patient_id)
-            risk = rs.calculate_risk_score(patient, conds)
+            risk = rs.get_patient_risk(patient)
             
     if risk:
         risk_label = risk.get("prediction", [{}])[0].get("qualitativeRisk", {}).get("coding", [{}])[0].get("display")
@@ -244,7 +334,7 @@ def get_insurance_recommendation_for_patient(patient_id):
     # by saying "People like you also frequently choose... X")
     
     # Get similar patients
-    similar = find_similar_patients(patient_id)
+    similar = find_similar_patients(patient_id, mode=similarity_mode)
     sim_text = ""
     if similar:
         sim_text = f" {len(similar)} similar patients were analyzed to refine this suggestion."
@@ -1,12 +1,99 @@
 from datetime import datetime
+from config import ANALYTICS_BACKEND
 from models.risk_assessment_model import RiskAssessmentModel
-from models.models import ObservationModel, MedicationModel
+from models.patient_risk_model import PatientRiskModel
+from models.models import PatientModel, ConditionModel, ObservationModel, MedicationModel
 from utils.logger import logger
+from utils.classification import is_high_risk_condition, classify_vital, VITAL_THRESHOLDS
+from utils.patient_key import patient_key as _patient_key, reference_key as _reference_key
+import threading
+import time
 
 risk_model = RiskAssessmentModel()
+patient_risk_model = PatientRiskModel()
 observation_model = ObservationModel()
 medication_model = MedicationModel()
 
+DEFAULT_WEIGHTS = {
+    "age": 30,
+    "conditions": 40,
+    "observations": 20,
+    "medications": 10
+}
+
+# --- Scoring Components ---
+# Shared by the per-patient scorer and the batch engine so both produce identical scores.
+
+def _age_factor(birth_date, now):
+    """Returns (factor, age) for a birthDate, or (None, None) if it is missing or unparsable."""
+    if not birth_date:
+        return None, None
+    try:
+        if isinstance(birth_date, str):
+            dob = datetime.strptime(birth_date, "%Y-%m-%d")
+        else:
+            dob = birth_date
+
+        age = (now - dob).days // 365
+
+        if age > 60: factor = 1.0
+        elif age > 45: factor = 0.66
+        elif age > 30: factor = 0.33
+        else: factor = 0.16
+        return factor, age
+    except:
+        return None, None
+
+def _condition_points(condition):
+    """Raw points for a single condition, or None if it is not Active."""
+    if condition.get("clinicalStatus", {}).get("text") != "Active":
+        return None
+    if is_high_risk_condition(condition.get("code", {}).get("text", "")):
+        return 1.0
+    return 0.3
+
+def _observation_points(observation):
+    """Raw points for a single observation (only final, abnormal vitals count)."""
+    if observation.get("status") != "final":
+        return 0
+    vital_type = classify_vital(observation.get("code", {}).get("text", ""))
+    val_obj = observation.get("valueQuantity", {})
+    val = val_obj.get("value", 0) if isinstance(val_obj, dict) else 0
+
+    if vital_type and val > VITAL_THRESHOLDS[vital_type]:
+        return 0.5
+    return 0
+
+def _is_active_medication(medication):
+    return medication.get("status") == "active"
+
+def _combine_components(age_factor, cond_raw_score, obs_raw_score, med_raw_score, weights):
+    """Applies weights and caps to the raw component scores. Returns (score, components)."""
+    score = 0
+    age_component = 0
+    if age_factor is not None:
+        age_component = age_factor * weights.get("age", 30)
+        score += age_component
+
+    cond_component = min(cond_raw_score * 15, weights.get("conditions", 40))
+    score += cond_component
+
+    obs_component = min(obs_raw_score * 20, weights.get("observations", 20))
+    score += obs_component
+
+    med_component = min(med_raw_score * 10, weights.get("medications", 10))
+    score += med_component
+
+    if score > 100: score = 100
+    return score, (age_component, cond_component, obs_component, med_component)
+
+def _risk_label(score):
+    if score <= 30:
+        return "Low"
+    elif score <= 60:
+        return "Medium"
+    return "High"
+
 def calculate_risk_score(patient, conditions, weights=None):
     """
     Calculates a rule-based risk score with customizable weights.
@@ -18,100 +105,53 @@ def calculate_risk_score(patient, conditions, weights=None):
     """
     logger.info(f"Calculating risk score for patient: {patient.get('id')}")
     if not weights:
-        weights = {
-            "age": 30,
-            "conditions": 40,
-            "observations": 20,
-            "medications": 10
-        }
-    
-    score = 0
+        weights = dict(DEFAULT_WEIGHTS)
+
     details = []
-    
+
     # 1. Age Score
-    birth_date = patient.get("birthDate")
-    age_component = 0
-    if birth_date:
-        try:
-            if isinstance(birth_date, str):
-                dob = datetime.strptime(birth_date, "%Y-%m-%d")
-            else:
-                dob = birth_date
-            
-            age = (datetime.now() - dob).days // 365
-            
-            factor = 0
-            if age > 60: factor = 1.0
-            elif age > 45: factor = 0.66
-            elif age > 30: factor = 0.33
-            else: factor = 0.16
-            
-            age_component = factor * weights.get("age", 30)
-            score += age_component
-            details.append(f"Age {age}: +{round(age_component, 1)}")
-        except:
-            pass 
+    age_factor, age = _age_factor(patient.get("birthDate"), datetime.now())
 
     # 2. Condition Score
-    high_risk = ["diabetes", "hypertension", "heart", "cancer", "stroke", "asthma"]
     cond_raw_score = 0
-    # Filter for Active conditions
-    active_conditions = [c for c in conditions if c.get("clinicalStatus", {}).get("text") == "Active"]
-    for condition in active_conditions:
-        text = condition.get("code", {}).get("text", "").lower()
-        if any(hr in text for hr in high_risk):
-            cond_raw_score += 1.0
-        else:
-            cond_raw_score += 0.3
-            
+    active_count = 0
+    for condition in conditions:
+        points = _condition_points(condition)
+        if points is None:
+            continue
+        cond_raw_score += points
+        active_count += 1
+
     # Comorbidity Bonus
-    if len(active_conditions) > 1:
+    if active_count > 1:
         cond_raw_score += 0.5
-        details.append("Comorbidity Bonus: +7.5")
-            
-    cond_component = min(cond_raw_score * 15, weights.get("conditions", 40))
-    score += cond_component
-    details.append(f"Conditions: +{round(cond_component, 1)}")
 
     # 3. Observation Score
-    patient_id = patient.get("id") or (str(patient.get("_id")) if "_id" in patient else None)
+    patient_id = _patient_key(patient)
     observations = observation_model.find_by_patient(patient_id)
-    # Filter for final status
-    final_observations = [o for o in observations if o.get("status") == "final"]
     obs_raw_score = 0
-    
-    for obs in final_observations:
-        text = obs.get("code", {}).get("text", "").lower()
-        val_obj = obs.get("valueQuantity", {})
-        val = val_obj.get("value", 0) if isinstance(val_obj, dict) else 0
-        
-        if ("blood pressure" in text or "systolic" in text) and val > 140:
-            obs_raw_score += 0.5
-        elif ("glucose" in text or "sugar" in text) and val > 180:
-            obs_raw_score += 0.5
-            
-    obs_component = min(obs_raw_score * 20, weights.get("observations", 20))
-    score += obs_component
-    details.append(f"Vitals: +{round(obs_component, 1)}")
+    for obs in observations:
+        obs_raw_score += _observation_points(obs)
 
     # 4. Medication Score
     meds = medication_model.find_by_patient(patient_id)
-    # Filter for active medications
-    active_meds = [m for m in meds if m.get("status") == "active"]
-    med_raw_score = len(active_meds) * 0.5
-    med_component = min(med_raw_score * 10, weights.get("medications", 10))
-    score += med_component
-    details.append(f"Meds ({len(active_meds)}): +{round(med_component, 1)}")
-    
-    if score > 100: score = 100
+    active_med_count = sum(1 for m in meds if _is_active_medication(m))
+    med_raw_score = active_med_count * 0.5
+
+    score, (age_component, cond_component, obs_component, med_component) = _combine_components(
+        age_factor, cond_raw_score, obs_raw_score, med_raw_score, weights
+    )
+
+    if age_factor is not None:
+        details.append(f"Age {age}: +{round(age_component, 1)}")
+    if active_count > 1:
+        details.append("Comorbidity Bonus: +7.5")
+    details.append(f"Conditions: +{round(cond_component, 1)}")
+    details.append(f"Vitals: +{round(obs_component, 1)}")
+    details.append(f"Meds ({active_med_count}): +{round(med_component, 1)}")
+
+    label = _risk_label(score)
 
-    if score <= 30:
-        label = "Low"
-    elif score <= 60:
-        label = "Medium"
-    else:
-        label = "High"
-    
     risk_assessment = {
         "resourceType": "RiskAssessment",
         "status": "final",
@@ -130,13 +170,221 @@ def calculate_risk_score(patient, conditions, weights=None):
         }],
         "note": [{"text": " | ".join(details)}]
     }
-    
+
     # Save RiskAssessment ONLY if default weights are used
-    is_default = weights == {"age": 30, "conditions": 40, "observations": 20, "medications": 10}
+    is_default = weights == DEFAULT_WEIGHTS
     if is_default:
         inserted_id = risk_model.create(risk_assessment)
         risk_assessment["id"] = str(inserted_id)
         if "_id" in risk_assessment: del risk_assessment["_id"]
-    
+        risk_assessment.pop("_patientKey", None)
+
     logger.info(f"Risk score for {patient_id}: {score} ({label})")
     return risk_assessment
+
+# --- Batch Scoring Engine ---
+
+def extract_population_components():
+    """
+    Computes each patient's raw risk components in a single pass over four bulk cursors
+    (patients, conditions, observations, medications) instead of three queries per patient.
+    Returns {patient_key: (age_factor, cond_raw, obs_raw, med_raw)}; age_factor is None when the
+    birthDate is missing or unparsable, and the whole value is None if a record could not be scored.
+    """
+    if ANALYTICS_BACKEND == "snapshot":
+        from services.population_snapshot import population_snapshot
+        return population_snapshot.get().risk_components()
+
+    cond_raw = {}       # Key -> running raw condition score
+    active_counts = {}  # Key -> number of active conditions
+    obs_raw = {}        # Key -> running raw observation score
+    med_counts = {}     # Key -> number of active medications
+    failed = set()      # Keys with a record that could not be scored
+
+    conditions = ConditionModel().collection.find(
+        {}, {"_patientKey": 1, "clinicalStatus.text": 1, "code.text": 1}
+    )
+    for c in conditions:
+        key = c.get("_patientKey")
+        if key is None or key in failed: continue
+        try:
+            points = _condition_points(c)
+        except Exception:
+            failed.add(key)
+            continue
+        if points is None: continue
+        cond_raw[key] = cond_raw.get(key, 0) + points
+        active_counts[key] = active_counts.get(key, 0) + 1
+
+    observations = observation_model.collection.find(
+        {}, {"_patientKey": 1, "status": 1, "code.text": 1, "valueQuantity.value": 1}
+    )
+    for o in observations:
+        key = o.get("_patientKey")
+        if key is None or key in failed: continue
+        try:
+            points = _observation_points(o)
+        except Exception:
+            failed.add(key)
+            continue
+        if points:
+            obs_raw[key] = obs_raw.get(key, 0) + points
+
+    medications = medication_model.collection.find({}, {"_patientKey": 1, "status": 1})
+    for m in medications:
+        key = m.get("_patientKey")
+        if key is None: continue
+        if _is_active_medication(m):
+            med_counts[key] = med_counts.get(key, 0) + 1
+
+    now = datetime.now()
+    components = {}
+    for p in PatientModel().collection.find({}, {"id": 1, "birthDate": 1}):
+        key = _patient_key(p)
+        if key in failed:
+            components[key] = None
+            continue
+        age_factor, _ = _age_factor(p.get("birthDate"), now)
+        c_raw = cond_raw.get(key, 0)
+        if active_counts.get(key, 0) > 1:
+            c_raw += 0.5
+        components[key] = (age_factor, c_raw, obs_raw.get(key, 0), med_counts.get(key, 0) * 0.5)
+    return components
+
+def extract_patient_components(patient, conditions=None):
+    """Raw risk components (age_factor, cond_raw, obs_raw, med_raw) for a single patient."""
+    patient_key = _patient_key(patient)
+    if conditions is None:
+        conditions = ConditionModel().find_by_patient(patient_key)
+
+    age_factor, _ = _age_factor(patient.get("birthDate"), datetime.now())
+    cond_raw_score = 0
+    active_count = 0
+    for condition in conditions:
+        points = _condition_points(condition)
+        if points is None: continue
+        cond_raw_score += points
+        active_count += 1
+    if active_count > 1:
+        cond_raw_score += 0.5
+
+    obs_raw_score = 0
+    for obs in observation_model.find_by_patient(patient_key):
+        obs_raw_score += _observation_points(obs)
+    active_med_count = sum(1 for m in medication_model.find_by_patient(patient_key) if _is_active_medication(m))
+    return age_factor, cond_raw_score, obs_raw_score, active_med_count * 0.5
+
+def calculate_population_risk(weights=None):
+    """
+    Scores every patient with the batch engine. Nothing is written to the database.
+    Returns {patient_key: (score, label)}; the value is None if scoring failed for that patient.
+    """
+    start_time = time.time()
+    if not weights:
+        weights = dict(DEFAULT_WEIGHTS)
+
+    results = {}
+    for key, comp in extract_population_components().items():
+        if comp is None:
+            results[key] = None
+            continue
+        score, _ = _combine_components(*comp, weights)
+        results[key] = (score, _risk_label(score))
+
+    logger.info(f"Batch risk scoring: {len(results)} patients in {round(time.time() - start_time, 3)}s")
+    return results
+
+# --- Materialized Patient Risk ---
+# patient_risk holds one current row per patient. It is recomputed only when the patient's
+# clinical data changes, so reads are a single keyed lookup.
+
+def _prediction(risk_assessment):
+    prediction = risk_assessment.get("prediction", [{}])[0]
+    label = prediction.get("qualitativeRisk", {}).get("coding", [{}])[0].get("display", "Unknown")
+    return prediction.get("probabilityDecimal", 0), label
+
+def refresh_patient_risk(patient):
+    """Recomputes and stores the current risk for a patient. Returns the RiskAssessment."""
+    patient_key = _patient_key(patient)
+    conditions = ConditionModel().find_by_patient(patient_key)
+    risk_assessment = calculate_risk_score(patient, conditions)
+    score, label = _prediction(risk_assessment)
+    patient_risk_model.upsert(patient_key, score, label, risk_assessment)
+    return risk_assessment
+
+def refresh_patient_risk_for(patient_ref):
+    """Refreshes the stored risk for the patient behind a reference ('Patient/ID' or 'ID')."""
+    patient_key = _reference_key(patient_ref)
+    if not patient_key:
+        return None
+    patient = PatientModel().find_by_id(patient_key)
+    if not patient:
+        return None
+    return refresh_patient_risk(patient)
+
+def get_patient_risk(patient):
+    """Serves the stored RiskAssessment, computing it only if the patient has none yet."""
+    row = patient_risk_model.find_by_patient(_patient_key(patient))
+    if row and row.get("assessment"):
+        return row["assessment"]
+    return refresh_patient_risk(patient)
+
+def _missing_risk_keys():
+    """Keys of patients that have no patient_risk row."""
+    patient_keys = {_patient_key(p) for p in PatientModel().collection.find({"resourceType": "Patient"}, {"id": 1})}
+    return patient_keys - patient_risk_model.find_keys()
+
+def backfill_patient_risk(missing=None):
+    """Scores patients that have no patient_risk row yet with the batch engine."""
+    if missing is None:
+        missing = _missing_risk_keys()
+    if not missing:
+        return 0
+    rows = []
+    for key, result in calculate_population_risk().items():
+        if key not in missing:
+            continue
+        score, label = result if result else (None, None)
+        rows.append({"patientKey": key, "score": score, "label": label})
+    inserted = patient_risk_model.insert_missing(rows)
+    logger.info(f"Backfilled {inserted} patient_risk rows.")
+    return inserted
+
+def rebuild_patient_risk():
+    """
+    Rescores every patient with the batch engine and drops rows of patients that no longer
+    exist. Bulk loads (seed scripts, ingest, $import) bypass the API writes that keep the
+    rows current, so they call this once the load is done.
+    """
+    rows = []
+    for key, result in calculate_population_risk().items():
+        score, label = result if result else (None, None)
+        rows.append({"patientKey": key, "score": score, "label": label})
+    written, removed = patient_risk_model.replace_all(rows)
+    logger.info(f"Rebuilt {written} patient_risk rows ({removed} stale rows removed).")
+    return written
+
+def start_risk_backfill():
+    """
+    Background thread that scores, once at startup, patients with no patient_risk row (data
+    stored before the table existed). After that clinical writes and bulk loads keep it
+    complete, so the read path never has to check.
+    """
+    def run():
+        try:
+            backfill_patient_risk()
+        except Exception as e:
+            logger.error(f"patient_risk backfill failed: {str(e)}")
+    thread = threading.Thread(target=run, name="patient-risk-backfill", daemon=True)
+    thread.start()
+    return thread
+
+def get_population_risk_distribution():
+    """Counts patients per risk label with a single $group over patient_risk."""
+    distribution = {"Low": 0, "Medium": 0, "High": 0, "Unknown": 0}
+    for label, count in patient_risk_model.get_label_counts().items():
+        if label in distribution:
+            distribution[label] += count
+        else:
+            distribution["Unknown"] += count
+    return distribution
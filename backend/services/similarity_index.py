@@ -0,0 +1,180 @@
+import bisect
+import os
+import threading
+import time
+from datetime import datetime
+from models.models import PatientModel, ConditionModel
+from utils.patient_key import patient_key
+from utils.logger import logger
+
+# Seconds before the index is rebuilt from MongoDB so writes made by other workers show up
+SIMILARITY_INDEX_TTL = int(os.getenv("SIMILARITY_INDEX_TTL", "300"))
+AGE_WINDOW = 5
+
+def _birth_ordinal(dob_str):
+    """Day ordinal of a YYYY-MM-DD birthDate, or None (same acceptance rules as the scorer)."""
+    if not dob_str or not isinstance(dob_str, str) or len(dob_str) != 10:
+        return None
+    try:
+        return datetime.strptime(dob_str, "%Y-%m-%d").toordinal()
+    except:
+        return None
+
+def _condition_code(condition):
+    """The code text a condition contributes to similarity, or a sentinel if it has no code."""
+    code = condition.get("code")
+    if not code:
+        return _NO_CODE
+    return code.get("text")
+
+_NO_CODE = object()
+
+class SimilarityIndex:
+    """
+    In-process index for find_similar_patients.
+    - postings: condition code text -> set of patient ids
+    - by_gender: gender -> sorted list of (birth ordinal, patient id) for the age window
+    - members: gender -> patient ids in insertion order (used to fill gender-only matches)
+    Patients are keyed by patient_key() (FHIR id, else MongoDB _id), like the LSH signatures,
+    so exact and approximate search rank the same population.
+    """
+    def __init__(self, ttl=SIMILARITY_INDEX_TTL):
+        self.ttl = ttl
+        self._lock = threading.RLock()
+        self._built_at = None
+        self._reset()
+
+    def _reset(self):
+        self.patients = {}       # pid -> (gender, birth ordinal, insertion seq)
+        self.by_gender = {}
+        self.members = {}
+        self.postings = {}
+        self.patient_codes = {}  # pid -> set of code texts
+        self._seq = 0
+
+    # --- Build / Maintenance ---
+
+    def build(self):
+        start_time = time.time()
+        with self._lock:
+            self._reset()
+            for p in PatientModel().collection.find({"resourceType": "Patient"}, {"id": 1, "gender": 1, "birthDate": 1}):
+                self._add_patient(p)
+            for key in self.by_gender:
+                self.by_gender[key].sort()
+
+            conditions = ConditionModel().collection.find(
+                {"_patientKey": {"$exists": True}}, {"_patientKey": 1, "code": 1}
+            )
+            for c in conditions:
+                code = _condition_code(c)
+                if code is _NO_CODE: continue
+                pid = c["_patientKey"]
+                self.patient_codes.setdefault(pid, set()).add(code)
+                self.postings.setdefault(code, set()).add(pid)
+            self._built_at = time.time()
+        logger.info(f"Similarity index built: {len(self.patients)} patients, {len(self.postings)} codes in {round(time.time() - start_time, 3)}s")
+
+    def ensure_built(self):
+        with self._lock:
+            if self._built_at is None or time.time() - self._built_at > self.ttl:
+                self.build()
+
+    def invalidate(self):
+        """Marks the index stale so the next query rebuilds it (after a bulk load)."""
+        with self._lock:
+            self._built_at = None
+
+    def _add_patient(self, p):
+        pid = patient_key(p)
+        gender = p.get("gender")
+        ordinal = _birth_ordinal(p.get("birthDate"))
+        self.patients[pid] = (gender, ordinal, self._seq)
+        self._seq += 1
+        self.members.setdefault(gender, {})[pid] = None
+        if ordinal is not None:
+            self.by_gender.setdefault(gender, []).append((ordinal, pid))
+
+    def remove_patient(self, pid):
+        with self._lock:
+            if self._built_at is None: return
+            entry = self.patients.pop(pid, None)
+            if entry:
+                gender, ordinal, _ = entry
+                self.members.get(gender, {}).pop(pid, None)
+                if ordinal is not None:
+                    bucket = self.by_gender.get(gender, [])
+                    i = bisect.bisect_left(bucket, (ordinal, pid))
+                    if i < len(bucket) and bucket[i] == (ordinal, pid):
+                        bucket.pop(i)
+            for code in self.patient_codes.pop(pid, set()):
+                self.postings.get(code, set()).discard(pid)
+
+    def refresh_patient(self, patient_ref):
+        """Re-reads one patient and their conditions after a write (no-op until the index is built)."""
+        with self._lock:
+            if self._built_at is None: return
+        patient = PatientModel().find_by_id(patient_ref)
+        pid = patient_key(patient) if patient else patient_ref
+        conditions = ConditionModel().collection.find({"_patientKey": pid}, {"code": 1})
+        codes = {code for code in (_condition_code(c) for c in conditions) if code is not _NO_CODE}
+        with self._lock:
+            self.remove_patient(pid)
+            if patient:
+                self._add_patient(patient)
+                gender = patient.get("gender")
+                ordinal = self.patients[pid][1]
+                if ordinal is not None:
+                    # _add_patient appended; move the entry into sorted position
+                    bucket = self.by_gender[gender]
+                    bucket.pop()
+                    bisect.insort(bucket, (ordinal, pid))
+            if codes:
+                self.patient_codes[pid] = codes
+                for code in codes:
+                    self.postings.setdefault(code, set()).add(pid)
+
+    # --- Queries ---
+
+    def age_window(self, gender, target_age, today_ordinal):
+        """Patient ids of this gender whose age (days // 365) is within +/-5 years of target_age."""
+        lo = today_ordinal - (365 * (target_age + AGE_WINDOW) + 364)
+        hi = today_ordinal - 365 * (target_age - AGE_WINDOW)
+        bucket = self.by_gender.get(gender, [])
+        start = bisect.bisect_left(bucket, lo, key=lambda e: e[0])
+        end = bisect.bisect_right(bucket, hi, key=lambda e: e[0])
+        return bucket[start:end]
+
+    def candidates(self, gender, target_age, target_codes, today_ordinal):
+        """
+        Returns {pid: (age or None, shared count)} for same-gender patients that share a
+        condition or fall within the age window. Nothing else is touched.
+        """
+        with self._lock:
+            found = {}
+            for ordinal, pid in self.age_window(gender, target_age, today_ordinal):
+                found[pid] = [(today_ordinal - ordinal) // 365, 0]
+            for code in target_codes:
+                for pid in self.postings.get(code, ()):
+                    entry = self.patients.get(pid)
+                    if not entry or entry[0] != gender: continue
+                    if pid not in found:
+                        found[pid] = [None, 0]
+                    found[pid][1] += 1
+            return {pid: tuple(v) for pid, v in found.items()}
+
+    def fill(self, gender, exclude, limit):
+        """Same-gender patients outside `exclude`, in insertion order (gender-only matches)."""
+        with self._lock:
+            result = []
+            for pid in self.members.get(gender, {}):
+                if len(result) >= limit: break
+                if pid not in exclude:
+                    result.append(pid)
+            return result
+
+    def sequence(self, pid):
+        entry = self.patients.get(pid)
+        return entry[2] if entry else 0
+
+similarity_index = SimilarityIndex()
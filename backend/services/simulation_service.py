@@ -0,0 +1,95 @@
+import numpy as np
+import time
+from config import ANALYTICS_BACKEND
+from services.risk_service import DEFAULT_WEIGHTS, extract_population_components, extract_patient_components
+from utils.logger import logger
+
+# Column order of the weight matrix
+WEIGHT_KEYS = ["age", "conditions", "observations", "medications"]
+RISK_LABELS = np.array(["Low", "Medium", "High"])
+
+def build_weight_matrix(weight_sets):
+    """Turns a list of weight dicts into an (S, 4) matrix, filling missing keys with the defaults."""
+    return np.array(
+        [[float(w.get(k, DEFAULT_WEIGHTS[k])) for k in WEIGHT_KEYS] for w in weight_sets],
+        dtype=np.float64
+    )
+
+def components_to_arrays(components):
+    """
+    Packs a list of (age_factor, cond_raw, obs_raw, med_raw) tuples into a (4, N) array.
+    A missing age factor contributes nothing, exactly like calculate_risk_score.
+    """
+    arr = np.zeros((4, len(components)), dtype=np.float64)
+    for i, (age_factor, cond_raw, obs_raw, med_raw) in enumerate(components):
+        arr[0, i] = age_factor or 0
+        arr[1, i] = cond_raw
+        arr[2, i] = obs_raw
+        arr[3, i] = med_raw
+    return arr
+
+def evaluate_weight_matrix(components, weight_matrix):
+    """
+    Evaluates every weight set against every patient in one vectorized call.
+    components: (4, N) raw component array, weight_matrix: (S, 4).
+    Returns (scores (S, N), label_index (S, N)) with 0=Low, 1=Medium, 2=High.
+    """
+    age, cond, obs, med = components
+    w = weight_matrix[:, :, None]
+    score = age[None, :] * w[:, 0]
+    score = score + np.minimum(cond[None, :] * 15, w[:, 1])
+    score = score + np.minimum(obs[None, :] * 20, w[:, 2])
+    score = score + np.minimum(med[None, :] * 10, w[:, 3])
+    score = np.minimum(score, 100)
+    labels = (score > 30).astype(np.int8) + (score > 60).astype(np.int8)
+    return score, labels
+
+def simulate_population(weight_sets, include_scores=False):
+    """
+    What-if sweep over the whole population: raw components are extracted once with the
+    batch engine, then all weight sets are scored together.
+    """
+    start_time = time.time()
+    if ANALYTICS_BACKEND == "snapshot":
+        # Components straight from the snapshot's bincount columns, no per-patient tuples
+        from services.population_snapshot import population_snapshot
+        keys, component_array, unknown = population_snapshot.get().risk_arrays()
+    else:
+        components = extract_population_components()
+        keys = [k for k, c in components.items() if c is not None]
+        unknown = len(components) - len(keys)
+        component_array = components_to_arrays([components[k] for k in keys])
+
+    weight_matrix = build_weight_matrix(weight_sets)
+    scores, labels = evaluate_weight_matrix(component_array, weight_matrix)
+
+    results = []
+    for i, weights in enumerate(weight_sets):
+        counts = np.bincount(labels[i], minlength=3)
+        entry = {
+            "weights": dict(zip(WEIGHT_KEYS, weight_matrix[i].tolist())),
+            "distribution": {
+                "Low": int(counts[0]), "Medium": int(counts[1]), "High": int(counts[2]), "Unknown": unknown
+            },
+            "mean_score": round(float(scores[i].mean()), 1) if keys else 0
+        }
+        if include_scores:
+            entry["scores"] = {k: round(s, 1) for k, s in zip(keys, scores[i].tolist())}
+        results.append(entry)
+
+    logger.info(f"Simulated {len(weight_sets)} weight sets over {len(keys)} patients in {round(time.time() - start_time, 3)}s")
+    return results
+
+def simulate_patient(patient, weight_sets, conditions=None):
+    """What-if sweep for one patient: one extraction, all weight sets scored together."""
+    components = components_to_arrays([extract_patient_components(patient, conditions)])
+    weight_matrix = build_weight_matrix(weight_sets)
+    scores, labels = evaluate_weight_matrix(components, weight_matrix)
+    return [
+        {
+            "weights": dict(zip(WEIGHT_KEYS, weight_matrix[i].tolist())),
+            "risk_score": round(float(scores[i, 0]), 1),
+            "risk_label": str(RISK_LABELS[labels[i, 0]])
+        }
+        for i in range(len(weight_sets))
+    ]
@@ -0,0 +1,67 @@
+import datetime
+from pymongo import UpdateOne
+from config import db
+from utils.logger import logger
+
+# Patients store their birthDate as a FHIR date string. _birthDate holds the same date as a
+# BSON date so age filters become an indexed range query; it is absent when birthDate is
+# missing or unparsable.
+BIRTH_DATE_FIELD = "_birthDate"
+
+def parse_birth_date(value):
+    """A FHIR birthDate (YYYY-MM-DD string, date or datetime) as a datetime, or None."""
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime.combine(value, datetime.datetime.min.time())
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.strptime(value, "%Y-%m-%d")
+        except ValueError:
+            return None
+    return None
+
+def stamp_birth_date(patient):
+    """Sets (or drops) _birthDate on a patient document from its birthDate."""
+    birth_date = parse_birth_date(patient.get("birthDate"))
+    if birth_date:
+        patient[BIRTH_DATE_FIELD] = birth_date
+    else:
+        patient.pop(BIRTH_DATE_FIELD, None)
+    return patient
+
+def birth_date_range(now, age_min=None, age_max=None):
+    """
+    Range on _birthDate equivalent to age_min <= (now - dob).days // 365 <= age_max:
+    at least 365 * age_min whole days old and fewer than 365 * (age_max + 1).
+    """
+    query = {}
+    if age_min is not None:
+        query["$lte"] = now - datetime.timedelta(days=365 * age_min)
+    if age_max is not None:
+        query["$gt"] = now - datetime.timedelta(days=365 * (age_max + 1))
+    return query
+
+def backfill_birth_dates(batch_size=1000, only_missing=True):
+    """
+    One-shot migration: stamps _birthDate on existing patients. Idempotent; with
+    only_missing=False every patient is re-stamped. Returns the number of patients updated.
+    """
+    collection = db.get_db().patients
+    query = {"birthDate": {"$exists": True}}
+    if only_missing:
+        query[BIRTH_DATE_FIELD] = {"$exists": False}
+    ops, count = [], 0
+    for doc in collection.find(query, {"birthDate": 1}):
+        birth_date = parse_birth_date(doc.get("birthDate"))
+        if birth_date:
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {BIRTH_DATE_FIELD: birth_date}}))
+        elif not only_missing:
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$unset": {BIRTH_DATE_FIELD: ""}}))
+        if len(ops) >= batch_size:
+            count += collection.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        count += collection.bulk_write(ops, ordered=False).modified_count
+    logger.info(f"Backfilled {BIRTH_DATE_FIELD} on {count} patients")
+    return count
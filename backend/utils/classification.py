@@ -0,0 +1,73 @@
+import re
+
+# Keyword lists shared by risk scoring, analytics and plan matching
+HIGH_RISK_KEYWORDS = ["diabetes", "hypertension", "heart", "cancer", "stroke", "asthma"]
+
+CHRONIC_INDICATORS = [
+    "diabetes", "hypertension", "heart", "asthma", "arthritis",
+    "chronic", "alzheimer", "parkinson", "bipolar", "schizophrenia",
+    "ptsd", "obesity", "thyroid", "osteoporosis", "copd", "gerd",
+    "glaucoma", "hiv", "tuberculosis", "hepatitis", "anemia"
+]
+
+BLOOD_PRESSURE_KEYWORDS = ["blood pressure", "systolic"]
+GLUCOSE_KEYWORDS = ["glucose", "sugar"]
+
+# Vital type -> value above which the reading is abnormal
+VITAL_THRESHOLDS = {"High BP": 140, "High Sugar": 180}
+
+# Texts come from a bounded vocabulary (conditions_pool / observations_pool), but free-text
+# input can still reach us, so each memo table is cleared once it grows past this size.
+MAX_CACHE_SIZE = 10000
+
+class KeywordMatcher:
+    """
+    Case-insensitive substring matcher: equivalent to any(k in text.lower() for k in keywords),
+    but the keyword list is compiled once into a single regex alternation and the result for
+    each distinct text is memoized.
+    """
+    def __init__(self, keywords):
+        self.keywords = [k.lower() for k in keywords]
+        # Longest first so the alternation prefers the most specific keyword
+        alternation = "|".join(re.escape(k) for k in sorted(set(self.keywords), key=len, reverse=True))
+        self._pattern = re.compile(alternation) if self.keywords else None
+        self._cache = {}
+
+    def matches(self, text):
+        hit = self._cache.get(text)
+        if hit is None:
+            hit = self._pattern is not None and self._pattern.search(text.lower()) is not None
+            if len(self._cache) >= MAX_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[text] = hit
+        return hit
+
+high_risk_matcher = KeywordMatcher(HIGH_RISK_KEYWORDS)
+chronic_matcher = KeywordMatcher(CHRONIC_INDICATORS)
+blood_pressure_matcher = KeywordMatcher(BLOOD_PRESSURE_KEYWORDS)
+glucose_matcher = KeywordMatcher(GLUCOSE_KEYWORDS)
+
+_vital_cache = {}
+
+def is_high_risk_condition(text):
+    return high_risk_matcher.matches(text)
+
+def is_chronic_condition(text):
+    return chronic_matcher.matches(text)
+
+def classify_vital(text):
+    """Returns "High BP", "High Sugar" or None for an observation code text (blood pressure wins)."""
+    try:
+        return _vital_cache[text]
+    except KeyError:
+        pass
+    if blood_pressure_matcher.matches(text):
+        vital_type = "High BP"
+    elif glucose_matcher.matches(text):
+        vital_type = "High Sugar"
+    else:
+        vital_type = None
+    if len(_vital_cache) >= MAX_CACHE_SIZE:
+        _vital_cache.clear()
+    _vital_cache[text] = vital_type
+    return vital_type
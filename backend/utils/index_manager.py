@@ -0,0 +1,125 @@
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+from pymongo.errors import OperationFailure
+from utils.logger import logger
+
+# Collection -> indexes the models' queries rely on. Each entry is (name, keys); an index is
+# considered present if any index on the collection has the same key pattern, whatever its name.
+INDEXES = {
+    "patients": [
+        ("id_resourceType", [("id", ASCENDING), ("resourceType", ASCENDING)]),
+        # /stats/trends age filters: range on the derived birth date
+        ("birthDate", [("_birthDate", ASCENDING)]),
+        # Admin listing search: prefix mode and text mode
+        ("searchKeys", [("_searchKeys", ASCENDING)]),
+        ("name_text", [("name.family", TEXT), ("name.given", TEXT), ("name.text", TEXT)]),
+    ],
+    "conditions": [
+        ("patientKey", [("_patientKey", ASCENDING)]),
+        ("id_resourceType", [("id", ASCENDING), ("resourceType", ASCENDING)]),
+    ],
+    "observations": [
+        ("patientKey", [("_patientKey", ASCENDING)]),
+        ("id_resourceType", [("id", ASCENDING), ("resourceType", ASCENDING)]),
+    ],
+    "medications": [
+        ("patientKey", [("_patientKey", ASCENDING)]),
+        ("id_resourceType", [("id", ASCENDING), ("resourceType", ASCENDING)]),
+    ],
+    "clinical_history": [
+        ("original_id_timestamp", [("original_id", ASCENDING), ("timestamp", DESCENDING)]),
+    ],
+    "clinical_versions": [
+        ("patientId_versionNum", [("patientId", ASCENDING), ("versionNum", DESCENDING)]),
+    ],
+    "users": [
+        ("username", [("username", ASCENDING)]),
+        ("patientId", [("patientId", ASCENDING)]),
+        ("searchKeys", [("_searchKeys", ASCENDING)]),
+        ("username_name_text", [("name", TEXT), ("username", TEXT)]),
+    ],
+    "consents": [
+        ("patientKey_status", [("_patientKey", ASCENDING), ("status", ASCENDING)]),
+    ],
+    "coverage": [
+        ("patientKey", [("_patientKey", ASCENDING)]),
+    ],
+    "risk_assessments": [
+        # find_latest_by_patient: equality on the patient key, newest _id first
+        ("patientKey_id", [("_patientKey", ASCENDING), ("_id", DESCENDING)]),
+    ],
+    "patient_risk": [
+        ("patientKey", [("patientKey", ASCENDING)]),
+    ],
+    "patient_signatures": [
+        ("patientId", [("patientId", ASCENDING)]),
+        ("bands_gender", [("bands", ASCENDING), ("gender", ASCENDING)]),
+        ("gender_birthOrdinal", [("gender", ASCENDING), ("birthOrdinal", ASCENDING)]),
+    ],
+}
+
+def _key_pattern(keys):
+    # Servers may report directions as floats; special index types (e.g. "text") stay strings.
+    # Text fields are order-insensitive, so they are compared sorted.
+    pattern = [(field, int(d) if isinstance(d, (int, float)) else d) for field, d in keys]
+    return tuple([k for k in pattern if k[1] != TEXT] + sorted(k for k in pattern if k[1] == TEXT))
+
+def _existing_patterns(collection):
+    """{key pattern: index name} for the indexes currently on a collection."""
+    patterns = {}
+    for name, info in collection.index_information().items():
+        keys = info["key"]
+        if ("_fts", TEXT) in keys:
+            # Text indexes are reported as _fts/_ftsx; the indexed fields are the weights
+            keys = [(field, TEXT) for field in info.get("weights", {})]
+        patterns[_key_pattern(keys)] = name
+    return patterns
+
+def ensure_indexes(database, collections=None):
+    """
+    Creates every declared index that is missing. Safe to call on every startup: existing
+    indexes (matched by key pattern) are left alone and nothing is ever dropped.
+    Returns {collection: [created index names]}.
+    """
+    created = {}
+    for coll_name, specs in INDEXES.items():
+        if collections and coll_name not in collections: continue
+        collection = database[coll_name]
+        existing = _existing_patterns(collection)
+        missing = [
+            IndexModel(keys, name=name) for name, keys in specs
+            if _key_pattern(keys) not in existing
+        ]
+        if not missing: continue
+        try:
+            created[coll_name] = collection.create_indexes(missing)
+            logger.info(f"Created indexes on {coll_name}: {', '.join(created[coll_name])}")
+        except OperationFailure as e:
+            logger.error(f"Failed to create indexes on {coll_name}: {str(e)}")
+    return created
+
+def _index_usage(collection):
+    """{index name: ops since server start} from $indexStats, or None if the server does not support it."""
+    try:
+        return {s["name"]: s["accesses"]["ops"] for s in collection.aggregate([{"$indexStats": {}}])}
+    except Exception:
+        return None
+
+def report_indexes(database):
+    """
+    Compares the declared indexes with what the server has. For each collection returns:
+    - missing: declared indexes that do not exist
+    - unmanaged: existing indexes that are not declared here (other than _id)
+    - unused: existing indexes with no recorded accesses (None when $indexStats is unavailable)
+    """
+    report = {}
+    for coll_name, specs in INDEXES.items():
+        collection = database[coll_name]
+        existing = _existing_patterns(collection)
+        declared = {_key_pattern(keys) for _, keys in specs}
+        usage = _index_usage(collection)
+        report[coll_name] = {
+            "missing": [name for name, keys in specs if _key_pattern(keys) not in existing],
+            "unmanaged": sorted(name for pattern, name in existing.items() if pattern not in declared and name != "_id_"),
+            "unused": None if usage is None else sorted(name for name, ops in usage.items() if ops == 0 and name != "_id_")
+        }
+    return report
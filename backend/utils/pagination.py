@@ -0,0 +1,73 @@
+import base64
+from bson import json_util
+
+# Keyset pagination for admin listings: pages are ordered by _id and the client passes back
+# an opaque `after` token naming the last document it saw, so every page is an index range
+# scan no matter how deep it is (unlike skip, which walks over all the skipped documents).
+
+MAX_PAGE_SIZE = 100
+# Admin clinical dumps return bare resources, so they allow larger pages
+MAX_DUMP_PAGE_SIZE = 1000
+SEARCH_MODES = ("contains", "prefix", "text")
+TOTAL_MODES = ("none", "estimate", "exact")
+# A filtered "estimate" counts at most this many matches
+ESTIMATE_COUNT_CAP = 10000
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(json_util.dumps({"after": last_id}).encode()).decode().rstrip("=")
+
+def decode_cursor(token):
+    """The _id a token points after, or None for an empty token. Raises ValueError if it is malformed."""
+    if not token:
+        return None
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        return json_util.loads(base64.urlsafe_b64decode(padded.encode()).decode())["after"]
+    except Exception:
+        raise ValueError("Invalid pagination token")
+
+def parse_cursor_args(args, default_limit=15, max_limit=MAX_PAGE_SIZE):
+    """
+    Reads after/limit/search/search_mode/total from request args.
+    Returns (params, error) where params holds the decoded cursor as `after`.
+    """
+    try:
+        limit = int(args.get("limit", default_limit))
+    except ValueError:
+        return None, "limit must be an integer"
+    if limit < 1 or limit > max_limit:
+        return None, f"limit must be between 1 and {max_limit}"
+    search_mode = args.get("search_mode", "contains")
+    if search_mode not in SEARCH_MODES:
+        return None, f"search_mode must be one of {list(SEARCH_MODES)}"
+    total = args.get("total", "none")
+    if total not in TOTAL_MODES:
+        return None, f"total must be one of {list(TOTAL_MODES)}"
+    try:
+        after = decode_cursor(args.get("after"))
+    except ValueError as e:
+        return None, str(e)
+    return {"after": after, "limit": limit, "search": args.get("search") or None,
+            "search_mode": search_mode, "total": total}, None
+
+def keyset_page(collection, query, limit, after=None, projection=None):
+    """One page in _id order after the given _id. Returns (items, next token or None)."""
+    if after is not None:
+        query = {"$and": [query, {"_id": {"$gt": after}}]} if query else {"_id": {"$gt": after}}
+    items = list(collection.find(query, projection).sort("_id", 1).limit(limit + 1))
+    next_token = encode_cursor(items[limit - 1]["_id"]) if len(items) > limit else None
+    return items[:limit], next_token
+
+def count_total(collection, query, mode, filtered=True):
+    """
+    Total for a listing: None for "none"; for "estimate" the collection metadata count when
+    unfiltered, else an exact count capped at ESTIMATE_COUNT_CAP. Returns (total, is_estimate).
+    """
+    if mode == "none":
+        return None, False
+    if mode == "exact":
+        return collection.count_documents(query), False
+    if not filtered:
+        return collection.estimated_document_count(), True
+    total = collection.count_documents(query, limit=ESTIMATE_COUNT_CAP)
+    return total, total >= ESTIMATE_COUNT_CAP
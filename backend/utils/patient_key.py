@@ -0,0 +1,79 @@
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from config import db
+from utils.logger import logger
+
+# Every resource that points at a patient stores the canonical key of that patient in
+# _patientKey: the patient's FHIR id if it has one, else its MongoDB _id as a string.
+# Lookups by patient are then a single indexed equality match, whichever spelling
+# ('Patient/ID', 'ID', FHIR id or _id) the resource's reference used.
+PATIENT_KEY_FIELD = "_patientKey"
+
+# Collection -> field holding the patient reference
+PATIENT_REFERENCE_FIELDS = {
+    "conditions": "subject",
+    "observations": "subject",
+    "medications": "subject",
+    "risk_assessments": "subject",
+    "coverage": "beneficiary",
+    "consents": "patient",
+}
+
+def patient_key(patient):
+    """The canonical key of a patient document (FHIR id, else MongoDB _id)."""
+    return patient.get("id") or (str(patient.get("_id")) if "_id" in patient else None)
+
+def reference_key(reference):
+    """Strips the 'Patient/' prefix from a reference; None if it is not a string."""
+    if not isinstance(reference, str):
+        return None
+    return reference[len("Patient/"):] if reference.startswith("Patient/") else reference
+
+def resolve_patient_key(patient_ref):
+    """
+    Canonical key for a patient reference or ID. Only an ObjectId-shaped value needs a lookup
+    (it may be the _id of a patient that has a FHIR id); anything else is already canonical.
+    """
+    key = reference_key(patient_ref)
+    if key and ObjectId.is_valid(key):
+        patient = db.get_db().patients.find_one({"_id": ObjectId(key), "resourceType": "Patient"}, {"id": 1})
+        if patient:
+            return patient_key(patient)
+    return key
+
+def stamp_patient_key(resource, field="subject"):
+    """Sets _patientKey on a resource from its patient reference field (no-op if there is none)."""
+    holder = resource.get(field)
+    if isinstance(holder, dict) and holder.get("reference"):
+        resource[PATIENT_KEY_FIELD] = resolve_patient_key(holder["reference"])
+    return resource
+
+def backfill_patient_keys(batch_size=1000, only_missing=True):
+    """
+    One-shot migration: stamps _patientKey on existing resources. Patients are read once into
+    an _id -> key map so no per-document lookups are needed. Idempotent; with only_missing=False
+    every document is re-stamped. Returns {collection: documents updated}.
+    """
+    database = db.get_db()
+    keys_by_object_id = {str(p["_id"]): patient_key(p) for p in database.patients.find({"resourceType": "Patient"}, {"id": 1})}
+
+    updated = {}
+    for coll_name, field in PATIENT_REFERENCE_FIELDS.items():
+        collection = database[coll_name]
+        query = {f"{field}.reference": {"$exists": True}}
+        if only_missing:
+            query[PATIENT_KEY_FIELD] = {"$exists": False}
+        ops, count = [], 0
+        for doc in collection.find(query, {f"{field}.reference": 1}):
+            key = reference_key((doc.get(field) or {}).get("reference"))
+            if not key: continue
+            key = keys_by_object_id.get(key, key)
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {PATIENT_KEY_FIELD: key}}))
+            if len(ops) >= batch_size:
+                count += collection.bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            count += collection.bulk_write(ops, ordered=False).modified_count
+        updated[coll_name] = count
+        logger.info(f"Backfilled {PATIENT_KEY_FIELD} on {count} {coll_name}")
+    return updated
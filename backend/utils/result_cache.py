@@ -0,0 +1,87 @@
+import threading
+import time
+from utils.logger import logger
+
+class _Flight:
+    """One in-progress computation that concurrent callers for the same key wait on."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class ResultCache:
+    """
+    In-process cache for expensive, read-only results.
+    - Fresh (age < ttl): served from memory.
+    - Stale (ttl <= age < ttl + stale_ttl): served immediately while one background
+      refresh recomputes it (stale-while-revalidate).
+    - Missing or expired: computed once; concurrent callers for the same key wait for
+      that single computation instead of starting their own (single-flight).
+    Expired entries are dropped when read, and at most max_entries are kept (oldest first out).
+    A ttl of 0 disables caching.
+    """
+    def __init__(self, ttl, stale_ttl=0, name="cache", max_entries=128):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.name = name
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}  # key -> (value, computed_at)
+        self._flights = {}  # key -> _Flight
+
+    def get(self, key, compute):
+        if self.ttl <= 0:
+            return compute()
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, computed_at = entry
+                age = now - computed_at
+                if age < self.ttl:
+                    return value
+                if age < self.ttl + self.stale_ttl:
+                    if key not in self._flights:
+                        self._flights[key] = _Flight()
+                        threading.Thread(target=self._run, args=(key, compute), daemon=True).start()
+                    return value
+                del self._entries[key]
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if leader:
+            self._run(key, compute)
+        else:
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _run(self, key, compute):
+        with self._lock:
+            flight = self._flights[key]
+        try:
+            flight.value = compute()
+            with self._lock:
+                self._entries.pop(key, None)
+                self._entries[key] = (flight.value, time.time())
+                while len(self._entries) > self.max_entries:
+                    # Dicts keep insertion order and entries are re-inserted on refresh,
+                    # so the first key is the least recently computed
+                    del self._entries[next(iter(self._entries))]
+        except Exception as e:
+            flight.error = e
+            logger.error(f"{self.name}: computing {key} failed: {str(e)}")
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def invalidate(self, key=None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
@@ -0,0 +1,67 @@
+import re
+from pymongo import UpdateOne
+from config import db
+from utils.logger import logger
+
+# _searchKeys holds the lowercased full name and each word of it, so a case-insensitive
+# prefix search ("smi" -> "John Smith") is an anchored regex on an indexed field.
+SEARCH_KEYS_FIELD = "_searchKeys"
+
+def _keys(*texts):
+    keys = []
+    for text in texts:
+        if not isinstance(text, str) or not text.strip():
+            continue
+        text = " ".join(text.lower().split())
+        for key in [text] + text.split(" "):
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+def patient_display_name(patient):
+    """Given names + family, else name.text (as listed in the admin patient view)."""
+    names = patient.get("name") or [{}]
+    name_obj = names[0] if isinstance(names, list) and names and isinstance(names[0], dict) else {}
+    display_name = f"{' '.join(name_obj.get('given', []))} {name_obj.get('family', '')}".strip()
+    return display_name or name_obj.get("text", "")
+
+def patient_search_keys(patient):
+    names = patient.get("name") or [{}]
+    name_obj = names[0] if isinstance(names, list) and names and isinstance(names[0], dict) else {}
+    return _keys(patient_display_name(patient), name_obj.get("text"))
+
+def user_search_keys(user):
+    return _keys(user.get("username"), user.get("name"))
+
+def stamp_search_keys(doc, keys_for):
+    doc[SEARCH_KEYS_FIELD] = keys_for(doc)
+    return doc
+
+def prefix_query(search):
+    """Index-backed, case-insensitive prefix match on _searchKeys."""
+    return {SEARCH_KEYS_FIELD: {"$regex": "^" + re.escape(" ".join(search.lower().split()))}}
+
+def backfill_search_keys(batch_size=1000, only_missing=True):
+    """
+    One-shot migration: stamps _searchKeys on patients and users. Idempotent; with
+    only_missing=False every document is re-stamped. Returns {collection: documents updated}.
+    """
+    database = db.get_db()
+    updated = {}
+    for coll_name, fields, keys_for in (
+        ("patients", {"name": 1}, patient_search_keys),
+        ("users", {"username": 1, "name": 1}, user_search_keys),
+    ):
+        collection = database[coll_name]
+        query = {SEARCH_KEYS_FIELD: {"$exists": False}} if only_missing else {}
+        ops, count = [], 0
+        for doc in collection.find(query, fields):
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {SEARCH_KEYS_FIELD: keys_for(doc)}}))
+            if len(ops) >= batch_size:
+                count += collection.bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            count += collection.bulk_write(ops, ordered=False).modified_count
+        updated[coll_name] = count
+        logger.info(f"Backfilled {SEARCH_KEYS_FIELD} on {count} {coll_name}")
+    return updated
@@ -0,0 +1,41 @@
+import re
+
+# Helpers for serving large collections without materializing them: documents are pulled
+# from a MongoDB cursor one batch at a time and written out as they are serialized.
+
+NDJSON_MIMETYPE = "application/fhir+ndjson"
+CURSOR_BATCH_SIZE = 1000
+
+_ELEMENT_NAME = re.compile(r"^[A-Za-z][A-Za-z0-9]*(\.[A-Za-z][A-Za-z0-9]*)*$")
+
+def elements_projection(elements, always=("resourceType",)):
+    """
+    MongoDB projection for a FHIR-style _elements parameter ("code,subject"). Returns
+    (projection, error); the projection is None when no elements were requested.
+    Internal fields (leading underscore) and operators cannot be selected.
+    """
+    if not elements:
+        return None, None
+    names = [e.strip() for e in elements.split(",") if e.strip()]
+    invalid = [e for e in names if not _ELEMENT_NAME.match(e)]
+    if invalid or not names:
+        return None, f"Invalid _elements: {', '.join(invalid) or elements}"
+    projection = {name: 1 for name in always}
+    projection.update({name: 1 for name in names})
+    return projection, None
+
+def stream_json_array(docs, dumps):
+    """Yields a JSON array of docs chunk by chunk."""
+    yield "["
+    first = True
+    for doc in docs:
+        if not first:
+            yield ","
+        first = False
+        yield dumps(doc)
+    yield "]"
+
+def stream_ndjson(docs, dumps):
+    """Yields one JSON document per line."""
+    for doc in docs:
+        yield dumps(doc) + "\n"
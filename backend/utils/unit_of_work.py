@@ -0,0 +1,51 @@
+from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateMany
+from config import db
+from utils.logger import logger
+
+# A request's writes are queued here and flushed together: one ordered bulk_write per
+# collection (queued order is kept, so "mark the old ones inactive, then insert the new
+# ones" still holds), inside one multi-document transaction when the deployment supports it.
+
+def transactions_supported(client):
+    """Multi-document transactions need a replica set or a sharded cluster."""
+    try:
+        return client.topology_description.topology_type_name in ("ReplicaSetWithPrimary", "Sharded")
+    except Exception:
+        return False
+
+class UnitOfWork:
+    def __init__(self):
+        self.client = db.client
+        self._ops = {}          # collection name -> [write ops]
+        self._collections = {}  # collection name -> collection, in first-use order
+
+    def _queue(self, collection, op):
+        self._collections.setdefault(collection.name, collection)
+        self._ops.setdefault(collection.name, []).append(op)
+
+    def insert(self, collection, doc):
+        """Queues an insert; the _id is allocated now so other queued documents can refer to it."""
+        doc.setdefault("_id", ObjectId())
+        self._queue(collection, InsertOne(doc))
+        return doc["_id"]
+
+    def update_many(self, collection, filter_query, update_data):
+        self._queue(collection, UpdateMany(filter_query, {"$set": update_data}))
+
+    def _flush(self, session=None):
+        for name, collection in self._collections.items():
+            collection.bulk_write(self._ops[name], ordered=True, session=session)
+
+    def commit(self):
+        """Writes everything queued: all or nothing when transactions are available."""
+        if not self._ops:
+            return
+        if transactions_supported(self.client):
+            with self.client.start_session() as session:
+                session.with_transaction(lambda s: self._flush(s))
+        else:
+            self._flush()
+        logger.info(f"Unit of work committed: {sum(len(ops) for ops in self._ops.values())} writes to {len(self._ops)} collections")
+        self._ops.clear()
+        self._collections.clear()
@@ -1,31 +1,102 @@
+import atexit
+import functools
+import json
+import logging
+import os
+import queue
+import re
+import threading
+from logging.handlers import QueueHandler, QueueListener
 from fhir.resources import get_fhir_model_class
 
-def validate_fhir_resource(resource_type, data):
+VALIDATION_ERROR_LOG = os.getenv("VALIDATION_ERROR_LOG", "/tmp/validation_errors.log")
+
+_TAG_PATTERN = re.compile(r'<[^>]*>')
+
+@functools.lru_cache(maxsize=None)
+def _model_class(resource_type):
+    """fhir.resources model class for a resource type; the lookup imports and resolves it, so it is done once."""
+    return get_fhir_model_class(resource_type)
+
+# --- Error log ---
+# Validation failures are handed to a queue and written to VALIDATION_ERROR_LOG by a
+# background listener, so a failing request never waits on opening and appending to a file.
+
+_error_logger = None
+_error_logger_lock = threading.Lock()
+
+def _validation_error_logger():
+    global _error_logger
+    with _error_logger_lock:
+        if _error_logger is None:
+            log_queue = queue.SimpleQueue()
+            file_handler = logging.FileHandler(VALIDATION_ERROR_LOG, delay=True)
+            file_handler.setFormatter(logging.Formatter("%(message)s\n"))
+            listener = QueueListener(log_queue, file_handler)
+            listener.start()
+            atexit.register(listener.stop)  # Drains anything still queued
+
+            error_logger = logging.getLogger("healthai.validation")
+            error_logger.propagate = False
+            error_logger.setLevel(logging.INFO)
+            error_logger.addHandler(QueueHandler(log_queue))
+            _error_logger = error_logger
+        return _error_logger
+
+def _drop_none(value):
+    if isinstance(value, dict):
+        return {k: _drop_none(v) for k, v in value.items() if v is not None}
+    if isinstance(value, list):
+        return [_drop_none(v) for v in value if v is not None]
+    return value
+
+def validate_fhir_resource(resource_type, data, log_errors=True, canonical=False):
     """
     Validates data against FHIR R4 models using fhir.resources.
     Returns (validated_data_dict, error_message).
+    canonical=True is for the fixed shapes the API builds itself (registration, clinical
+    updates): they hold only JSON primitives already in FHIR form (UTC times ending in "Z"),
+    so once validated the data is returned without None values instead of re-serializing
+    the model, which costs more than validating it.
     """
     try:
-        ResourceTypeClass = get_fhir_model_class(resource_type)
-        # Use parse_obj or instantiation
-        resource = ResourceTypeClass(**data)
-        # Convert to JSON and back to dict to ensure all custom types (like date) 
-        # are converted to JSON primitives (strings) which Mongo/Flask handle better 
-        # and matches our existing logic (expecting date strings).
-        import json
-        return json.loads(resource.json()), None
+        resource = _model_class(resource_type).model_validate(data)
+        if canonical:
+            return _drop_none(data), None
+        # JSON-mode dump: dates and other custom types come out as JSON primitives (strings),
+        # which Mongo/Flask handle better and which the rest of the code expects
+        return resource.model_dump(mode="json"), None
     except Exception as e:
-        with open("/tmp/validation_errors.log", "a") as f:
-             f.write(f"Validation Error for {resource_type}: {str(e)}\nData: {data}\n\n")
+        if log_errors:
+            _validation_error_logger().info("Validation Error for %s: %s\nData: %s", resource_type, e, data)
         return None, str(e)
 
+def validate_ndjson_lines(lines, allowed_types):
+    """
+    Parses and validates a chunk of NDJSON lines ([(line_no, text)]); runs in $import worker
+    processes. Returns [(line_no, validated resource or None, error or None)].
+    """
+    results = []
+    for line_no, text in lines:
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            results.append((line_no, None, f"Invalid JSON: {e}"))
+            continue
+        resource_type = data.get("resourceType") if isinstance(data, dict) else None
+        if resource_type not in allowed_types:
+            results.append((line_no, None, f"Unexpected resourceType: {resource_type} (expected {', '.join(allowed_types)})"))
+            continue
+        validated, error = validate_fhir_resource(resource_type, data, log_errors=False)
+        results.append((line_no, validated, error))
+    return results
+
 def sanitize_text(text):
     """
     Simple sanitization to remove potential HTML/Script tags.
     """
     if not isinstance(text, str):
         return text
-    import re
     # Remove <script> tags and html tags
-    text = re.sub(r'<[^>]*>', '', text)
+    text = _TAG_PATTERN.sub('', text)
     return text.strip()
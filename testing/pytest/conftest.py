@@ -1,7 +1,12 @@
+import os
+import sys
 import pytest
 import requests
 from pymongo import MongoClient
 
+# Unit tests import backend modules directly
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "backend"))
+
 BASE_URL = "http://localhost:5000/api"
 MONGO_URI = "mongodb://localhost:27017/fhir_db"
 
@@ -39,6 +44,8 @@ def cleanup_db(mongo_db):
     mongo_db.observations.delete_many({"subject.reference": {"$in": test_patient_refs}})
     mongo_db.medications.delete_many({"subject.reference": {"$in": test_patient_refs}})
     mongo_db.risk_assessments.delete_many({"subject.reference": {"$in": test_patient_refs}})
+    mongo_db.patient_risk.delete_many({"patientKey": {"$in": test_patient_ids}})
+    mongo_db.patient_signatures.delete_many({"patientId": {"$in": test_patient_ids}})
     # Also cleanup clinical versions and history
     mongo_db.clinical_versions.delete_many({"patientId": {"$in": test_patient_ids}})
     mongo_db.history.delete_many({"originalId": {"$regex": f"^{test_prefix}"}})
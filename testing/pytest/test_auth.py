@@ -47,3 +47,20 @@ def test_uat_auth_04_unauthorized_access(api_base_url):
     # No token access
     response = requests.get(f"{api_base_url}/admin/patients")
     assert response.status_code == 401
+
+def test_uat_auth_05_admin_patient_cursor_pagination(api_base_url, auth_header):
+    # Walking the listing with ?after= tokens visits every patient exactly once
+    first = requests.get(f"{api_base_url}/admin/patients", params={"after": "", "limit": 5, "total": "exact"}, headers=auth_header)
+    assert first.status_code == 200
+    total = first.json()["total"]
+
+    seen = [p["id"] for p in first.json()["data"]]
+    token = first.json()["next"]
+    while token:
+        page = requests.get(f"{api_base_url}/admin/patients", params={"after": token, "limit": 5}, headers=auth_header).json()
+        seen.extend(p["id"] for p in page["data"])
+        token = page["next"]
+    assert len(seen) == len(set(seen)) == total
+
+    bad = requests.get(f"{api_base_url}/admin/patients", params={"after": "not-a-token"}, headers=auth_header)
+    assert bad.status_code == 400
@@ -1,4 +1,6 @@
 import requests
+import json
+import time
 import pytest
 
 def test_uat_fhir_01_valid_ingestion(api_base_url, auth_header, mongo_db):
@@ -38,3 +40,90 @@ def test_uat_fhir_03_invalid_structure(api_base_url, auth_header):
     }
     response = requests.post(f"{api_base_url}/Patient", json=data, headers=auth_header)
     assert response.status_code == 400
+
+def test_uat_fhir_04_transaction_bundle(api_base_url, auth_header, mongo_db):
+    patient_id = "pytest-fhir-04"
+    mongo_db.patients.delete_many({"id": patient_id})
+    mongo_db.conditions.delete_many({"subject.reference": f"Patient/{patient_id}"})
+
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "entry": [
+            {
+                "fullUrl": "urn:uuid:pytest-fhir-04-patient",
+                "resource": {"resourceType": "Patient", "id": patient_id, "name": [{"text": "Bundle Patient"}]},
+                "request": {"method": "POST", "url": "Patient"}
+            },
+            {
+                "resource": {
+                    "resourceType": "Condition",
+                    "clinicalStatus": {"text": "Active"},
+                    "code": {"text": "Asthma"},
+                    "subject": {"reference": "urn:uuid:pytest-fhir-04-patient"}
+                },
+                "request": {"method": "POST", "url": "Condition"}
+            }
+        ]
+    }
+    response = requests.post(f"{api_base_url}/", json=bundle, headers=auth_header)
+    assert response.status_code == 200
+    body = response.json()
+    assert body["type"] == "transaction-response"
+    assert [e["response"]["status"] for e in body["entry"]] == ["201 Created", "201 Created"]
+    assert mongo_db.conditions.count_documents({"subject.reference": f"Patient/{patient_id}"}) == 1
+
+    # One invalid entry rejects the whole transaction
+    bundle["entry"][0]["resource"]["id"] = "pytest-fhir-04-rejected"
+    bundle["entry"][1]["resource"]["code"] = "not a CodeableConcept"
+    response = requests.post(f"{api_base_url}/", json=bundle, headers=auth_header)
+    assert response.status_code == 400
+    assert mongo_db.patients.count_documents({"id": "pytest-fhir-04-rejected"}) == 0
+
+def test_uat_fhir_05_bulk_export(api_base_url, auth_header):
+    response = requests.get(f"{api_base_url}/$export", params={"_type": "Patient"}, headers=auth_header)
+    assert response.status_code == 202
+    status_url = response.headers["Content-Location"]
+
+    for _ in range(60):
+        status = requests.get(status_url, headers=auth_header)
+        if status.status_code != 202:
+            break
+        time.sleep(1)
+    assert status.status_code == 200
+    manifest = status.json()
+    assert [o["type"] for o in manifest["output"]] == ["Patient"]
+
+    ndjson = requests.get(manifest["output"][0]["url"], headers=auth_header)
+    assert ndjson.status_code == 200
+    lines = ndjson.text.splitlines()
+    assert len(lines) == manifest["output"][0]["count"]
+    assert all(json.loads(line)["resourceType"] == "Patient" for line in lines)
+
+def test_uat_fhir_06_bulk_import(api_base_url, auth_header, mongo_db):
+    patient_id = "pytest-fhir-06"
+    mongo_db.patients.delete_many({"id": patient_id})
+    lines = [
+        json.dumps({"resourceType": "Patient", "id": patient_id, "name": [{"text": "Import Patient"}]}),
+        json.dumps({"resourceType": "Patient", "name": "Invalid String Name instead of Array"}),
+    ]
+    response = requests.post(
+        f"{api_base_url}/$import", data="\n".join(lines),
+        headers={**auth_header, "Content-Type": "application/fhir+ndjson"}
+    )
+    assert response.status_code == 202
+    status_url = response.headers["Content-Location"]
+
+    for _ in range(60):
+        status = requests.get(status_url, headers=auth_header)
+        if status.status_code != 202:
+            break
+        time.sleep(1)
+    assert status.status_code == 200
+    manifest = status.json()
+    assert manifest["output"][0]["count"] == 1
+    assert manifest["error"][0]["count"] == 1
+    assert mongo_db.patients.count_documents({"id": patient_id}) == 1
+
+    errors = requests.get(manifest["error"][0]["url"], headers=auth_header)
+    assert json.loads(errors.text.splitlines()[0])["resourceType"] == "OperationOutcome"
@@ -0,0 +1,58 @@
+import json
+import pytest
+from services.ingestion_service import iter_json_records, ingest_file, Checkpoint
+
+RECORDS = [
+    {"resourceType": "Patient", "id": "a", "name": [{"text": "O'Brien, \"Jr\" [x]"}]},
+    {"resourceType": "Condition", "code": {"text": "Fever, high {acute}"}, "note": ["a,b", "]["]},
+    {"resourceType": "Observation", "valueQuantity": {"value": 98.6, "unit": "°F"}, "flags": [True, None, 0]},
+    {"resourceType": "Patient", "id": "b", "empty": {}, "list": []},
+]
+
+def test_ingest_01_json_array_any_chunk_size(tmp_path):
+    path = tmp_path / "records.json"
+    text = "  \n" + json.dumps(RECORDS, indent=2, ensure_ascii=False) + "\n"
+    path.write_text(text, encoding="utf-8")
+    # Every chunk size puts the boundary inside a string, a number, between records, ...
+    for chunk_size in range(1, len(text) + 1):
+        assert list(iter_json_records(str(path), chunk_size=chunk_size)) == RECORDS, chunk_size
+
+def test_ingest_02_ndjson(tmp_path):
+    path = tmp_path / "records.ndjson"
+    path.write_text("\n" + "\n\n".join(json.dumps(r) for r in RECORDS) + "\n", encoding="utf-8")
+    for chunk_size in (1, 7, 4096):
+        assert list(iter_json_records(str(path), chunk_size=chunk_size)) == RECORDS
+
+    path.write_text(json.dumps(RECORDS[0]) + "\n{not json}\n", encoding="utf-8")
+    with pytest.raises(ValueError, match="line 2"):
+        list(iter_json_records(str(path)))
+
+def test_ingest_03_truncated_array(tmp_path):
+    path = tmp_path / "truncated.json"
+    path.write_text(json.dumps(RECORDS)[:-10], encoding="utf-8")
+    with pytest.raises(ValueError):
+        list(iter_json_records(str(path), chunk_size=16))
+
+def test_ingest_04_checkpoint_resume(tmp_path, mongo_db):
+    ids = [f"pytest-ingest-{i:02d}" for i in range(10)]
+    mongo_db.patients.delete_many({"id": {"$in": ids}})
+    path = tmp_path / "patients.ndjson"
+    path.write_text("".join(json.dumps({"resourceType": "Patient", "id": pid}) + "\n" for pid in ids), encoding="utf-8")
+
+    # An earlier run stopped after its fourth record
+    checkpoint = Checkpoint(str(tmp_path / "checkpoint.json"))
+    checkpoint.save(str(path), 4)
+
+    stats = ingest_file(str(path), batch_size=3, checkpoint=Checkpoint(checkpoint.path))
+    assert stats["resumed_at"] == 4
+    assert stats["read"] == 6
+    assert stats["written"] == 6
+    assert sorted(p["id"] for p in mongo_db.patients.find({"id": {"$in": ids}})) == ids[4:]
+
+    # The file is recorded as complete, so a rerun reads nothing
+    rerun = ingest_file(str(path), checkpoint=Checkpoint(checkpoint.path))
+    assert rerun["read"] == 0 and rerun["already_complete"]
+
+    # Editing the file invalidates its checkpoint entry
+    path.write_text(path.read_text() + json.dumps({"resourceType": "Patient", "id": "pytest-ingest-10"}) + "\n")
+    assert Checkpoint(checkpoint.path).position(str(path)) == (0, False)
@@ -0,0 +1,59 @@
+import pytest
+from services import risk_service
+from services.analytics_service import AnalyticsService, POPULATION_VIEWS
+from services.population_snapshot import PopulationSnapshot, SnapshotAnalyticsBackend
+
+PREFIX = "pytest-snap-"
+
+@pytest.fixture
+def snapshot_population(mongo_db):
+    """A small population covering the edge cases both backends must agree on."""
+    def clinical(pid, **fields):
+        return {"subject": {"reference": f"Patient/{pid}"}, "_patientKey": pid, **fields}
+
+    mongo_db.patients.insert_many([
+        {"resourceType": "Patient", "id": f"{PREFIX}01", "birthDate": "1950-03-01", "address": [{"city": "Springfield"}]},
+        {"resourceType": "Patient", "id": f"{PREFIX}02", "birthDate": "not-a-date"},
+        {"resourceType": "Patient", "id": f"{PREFIX}03", "address": []},
+        {"resourceType": "Patient", "id": f"{PREFIX}04", "birthDate": "2010-06-15", "address": [{"city": "Shelbyville"}]},
+    ])
+    mongo_db.conditions.insert_many([
+        clinical(f"{PREFIX}01", resourceType="Condition", clinicalStatus={"text": "Active"}, code={"text": "Hypertension"}),
+        clinical(f"{PREFIX}01", resourceType="Condition", clinicalStatus={"text": "Active"}, code={"text": "Type 2 Diabetes"}),
+        clinical(f"{PREFIX}01", resourceType="Condition", clinicalStatus={"text": "Resolved"}, code={"text": "Common Cold"}),
+        clinical(f"{PREFIX}02", resourceType="Condition", clinicalStatus={"text": "Active"}),
+        clinical(f"{PREFIX}03", resourceType="Condition", clinicalStatus={"text": "Active"}, code={"text": "Asthma"}),
+        clinical(f"{PREFIX}ghost", resourceType="Condition", clinicalStatus={"text": "Active"}, code={"text": "Asthma"}),
+    ])
+    mongo_db.observations.insert_many([
+        clinical(f"{PREFIX}01", resourceType="Observation", status="final", code={"text": "Systolic Blood Pressure"}, valueQuantity={"value": 180}),
+        clinical(f"{PREFIX}01", resourceType="Observation", code={"text": "Heart Rate"}, valueQuantity={"value": 70}),
+        clinical(f"{PREFIX}02", resourceType="Observation", code={"text": "Systolic Blood Pressure"}),
+        clinical(f"{PREFIX}04", resourceType="Observation", status="final", code={"text": "Fasting Blood Glucose"}, valueQuantity={"value": 90}),
+    ])
+    mongo_db.medications.insert_many([
+        clinical(f"{PREFIX}01", resourceType="MedicationRequest", status="active", medicationCodeableConcept={"text": "Metformin"}),
+        clinical(f"{PREFIX}02", resourceType="MedicationRequest", status="stopped", medicationReference={"display": "Lisinopril"}),
+        {"resourceType": "MedicationRequest", "id": f"{PREFIX}med-unlinked", "status": "active", "medicationCodeableConcept": {"text": "Aspirin"}},
+    ])
+    yield
+    mongo_db.patients.delete_many({"id": {"$regex": f"^{PREFIX}"}})
+    for collection in ("conditions", "observations", "medications"):
+        mongo_db[collection].delete_many({"_patientKey": {"$regex": f"^{PREFIX}"}})
+    mongo_db.medications.delete_many({"id": {"$regex": f"^{PREFIX}"}})
+
+def test_snapshot_views_match_python_scan(snapshot_population):
+    service = AnalyticsService()
+    service.backend = None  # The python _scan path, whatever ANALYTICS_BACKEND is set to
+    expected = service._scan(list(POPULATION_VIEWS))
+
+    snapshot = PopulationSnapshot(service)
+    for name, view in SnapshotAnalyticsBackend.VIEWS.items():
+        assert view(snapshot) == expected[name], name
+
+def test_snapshot_risk_components_match_python_engine(snapshot_population, monkeypatch):
+    monkeypatch.setattr(risk_service, "ANALYTICS_BACKEND", "python")
+    expected = risk_service.extract_population_components()
+
+    snapshot = PopulationSnapshot(AnalyticsService())
+    assert snapshot.risk_components() == expected
@@ -1,3 +1,4 @@
+import random
 import requests
 import pytest
 
@@ -54,3 +55,36 @@ def test_uat_ins_02_recommendation_explanation(api_base_url, auth_header):
     data = response.json()
     assert "explanation" in data
     assert len(data["explanation"]) > 20 # Ensure non-empty meaningful explanation
+
+def test_uat_sim_02_approximate_recall(api_base_url, auth_header, mongo_db):
+    # A fixture cohort of a gender no seeded patient has, so the result does not depend on the rest of the data
+    rng = random.Random(7)
+    codes = ["Diabetes", "Hypertension", "Asthma", "COPD", "Obesity", "Arthritis", "Depression"]
+    ids = [f"pytest-sim-02-{i:02d}" for i in range(40)]
+    mongo_db.patients.delete_many({"id": {"$in": ids}})
+    mongo_db.conditions.delete_many({"subject.reference": {"$in": [f"Patient/{pid}" for pid in ids]}})
+
+    for pid in ids:
+        requests.post(f"{api_base_url}/Patient", json={
+            "resourceType": "Patient", "id": pid, "gender": "other",
+            "birthDate": f"{rng.randint(1940, 1995)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}"
+        }, headers=auth_header)
+        for code in rng.sample(codes, rng.randint(1, 3)):
+            requests.post(f"{api_base_url}/Condition", json={
+                "resourceType": "Condition", "clinicalStatus": {"text": "Active"},
+                "code": {"text": code}, "subject": {"reference": f"Patient/{pid}"}
+            }, headers=auth_header)
+
+    # Score recall: ties between equally similar patients may be broken differently
+    recalls = []
+    for pid in ids[:10]:
+        exact = requests.get(f"{api_base_url}/Patient/{pid}/similar?k=5", headers=auth_header).json()
+        approx = requests.get(f"{api_base_url}/Patient/{pid}/similar?k=5&mode=approximate", headers=auth_header).json()
+        remaining = [p["similarity_score"] for p in approx]
+        matched = 0
+        for p in exact:
+            if p["similarity_score"] in remaining:
+                remaining.remove(p["similarity_score"])
+                matched += 1
+        recalls.append(matched / len(exact) if exact else 1.0)
+    assert sum(recalls) / len(recalls) >= 0.9
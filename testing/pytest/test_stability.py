@@ -40,3 +40,13 @@ def test_uat_data_03_performance_under_load(api_base_url, auth_header):
     assert response.status_code == 200
     # Acceptance criteria: within acceptable time (e.g. < 2 seconds for this dataset size)
     assert duration < 2.0
+
+def test_uat_data_04_concurrent_summary_requests_share_result(api_base_url, auth_header):
+    # Identical concurrent requests are coalesced into one computation and get the same body
+    url = f"{api_base_url}/analytics/population/summary"
+    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+        responses = list(executor.map(lambda _: requests.get(url, headers=auth_header), range(5)))
+
+    assert all(r.status_code == 200 for r in responses)
+    assert all(r.json() == responses[0].json() for r in responses)
+    assert "disease_distribution" in responses[0].json()